@@ -1,7 +1,7 @@
 #!/bin/bash
 
 ndays=4
-NCPU=1
+NCPU=auto
 
 agupinholesearch --ndays ${ndays} --ncpu ${NCPU} --loglevel INFO --database ${DATABASE} --useaws
 aguanalysis --database ${DATABASE} --outputpath agupinhole_html
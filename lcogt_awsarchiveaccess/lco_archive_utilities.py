@@ -1,16 +1,19 @@
+import concurrent.futures
+import contextlib
 import datetime
+import fnmatch
 import glob
 import io
+import json
 import logging
 import os
+import queue
+import re
+import threading
+import time
 
 import numpy as np
 import requests
-from astropy.io import fits
-from astropy.table import Table
-
-from opensearchpy import OpenSearch
-from opensearch_dsl import Search
 
 log = logging.getLogger(__name__)
 logging.getLogger('elasticsearch').setLevel(logging.WARNING)
@@ -18,6 +21,36 @@ logging.getLogger('connectionpool').setLevel(logging.WARNING)
 
 ARCHIVE_ROOT = "/archive/engineering"
 ARCHIVE_API_TOKEN = os.getenv('ARCHIVE_API_TOKEN', '')
+ARCHIVE_API_URL = os.getenv('ARCHIVE_API_URL', 'https://archive-api.lco.global')
+OPENSEARCH_URL = os.getenv('OPENSEARCH_URL', 'https://opensearch.lco.global')
+# seconds an archive request may wait for a connection or for the next bytes; a stalled transfer raises instead of
+# holding its thread forever.
+ARCHIVE_REQUEST_TIMEOUT = float(os.getenv('ARCHIVE_REQUEST_TIMEOUT', '60'))
+
+# Records query and download latencies, byte counts, and queue depths if set, see set_metrics.
+metrics = None
+
+
+def set_metrics(recorder):
+    """ Record the run time metrics of this module into recorder, an object with timed(stage), count(name, n) and
+    gauge(name, value) like a MetricsRegistry of lcogt_nres_aguanalysis.agumetrics, or nowhere if None.
+    """
+    global metrics
+    metrics = recorder
+
+
+def _timed(stage):
+    return metrics.timed(stage) if metrics is not None else contextlib.nullcontext()
+
+
+def _count(name, n=1):
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def _gauge(name, value):
+    if metrics is not None:
+        metrics.gauge(name, value)
 
 
 class ArchiveDiskCrawler:
@@ -58,14 +91,121 @@ class ArchiveDiskCrawler:
         dir = "{}{}/{}/{}/{}".format(prefix, sitecamera, date, raworprocessed, filetempalte)
         files = glob.glob(dir)
         if (files is not None) and (len(files) > 0):
+            from astropy.table import Table
             myfiles = np.asarray([[f, "-1"] for f in files])
-            return Table(myfiles, names=['FILENAME', 'FRAMEID'])
+            return Table(myfiles, names=['filename', 'frameid'])
         return None
 
 
+class ScandirArchiveCrawler(ArchiveDiskCrawler):
+    """ Disk crawler for a network mounted /archive that lists camera / date directories with os.scandir from a
+    pool of threads, and streams the results instead of building tables.
+
+    Listings of past days do not change anymore, so they are cached, keyed by the directory's mtime, and optionally
+    persisted in a json cache file between runs. A cached listing costs a single stat instead of a directory read.
+    """
+
+    def __init__(self, rootdirectory=ARCHIVE_ROOT, nthreads=16, cachefile=None):
+        super().__init__(rootdirectory)
+        self.nthreads = nthreads
+        self.cachefile = cachefile
+        self.cache = {}
+        self.cachehits = 0
+        self.cachemisses = 0
+        self._lock = threading.Lock()
+        if (cachefile is not None) and os.path.exists(cachefile):
+            try:
+                with open(cachefile) as f:
+                    self.cache = json.load(f)
+            except (OSError, ValueError):
+                log.warning(f"Could not read directory listing cache {cachefile}, starting empty")
+
+    def find_cameras(self, sites=[], cameras=["fa??", "fs??", "kb??"]):
+        def camerasatsite(site):
+            sitedir = "{}/{}".format(self.archive_root, site)
+            try:
+                with os.scandir(sitedir) as entries:
+                    return sorted(entry.path for entry in entries if entry.is_dir() and
+                                  any(fnmatch.fnmatch(entry.name, camera) for camera in cameras))
+            except FileNotFoundError:
+                return []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads) as e:
+            return [c for sitecameras in e.map(camerasatsite, sites) for c in sitecameras]
+
+    def _scandir(self, directory):
+        """ Names of the files in directory, [] if it does not exist. """
+        try:
+            with os.scandir(directory) as entries:
+                return [entry.name for entry in entries if entry.is_file()]
+        except FileNotFoundError:
+            return []
+
+    def list_directory(self, directory, cacheable=True):
+        """ File names in directory. The listing is served from the cache if the directory mtime did not change.
+            A missing directory is cached against the mtime of its closest existing parent, so it is looked at again
+            once something gets created underneath that parent.
+        """
+        stamp = None
+        path = directory
+        while stamp is None:
+            try:
+                stamp = [path, os.stat(path).st_mtime_ns]
+            except FileNotFoundError:
+                if os.path.dirname(path) == path:
+                    stamp = [path, None]
+                path = os.path.dirname(path)
+
+        cached = self.cache.get(directory) if cacheable else None
+        if (cached is not None) and (cached['stamp'] == stamp):
+            with self._lock:
+                self.cachehits += 1
+            return cached['entries']
+
+        entries = self._scandir(directory) if stamp[0] == directory else []
+        with self._lock:
+            self.cachemisses += 1
+            if cacheable:
+                self.cache[directory] = {'stamp': stamp, 'entries': entries}
+        return entries
+
+    def files_for_camera_date(self, sitecamera, date, raworprocessed, filetemplate, today=None):
+        """ list of {'filename', 'frameid'} records of files matching filetemplate in sitecamera/date/raworprocessed.
+            Only listings older than yesterday are cached, more recent ones can still change.
+        """
+        today = datetime.datetime.utcnow() if today is None else today
+        cacheable = date < (today - datetime.timedelta(days=1)).strftime("%Y%m%d")
+        directory = "{}/{}/{}".format(sitecamera, date, raworprocessed)
+        names = self.list_directory(directory, cacheable=cacheable)
+        return [{'filename': os.path.join(directory, name), 'frameid': -1}
+                for name in sorted(fnmatch.filter(names, filetemplate))]
+
+    def iter_files_for_cameras_dates(self, sitecameras, dates, raworprocessed, filetemplate):
+        """ Generator over (sitecamera, date, files) for all combinations of cameras and dates, in the order the
+            listings complete. files is a list of {'filename', 'frameid'} records.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.nthreads) as e:
+            futures = {e.submit(self.files_for_camera_date, sitecamera, date, raworprocessed, filetemplate):
+                           (sitecamera, date) for sitecamera in sitecameras for date in dates}
+            for future in concurrent.futures.as_completed(futures):
+                sitecamera, date = futures[future]
+                yield sitecamera, date, future.result()
+        self.save_cache()
+
+    def save_cache(self):
+        if self.cachefile is None:
+            return
+        log.debug(f"Directory listing cache: {self.cachehits} hits, {self.cachemisses} misses")
+        tmpfile = f'{self.cachefile}.{os.getpid()}.tmp'
+        with self._lock:
+            with open(tmpfile, 'w') as f:
+                json.dump(self.cache, f)
+        os.replace(tmpfile, self.cachefile)
+
+
 def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_filters=None, prefix_filters=None,
                     terms_filters=None,
-                    es_url='https://opensearch.lco.global'):
+                    es_url=OPENSEARCH_URL):
     """
     Make an OpenSearch query
 
@@ -92,6 +232,10 @@ def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_
     search : opensearch_dsl.Search
              The OpenSearch object
     """
+    # the OpenSearch clients are only needed in aws mode, so they are imported here rather than at module load.
+    from opensearchpy import OpenSearch
+    from opensearch_dsl import Search
+
     if queries is None:
         queries = []
     if exclusion_filters is None:
@@ -120,16 +264,22 @@ def make_opensearch(index, filters, queries=None, exclusion_filters=None, range_
 
 
 def get_frames_by_identifiers(dayobs, site=None, cameratype=None, camera=None, mintexp=30, obstype='EXPOSE', rlevel=91,
-                              filterlist=None, es_url='https://opensearch.lco.global'):
+                              filterlist=None, es_url=OPENSEARCH_URL, lastdayobs=None):
     """ Queries for a list of processed LCO images that are viable to get a photometric zeropoint in the griz bands measured.
 
         Selection criteria are by DAY-OBS, site, by camera type (fs,fa,kb), what filters to use, and minimum exposure time.
         Only day-obs is a mandatory fields, we do not want to query the entire archive at once.
+        With lastdayobs, all nights from dayobs to lastdayobs (YYYYMMDD, inclusive) are queried at once, e.g., a month
+        for a backfill.
      """
 
     # TODO: further preselect by number of sources to avoid overly crowded or empty fields
-    query_filters = [{'DAY-OBS': dayobs}, {'FOCOBOFF': 0}]
+    query_filters = [{'FOCOBOFF': 0}]
     range_filters = [{'EXPTIME': {'gte': mintexp}}, ]
+    if lastdayobs is None:
+        query_filters.insert(0, {'DAY-OBS': dayobs})
+    else:
+        range_filters.append({'DAY-OBS': {'gte': dayobs, 'lte': lastdayobs}})
     terms_filters = []
     prefix_filters = []
 
@@ -147,12 +297,15 @@ def get_frames_by_identifiers(dayobs, site=None, cameratype=None, camera=None, m
         terms_filters.append({'FILTER': filterlist})
 
     queries = []
-    records = make_opensearch('lco-fitsheaders', query_filters, queries, exclusion_filters=None, es_url=es_url,
-                              range_filters=range_filters, prefix_filters=prefix_filters,
-                              terms_filters=terms_filters).scan()
-    if records is None:
-        return None
-    records_sanitized = np.asarray([[record['filename'], record['frameid']] for record in records])
+    with _timed('opensearch_query'):
+        records = make_opensearch('lco-fitsheaders', query_filters, queries, exclusion_filters=None, es_url=es_url,
+                                  range_filters=range_filters, prefix_filters=prefix_filters,
+                                  terms_filters=terms_filters).scan()
+        if records is None:
+            return None
+        records_sanitized = np.asarray([[record['filename'], record['frameid']] for record in records])
+    _count('opensearch_records', len(records_sanitized))
+    from astropy.table import Table
     records_sanitized = Table(records_sanitized, names=['filename', 'frameid'])
     return records_sanitized
 
@@ -162,6 +315,8 @@ def filename_to_archivepath_dict(filenametable, rootpath='/archive/engineering')
         We are still married to /archive file names here - because reasons. Long term we should go away from that.
     '''
 
+    from astropy.table import Table
+
     cameras = set(filenametable['INSTRUME'])
     returndict = {}
     for camera in cameras:
@@ -169,28 +324,290 @@ def filename_to_archivepath_dict(filenametable, rootpath='/archive/engineering')
                                                           record['DAY-OBS'], 'raw', record['FILENAME']),
                                record['frameid']] for record in filenametable[filenametable['INSTRUME'] == camera]]
 
-        returndict[camera] = Table(np.asarray(returndict[camera]), names=['FILENAME', 'frameid'])
+        returndict[camera] = Table(np.asarray(returndict[camera]), names=['filename', 'frameid'])
     return returndict
 
 
-def download_from_archive(frameid):
+FITS_BLOCK = 2880
+# The first range request of a frame; covers the headers and the tile table of an AGU frame, ~35 kB.
+RANGE_FIRST_BYTES = 16 * FITS_BLOCK
+# bytes per element of binary table TFORM codes
+TFORM_WIDTHS = {'L': 1, 'B': 1, 'I': 2, 'J': 4, 'K': 8, 'A': 1, 'E': 4, 'D': 8, 'C': 8, 'M': 16, 'P': 8, 'Q': 16}
+
+
+class RangeReader:
+    """ Sparse local copy of a remote file that is filled with HTTP range requests as parts of it are read.
+
+    If the server ignores the Range header and sends the whole file, the copy is complete after the first request,
+    and every later read is served locally. That is the fallback to a full download.
     """
-    Download a file from the LCO archive by frame id.
+
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session if session is not None else requests
+        self.size = None
+        self.buffer = None
+        self.ranges = []
+        self.nbytes = 0
+
+    def read(self, start, end):
+        """ Bytes start:end of the remote file, fetched if not all of them are local yet."""
+        if self.size is not None:
+            end = min(end, self.size)
+        if not any((first <= start) and (end <= last) for first, last in self.ranges):
+            response = self.session.get(self.url, headers={'Range': f'bytes={start}-{end - 1}'},
+                                        timeout=ARCHIVE_REQUEST_TIMEOUT)
+            response.raise_for_status()
+            self.nbytes += len(response.content)
+            _count('range_requests')
+            if response.status_code == 206:
+                if self.buffer is None:
+                    self.size = int(response.headers['Content-Range'].rsplit('/', 1)[1])
+                    self.buffer = bytearray(self.size)
+                self.buffer[start:start + len(response.content)] = response.content
+                self.ranges.append((start, start + len(response.content)))
+            else:
+                log.info(f"Server does not support range requests, downloaded all of {self.url}")
+                _count('range_fallbacks')
+                self.size = len(response.content)
+                self.buffer = bytearray(response.content)
+                self.ranges = [(0, self.size)]
+            end = min(end, self.size)
+        return bytes(self.buffer[start:end])
+
+
+def _read_header(reader, offset):
+    """ Parse the FITS header that starts at byte offset. Returns the header, and the offset of the data after it."""
+    from astropy.io import fits
+    cards = b''
+    position = offset
+    while True:
+        chunk = reader.read(position, position + RANGE_FIRST_BYTES)
+        if len(chunk) < FITS_BLOCK:
+            raise OSError(f"Truncated FITS header at byte {position} of {reader.url}")
+        for ii in range(0, len(chunk) - FITS_BLOCK + 1, FITS_BLOCK):
+            block = chunk[ii:ii + FITS_BLOCK]
+            cards += block
+            if any(block[jj:jj + 80].rstrip() == b'END' for jj in range(0, FITS_BLOCK, 80)):
+                return fits.Header.fromstring(cards.decode('ascii')), position + ii + FITS_BLOCK
+        position += len(chunk) - len(chunk) % FITS_BLOCK
+
+
+def _padded_data_size(header):
+    """ Size of the data of a FITS HDU, including the padding to full blocks."""
+    naxis = [header[f'NAXIS{ii}'] for ii in range(1, header['NAXIS'] + 1)]
+    size = abs(header['BITPIX']) // 8 * header.get('GCOUNT', 1) * \
+        (header.get('PCOUNT', 0) + (int(np.prod(naxis)) if naxis else 0))
+    return -(-size // FITS_BLOCK) * FITS_BLOCK
+
+
+def _descriptor_columns(header):
+    """ Variable length array columns of a binary table.
+        Returns a list of (byte offset in the table row, descriptor dtype, bytes per heap element).
+    """
+    columns = []
+    offset = 0
+    for ii in range(1, header['TFIELDS'] + 1):
+        repeat, code, element = re.match(r'(\d*)([A-Z])([A-Z]?)', header[f'TFORM{ii}'].strip()).groups()
+        repeat = int(repeat) if repeat else 1
+        if code in 'PQ':
+            columns.append((offset, '>i4' if code == 'P' else '>i8', TFORM_WIDTHS[element]))
+            offset += TFORM_WIDTHS[code]
+        elif code == 'X':
+            offset += -(-repeat // 8)
+        else:
+            offset += repeat * TFORM_WIDTHS[code]
+    return columns
+
+
+def fetch_frame_rows(url, rows, session=None):
+    """ Fetch the headers, the tile table, and the compressed tiles that hold some image rows of a tile compressed
+    FITS file with HTTP range requests.
+
+    :param url: URL of the .fits.fz file
+    :param rows: function of the compressed image header that returns the first and last 0-indexed image row needed
+    :param session: requests session to reuse connections, optional
+    :return: content of the file as bytes. Only the requested rows of the image are valid, the other tiles are left
+    empty. Files that are not compressed in tiles of full image rows are downloaded completely.
+    """
+    reader = RangeReader(url, session)
+    primary, offset = _read_header(reader, 0)
+    header, dataoffset = _read_header(reader, offset + _padded_data_size(primary))
+
+    if not header.get('ZIMAGE', False) or header.get('ZTILE1', header['ZNAXIS1']) != header['ZNAXIS1']:
+        log.info(f"{url} is not compressed in row tiles, fetching all of it")
+        reader.read(0, reader.size)
+    else:
+        rowbytes = header['NAXIS1']
+        table = reader.read(dataoffset, dataoffset + rowbytes * header['NAXIS2'])
+        heap = dataoffset + header.get('THEAP', rowbytes * header['NAXIS2'])
+        first, last = rows(header)
+        ztile2 = header.get('ZTILE2', 1)
+        spans = []
+        for tile in range(max(first, 0) // ztile2, min(last, header['ZNAXIS2'] - 1) // ztile2 + 1):
+            for columnoffset, dtype, elementsize in _descriptor_columns(header):
+                start = tile * rowbytes + columnoffset
+                count, heapoffset = np.frombuffer(table[start:start + 2 * np.dtype(dtype).itemsize], dtype=dtype)
+                if count > 0:
+                    spans.append((int(heapoffset), int(heapoffset + count * elementsize)))
+        if spans:
+            # tiles of neighbouring rows are next to each other in the heap; one request for all of them.
+            reader.read(heap + min(s[0] for s in spans), heap + max(s[1] for s in spans))
+    _count('download_bytes', reader.nbytes)
+    return bytes(reader.buffer)
+
+
+def fetch_frame_content(frameid, rows=None, session=None):
+    """
+    Download the content of a file from the LCO archive by frame id.
     :param frameid: Archive API frame ID
-    :return: Astropy HDUList
+    :param rows: if not None, a function of the compressed image header that returns the first and last image row
+    needed. Only these rows are fetched with HTTP range requests, see fetch_frame_rows.
+    :param session: requests session to reuse connections, optional
+    :return: file content as bytes
     """
-    url = f'https://archive-api.lco.global/frames/{frameid}'
+    session = session if session is not None else requests
+    url = f'{ARCHIVE_API_URL}/frames/{frameid}'
     log.info("Downloading image frameid {} from URL: {}".format(frameid, url))
     headers = {'Authorization': 'Token {}'.format(ARCHIVE_API_TOKEN)}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    response_dict = response.json()
+    with _timed('archive_lookup'):
+        response = session.get(url, headers=headers, timeout=ARCHIVE_REQUEST_TIMEOUT)
+        response.raise_for_status()
+        response_dict = response.json()
     if response_dict == {}:
         log.warning("No file url was returned from id query")
         raise Exception('Could not find file remotely.')
     frame_url = response_dict['url']
     log.debug(frame_url)
-    file_response = requests.get(frame_url)
-    file_response.raise_for_status()
-    f = fits.open(io.BytesIO(file_response.content))
-    return f
+    with _timed('archive_download'):
+        if rows is not None:
+            content = fetch_frame_rows(frame_url, rows, session)
+        else:
+            file_response = session.get(frame_url, timeout=ARCHIVE_REQUEST_TIMEOUT)
+            file_response.raise_for_status()
+            content = file_response.content
+            _count('download_bytes', len(content))
+    _count('downloads')
+    return content
+
+
+def download_from_archive(frameid, rows=None):
+    """
+    Download a file from the LCO archive by frame id.
+    :param frameid: Archive API frame ID
+    :param rows: see fetch_frame_content
+    :return: Astropy HDUList
+    """
+    from astropy.io import fits
+    return fits.open(io.BytesIO(fetch_frame_content(frameid, rows)))
+
+
+class _FrameFetcher:
+    """ Fetches frames in a pool of concurrency threads, one requests session per thread, and puts (frameid, content or
+    exception) into a results queue as they complete. The requests are blocking, so the pool size is the number of
+    transfers in flight. The results queue is bounded: a fetching thread waits for a free slot before it goes on with
+    the next frame, so memory stays bounded when the consumer falls behind.
+
+    started holds the start time of each transfer in flight, and frames in abandoned are not put into the results queue
+    anymore; both are shared with the consumer, and only used under lock.
+    """
+
+    def __init__(self, concurrency, rows, results):
+        self.rows = rows
+        self.results = results
+        self.lock = threading.Lock()
+        self.started = {}
+        self.abandoned = set()
+        self.stopped = threading.Event()
+        self.sessions = threading.local()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit(self, frameids):
+        for frameid in frameids:
+            self.executor.submit(self.fetch, frameid)
+
+    def fetch(self, frameid):
+        if self.stopped.is_set():
+            return
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+        with self.lock:
+            self.started[frameid] = time.monotonic()
+        try:
+            content = fetch_frame_content(frameid, rows=self.rows, session=self.sessions.session)
+        except Exception as e:
+            log.warning(f"Could not fetch frame {frameid}: {e}")
+            content = e
+        # the deadline is on the transfer, not on the wait for a free slot in the results queue
+        with self.lock:
+            self.started.pop(frameid, None)
+            if frameid in self.abandoned:
+                return
+        while not self.stopped.is_set():
+            try:
+                self.results.put((frameid, content), timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def first_started(self):
+        with self.lock:
+            return min(self.started.values(), default=None)
+
+    def abandon_overdue(self, deadline):
+        """ Give up on the transfers that started more than deadline seconds ago. Returns [(frameid, seconds)]."""
+        now = time.monotonic()
+        with self.lock:
+            overdue = [(frameid, now - start) for frameid, start in self.started.items() if now - start > deadline]
+            for frameid, seconds in overdue:
+                self.abandoned.add(frameid)
+                del self.started[frameid]
+        return overdue
+
+    def close(self, wait):
+        self.stopped.set()
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def iter_frames_from_archive(frameids, concurrency=16, rows=None, deadline=None):
+    """
+    Fetch many frames from the archive with up to concurrency transfers in flight, independent of the number of
+    processes that work on them.
+    :param frameids: list of Archive API frame IDs
+    :param concurrency: number of concurrent requests
+    :param rows: see fetch_frame_content
+    :param deadline: seconds a frame may take from the start of its transfer. A frame that takes longer is given up:
+    it is yielded with a TimeoutError, and its content is dropped if it still arrives. Its thread is held until the
+    request times out, see ARCHIVE_REQUEST_TIMEOUT.
+    :return: generator of (frameid, content), in order of completion. content is the file content as bytes, or the
+    exception if the frame could not be fetched.
+    """
+    frameids = list(frameids)
+    results = queue.Queue(maxsize=2 * concurrency)
+    fetcher = _FrameFetcher(concurrency, rows, results)
+    fetcher.submit(frameids)
+    remaining = len(frameids)
+    abandoned = False
+    try:
+        while remaining > 0:
+            _gauge('fetch_queue', results.qsize())
+            timeout = None
+            if deadline is not None:
+                first = fetcher.first_started()
+                timeout = deadline if first is None else max(first + deadline - time.monotonic(), 0.01)
+            try:
+                frameid, content = results.get(timeout=timeout)
+                remaining -= 1
+                yield frameid, content
+            except queue.Empty:
+                pass
+            if deadline is not None:
+                for frameid, seconds in fetcher.abandon_overdue(deadline):
+                    abandoned = True
+                    remaining -= 1
+                    _count('fetch_timeouts')
+                    log.warning(f"Giving up on frame {frameid} after {seconds:.1f} s")
+                    yield frameid, TimeoutError(f"Fetching frame {frameid} took more than {deadline} s")
+    finally:
+        # threads of abandoned transfers end when their request times out; do not wait for them.
+        fetcher.close(wait=not abandoned and remaining == 0)
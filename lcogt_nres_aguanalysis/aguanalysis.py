@@ -7,25 +7,116 @@ Datapoints are retrieved from a database and plotted. that is it.
 """
 import argparse
 import datetime
+import functools
 import io
+import json
 import logging
 import os
 import sys
 
-import boto3
-import matplotlib
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
 import numpy as np
 
 import lcogt_nres_aguanalysis.agupinholedb as agupinholedb
+from lcogt_nres_aguanalysis import aguflexure, agumetrics
 
-plt.style.use('ggplot')
 _logger = logging.getLogger(__name__)
 logging.getLogger('matplotlib').setLevel(logging.FATAL)
 
 available_cameras = ['ak05', 'ak06', 'ak15', 'ak16', 'ak17', 'ak18', 'ak19', 'ak20', 'ak21', 'ak22', 'ak23', 'ak24', 'ak25', 'ak26', 'ak27', 'ak28']
 
+@functools.lru_cache()
+def pyplot():
+    """ matplotlib.pyplot in the ggplot style. Imported at the first plot, so that loading the history and the
+        command line do not pay for matplotlib.
+    """
+    import matplotlib.pyplot as plt
+    plt.style.use('ggplot')
+    return plt
+
+
+RENDERMODES = ['full', 'decimated']
+# With the decimated render mode, the +-5 day running median under the alt / az plots is evaluated every 6 hours.
+MEDIAN_STEP = datetime.timedelta(hours=6)
+
+
+def decimate(x, y, markersize, xlim=None, ylim=None, ax=None):
+    """ Indices of the points to draw so that a scatter plot looks the same: one point per cell of half the marker
+        size on the axes in output pixels, i.e., the number of points drawn is bounded by the axes area and not by the
+        history length. xlim / ylim are the ranges the axes will show; points outside them are dropped. Without a
+        limit, the data range is used.
+    """
+    import matplotlib.dates as mdates
+    plt = pyplot()
+    ax = ax if ax is not None else plt.gca()
+    xv = np.asarray(mdates.date2num(x) if len(x) > 0 and not np.issubdtype(np.asarray(x).dtype, np.number) else x,
+                    dtype=float)
+    yv = np.asarray(y, dtype=float)
+    good = np.isfinite(xv) & np.isfinite(yv)
+    if not good.any():
+        return np.flatnonzero(good)
+
+    dpi = plt.rcParams['savefig.dpi']
+    dpi = ax.figure.dpi if dpi == 'figure' else dpi
+    extent = ax.get_window_extent()
+    cell = max(markersize * dpi / 72 / 2, 1)
+    nx = max(int(extent.width / ax.figure.dpi * dpi / cell), 1)
+    ny = max(int(extent.height / ax.figure.dpi * dpi / cell), 1)
+
+    limits = []
+    for values, limit in ((xv, xlim), (yv, ylim)):
+        if limit is None:
+            limit = (np.min(values[good]), np.max(values[good]))
+        elif not np.issubdtype(np.asarray(limit).dtype, np.number):
+            limit = mdates.date2num(limit)
+        limits.append((float(limit[0]), float(limit[1])))
+    (x0, x1), (y0, y1) = limits
+    good &= (xv >= x0) & (xv <= x1) & (yv >= y0) & (yv <= y1)
+    ix = np.clip(((xv - x0) / max(x1 - x0, 1e-12) * nx).astype(int), 0, nx - 1)
+    iy = np.clip(((yv - y0) / max(y1 - y0, 1e-12) * ny).astype(int), 0, ny - 1)
+    cells = np.where(good, ix * ny + iy, -1)
+    unique, first = np.unique(cells, return_index=True)
+    return np.sort(first[unique >= 0])
+
+
+def plotpoints(x, y, fmt, markersize, rendermode='full', xlim=None, ylim=None, **kwargs):
+    """ plt.plot of a scatter layer. With rendermode 'decimated', only the points that make a visible difference
+        are drawn, see decimate(), and the layer is rasterized.
+    """
+    plt = pyplot()
+    if rendermode == 'decimated':
+        keep = decimate(x, y, markersize, xlim=xlim, ylim=ylim)
+        agumetrics.count('plot_points_drawn', len(keep))
+        return plt.plot(np.asarray(x)[keep], np.asarray(y)[keep], fmt, markersize=markersize, rasterized=True,
+                        **kwargs)
+    agumetrics.count('plot_points_drawn', len(x))
+    return plt.plot(x, y, fmt, markersize=markersize, **kwargs)
+
+
+def running_median_residuals(dobs, values, window, usable, step=None):
+    """ values minus the median of the usable values within +- window around each point's time; dobs is sorted.
+        The window ends are found by bisection instead of a full mask per point.
+        With a step, e.g. 6 hours, the median is evaluated once per step at its center, and shared by the points in
+        it, so the cost follows the length of the history rather than the number of points.
+    """
+    dobs = np.asarray(dobs, dtype='datetime64[us]')
+    window = np.timedelta64(window)
+    if step is not None:
+        step = np.timedelta64(step).astype('timedelta64[us]')
+        cells, first = np.unique((dobs - dobs[0]) // step, return_index=True) if len(dobs) > 0 else ([], [])
+        centers = dobs[0] + np.asarray(cells, dtype=np.int64) * step + step // 2 if len(dobs) > 0 else dobs
+        owner = np.searchsorted(first, np.arange(len(dobs)), side='right') - 1
+    else:
+        centers = dobs
+        owner = np.arange(len(dobs))
+    low = np.searchsorted(dobs, centers - window, side='right')
+    high = np.searchsorted(dobs, centers + window, side='left')
+    medians = np.empty(len(centers))
+    for ii in range(len(centers)):
+        inwindow = values[low[ii]:high[ii]][usable[low[ii]:high[ii]]]
+        medians[ii] = np.median(inwindow) if len(inwindow) > 0 else np.nan
+    return values - medians[owner]
+
+
 def aws_enabled():
     '''Return True if AWS support is configured'''
     access_key = os.environ.get('AWS_ACCESS_KEY_ID', None)
@@ -37,8 +128,15 @@ def aws_enabled():
 
 
 def write_to_storage_backend(directory, filename, data, binary=True):
+    agumetrics.count('output_bytes', len(data))
+    with agumetrics.timed('storage_write'):
+        return _write_to_storage_backend(directory, filename, data, binary)
+
+
+def _write_to_storage_backend(directory, filename, data, binary=True):
     if aws_enabled():
         # AWS S3 Bucket upload
+        import boto3
         client = boto3.client('s3')
         bucket = os.environ.get('AWS_S3_BUCKET', None)
         try:
@@ -57,49 +155,155 @@ def write_to_storage_backend(directory, filename, data, binary=True):
             return True
 
 
+HISTORY_COLUMNS = ['imagename', 'instrument', 'telescopeidentifier', 'altitude', 'azimut', 'xcenter', 'ycenter',
+                   'dateobs', 'foctemp', 'crpix1', 'crpix2']
+
+
+def loadHistory(dbsession, criterion):
+    """ Pinhole measurements that match criterion, sorted by dateobs, as a dict of column arrays by HISTORY_COLUMNS.
+        Only the columns are queried, no ORM objects are built.
+    """
+    measurement = agupinholedb.PinholeMeasurement
+    with agumetrics.timed('db_load'):
+        resultset = dbsession.query(*[getattr(measurement, column) for column in HISTORY_COLUMNS]).filter(criterion)
+        # weed out vestigal bpl contamination. don't want that.
+        resultset = resultset.filter(~measurement.imagename.contains('bpl'))
+        rows = resultset.order_by(measurement.dateobs).all()
+    agumetrics.count('db_rows', len(rows))
+    return _history_columns(rows)
+
+
+def _history_columns(rows):
+    values = list(zip(*rows)) if len(rows) > 0 else [[]] * len(HISTORY_COLUMNS)
+    history = {}
+    for column, value in zip(HISTORY_COLUMNS, values):
+        if column in ('xcenter', 'ycenter'):
+            history[column] = np.asarray(value, dtype=np.float32)
+        elif column in ('altitude', 'azimut', 'foctemp', 'crpix1', 'crpix2'):
+            history[column] = np.asarray(value, dtype=float)
+        else:
+            history[column] = np.asarray(value)
+    return history
+
+
 def readPinHoles(cameraname, sql):
     dbsession = agupinholedb.get_session(sql)
+    _logger.debug (f"Working on {cameraname}")
+    try:
+        h = loadHistory(dbsession, agupinholedb.PinholeMeasurement.instrument == cameraname)
+    finally:
+        dbsession.close()
+    return pinholeColumns(h)
 
-    images = []
-    alt = []
-    az = []
-    xs = []
-    ys = []
-    dobs = []
-    foctemps = []
-    crpix1 = []
-    crpix2 = []
 
-    _logger.debug (f"Working on {cameraname}")
-    resultset = dbsession.query(agupinholedb.PinholeMeasurement)
-    resultset = resultset.filter(agupinholedb.PinholeMeasurement.instrument == cameraname)
-    # weed out vestigal bpl contamination. don't want that.
-    resultset = resultset.filter(~agupinholedb.PinholeMeasurement.imagename.contains('bpl'))
-    resultset = resultset.order_by (agupinholedb.PinholeMeasurement.dateobs)
-    for result in resultset:
-        images.append(result.imagename)
-        alt.append(result.altitude)
-        az.append(result.azimut)
-        xs.append(result.xcenter)
-        ys.append(result.ycenter)
-        dobs.append(result.dateobs)
-        foctemps.append(result.foctemp)
-        crpix1.append (result.crpix1)
-        crpix2.append (result.crpix2)
-
-    return images, np.asarray(alt), np.asarray(az), \
-           np.asarray(xs, dtype=np.float32), \
-           np.asarray(ys, dtype=np.float32), \
-           np.asarray(dobs), np.asanyarray(foctemps), \
-           np.asarray (crpix1), np.asarray(crpix2)
-    dbsession.close()
+def pinholeColumns(h):
+    """ The columns of a camera history in the order readPinHoles returns them."""
+    return list(h['imagename']), h['altitude'], h['azimut'], h['xcenter'], h['ycenter'], h['dateobs'], \
+        h['foctemp'], h['crpix1'], h['crpix2']
+
+
+class TelescopeHistory:
+    """ Pinhole history of all cameras that were mounted on one telescope, sorted by dateobs.
+
+    The measurements are split into segments: runs of consecutive measurements by the same camera. A new segment
+    starts wherever the instrument changes, i.e., at a camera swap.
+    """
+
+    def __init__(self, telescopeidentifier, columns):
+        self.telescopeidentifier = telescopeidentifier
+        self.columns = columns
+        instrument = columns['instrument']
+        boundaries = list(np.flatnonzero(instrument[1:] != instrument[:-1]) + 1)
+        starts = [0] + boundaries
+        stops = boundaries + [len(instrument)]
+        self.segments = [(str(instrument[start]), start, stop)
+                         for start, stop in zip(starts, stops)] if len(instrument) > 0 else []
+
+    def __len__(self):
+        return len(self.columns['instrument'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    @property
+    def cameras(self):
+        """ Cameras in order of their first measurement on this telescope."""
+        return list(dict.fromkeys(camera for camera, start, stop in self.segments))
+
+    @property
+    def swaps(self):
+        """ dateobs of the first measurement after each camera swap."""
+        return [self.columns['dateobs'][start] for camera, start, stop in self.segments[1:]]
+
+    def camera(self, camera):
+        """ All columns of one camera, over all of its segments."""
+        index = self.columns['instrument'] == camera
+        return {column: values[index] for column, values in self.columns.items()}
+
+
+def readTelescopeHistory(telescopeidentifier, sql=None, dbsession=None):
+    """ History of all cameras of a telescope, e.g., lsc-domb-1m0a, in one query on the telescopeidentifier index.
+        Pass an open dbsession to reuse it, or the database url in sql.
+    """
+    session = dbsession if dbsession is not None else agupinholedb.get_session(sql)
+    try:
+        columns = loadHistory(session, agupinholedb.PinholeMeasurement.telescopeidentifier == telescopeidentifier)
+    finally:
+        if dbsession is None:
+            session.close()
+    return TelescopeHistory(telescopeidentifier, columns)
+
+
+def listTelescopes(dbsession, cameras=None):
+    """ Telescopes in the database, or only those that any of cameras was on."""
+    measurement = agupinholedb.PinholeMeasurement
+    q = dbsession.query(measurement.telescopeidentifier).distinct()
+    if cameras is not None:
+        q = q.filter(measurement.instrument.in_(cameras))
+    return sorted(r[0] for r in q if r[0] is not None)
+
+
+def readCameraHistories(dbsession, cameras, telescopes=None):
+    """ History of each of cameras, a dict camera -> columns as from loadHistory, assembled from the histories of the
+        telescopes the cameras were on, so all cameras of a telescope come in with one query. Measurements without a
+        telescopeidentifier come in with one more query. Pass the TelescopeHistory of telescopes already loaded, a dict
+        telescopeidentifier -> TelescopeHistory, to reuse them; the ones loaded here are added to it.
+    """
+    telescopes = telescopes if telescopes is not None else {}
+    for telescope in listTelescopes(dbsession, cameras):
+        if telescope not in telescopes:
+            telescopes[telescope] = readTelescopeHistory(telescope, dbsession=dbsession)
+    measurement = agupinholedb.PinholeMeasurement
+    unassigned = TelescopeHistory(None, loadHistory(dbsession, measurement.telescopeidentifier.is_(None) &
+                                                    measurement.instrument.in_(cameras)))
+    parts = {camera: [] for camera in cameras}
+    for history in list(telescopes.values()) + [unassigned]:
+        for camera in history.cameras:
+            if camera in parts:
+                parts[camera].append(history.camera(camera))
+    histories = {}
+    for camera, camerahistories in parts.items():
+        if len(camerahistories) == 0:
+            histories[camera] = _history_columns([])
+            continue
+        columns = {column: np.concatenate([h[column] for h in camerahistories]) for column in HISTORY_COLUMNS}
+        # a camera that moved between telescopes: merge its histories by dateobs again
+        order = np.argsort(columns['dateobs'], kind='stable')
+        histories[camera] = {column: values[order] for column, values in columns.items()}
+    return histories
+
+
+def daterange():
+    """ Time range of the history plots."""
+    return datetime.datetime(2017, 1, 1), datetime.datetime.now() + datetime.timedelta(days=14)
 
 
 def dateformat():
     """ Utility to prettify a plot with dates.
     """
-    starttime = datetime.datetime(2017, 1, 1)
-    endtime = datetime.datetime.now() + datetime.timedelta(days=14)
+    import matplotlib.dates as mdates
+    plt = pyplot()
+    starttime, endtime = daterange()
     plt.xlim([starttime, endtime])
     plt.gcf().autofmt_xdate()
     years = mdates.YearLocator()  # every year
@@ -135,13 +339,124 @@ def findrecentPinhole(dobs, xs, ys):
         return None, None
 
 
-def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', outputpath='.'):
-    plt.style.use('ggplot')
+def plottelescopehistory(history, outputpath='.', title=None, starttime=None, endtime=None, cameras=None,
+                         rendermode='full', filename=None):
+    """ Pinhole location of all cameras of a telescope vs time, each camera relative to its own median location,
+        with the assumed location from CRPIX, and camera swaps marked.
+        Written to filename in outputpath, by default longterm_telescope_<telescope>.png. Returns the file name.
+    """
+    plt = pyplot()
+    title = title if title is not None else history.telescopeidentifier
+    xlim = (starttime if starttime is not None else daterange()[0], endtime if endtime is not None else daterange()[1])
+    plt.figure()
+    for camera in (cameras if cameras is not None else history.cameras):
+        data = history.camera(camera)
+        xs = data['xcenter']
+        ys = data['ycenter']
+        dobs = data['dateobs']
+        index = (np.isfinite(xs)) & np.isfinite(ys) & (xs != 0)
+        if not index.any():
+            continue
+        crpix1 = data['crpix1']
+        crpix2 = data['crpix2']
+        for subplot, values, crpix, label in ((211, xs, crpix1, 'X'), (212, ys, crpix2, 'Y')):
+            plt.subplot(subplot, label=f"center{label}")
+            plotpoints(dobs[index], values[index] - np.nanmedian(values[index]), '.', 1, rendermode,
+                       xlim=xlim, ylim=(-15, 15), label=camera)
+            if (crpix > 0).any():
+                line = index.copy()
+                if rendermode == 'decimated':
+                    # the assumed location is piecewise constant; its corners are enough to draw it.
+                    corners = np.flatnonzero(index)
+                    steps = np.flatnonzero(np.diff(crpix[corners]) != 0)
+                    line[:] = False
+                    line[corners[np.unique(np.concatenate([[0, len(corners) - 1], steps, steps + 1]))]] = True
+                plt.plot(dobs[line], crpix[line] - np.median(crpix[crpix > 0]), '-', color='orange',
+                         label='Assumed location')
+    for subplot, label in ((211, 'X'), (212, 'Y')):
+        plt.subplot(subplot, label=f"center{label}")
+        for swap in history.swaps:
+            plt.axvline(swap, color='grey', linewidth=0.5)
+        plt.ylim([-15, 15])
+        plt.ylabel(f"rel. center {label}")
+        dateformat()
+        if starttime is not None:
+            plt.xlim([starttime, endtime])
+    plt.subplot(211, label="centerX")
+    plt.title(f"Pinhole location in focus images {title}")
+    plt.tight_layout()
+
+    with io.BytesIO() as fileobj:
+        if filename is None:
+            filename = f'longterm_telescope_{history.telescopeidentifier}.png'
+        with agumetrics.timed('plot_render'):
+            plt.savefig(fileobj, format='png', dpi=300)
+        plt.close()
+        write_to_storage_backend(outputpath, filename, fileobj.getvalue())
+    return filename
+
+
+def plotflexuremodel(model, alts, az, foctemps, dobs, xraw, yraw, outputpath='.', rendermode='full'):
+    """ Measured vs. model pinhole location of a camera, both without the model's monthly offsets, and the model
+        coefficients as json next to the plots.
+    """
+    plt = pyplot()
+    months = np.char.replace(np.asarray(dobs, dtype='datetime64[M]').astype(str), '-', '')
+    offsets = np.asarray([model.offsets.get(month, (np.nan, np.nan)) for month in months]).reshape(-1, 2)
+    px, py = model.predict(alts, az, foctemps, months)
+
+    plt.figure()
+    for column, measured, predicted, label in ((0, xraw, px, 'x'), (1, yraw, py, 'y')):
+        offset = offsets[:, column]
+        rms = model.rms[column]
+        plt.subplot(121 + column)
+        lim = np.nanmax(np.abs(predicted - offset)) + 3 * rms if len(predicted) > 0 else 1
+        plotpoints(predicted - offset, measured - offset, '.', 2, rendermode, xlim=(-lim, lim), ylim=(-lim, lim))
+        plt.plot([-lim, lim], [-lim, lim], '-', color='grey', linewidth=0.5)
+        plt.xlim([-lim, lim])
+        plt.ylim([-lim, lim])
+        plt.xlabel(f"model {label} flexure [pixel]")
+        plt.ylabel(f"measured {label} - monthly offset")
+        plt.title(f"{model.instrument} {label}: rms {rms:.2f} pixel")
+        text = "\n".join(f"{feature}: {model.coefficients[feature][column]:+.3f} "
+                         f"+- {model.uncertainties[feature][column]:.3f}" for feature in aguflexure.FEATURES)
+        plt.gca().text(0.03, 0.97, text, transform=plt.gca().transAxes, va='top', fontsize=6)
+    plt.gcf().set_size_inches(12, 6)
+    plt.tight_layout()
+
+    with io.BytesIO() as fileobj:
+        filename = f'flexuremodel_pinhole_{model.instrument}.png'
+        with agumetrics.timed('plot_render'):
+            plt.savefig(fileobj, format='png', bbox_inches='tight')
+        plt.close()
+        write_to_storage_backend(outputpath, filename, fileobj.getvalue())
+    write_to_storage_backend(outputpath, f'flexuremodel_{model.instrument}.json',
+                             json.dumps(model.to_dict(), indent=1).encode())
+
+
+def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', outputpath='.', rendermode='full',
+                  history=None, dbsession=None):
+    """ History and flexure plots of a camera. history are the camera's columns from readCameraHistories; without,
+        they are read from the database. Pass an open dbsession to reuse it, or the database url in sql.
+    """
+    import matplotlib
+    plt = pyplot()
     matplotlib.rcParams['savefig.dpi'] = 300
     matplotlib.rcParams['figure.figsize'] = (8.0,6.0)
 
-    images, alts, az, xraw, yraw, dobs, foctemps, crpix1, crpix2 = readPinHoles(camera, sql)
+    session = dbsession if dbsession is not None else agupinholedb.get_session(sql)
+    try:
+        if history is None:
+            history = loadHistory(session, agupinholedb.PinholeMeasurement.instrument == camera)
+        # the model comes from the stored statistics, not from these points
+        with agumetrics.timed('flexure_fit'):
+            model = aguflexure.fit_camera(session, camera)
+    finally:
+        if dbsession is None:
+            session.close()
+    images, alts, az, xraw, yraw, dobs, foctemps, crpix1, crpix2 = pinholeColumns(history)
     _logger.info("Found {} entries".format(len(images)))
+    _logger.info(f"Flexure model: {model}")
     # Sort out bad values
     index = (np.isfinite(xraw)) & np.isfinite(yraw) & (xraw != 0)  # & (alts>89)
     xraw = xraw[index]
@@ -152,6 +467,9 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     crpix2 = crpix2[index]
     foctemps = foctemps[index]
     az = az[index]
+    if rendermode == 'decimated':
+        # vectorized date conversions from here on, instead of one datetime object at a time
+        dobs = np.asarray(dobs, dtype='datetime64[us]')
 
     # Median-correct to we have a nice homogeneous plotting range between camera adjustments.
     xraw_median = np.nanmedian(xraw)
@@ -160,8 +478,6 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     ys = yraw - yraw_median
 
     timewindow = datetime.timedelta(days=5)
-    filteredy = ys * 0
-    filteredx = xs * 0
     smallnumber = (np.abs(ys) < 15) & (np.abs(xs) < 15)
     recent_x, recent_y = findrecentPinhole(dobs, xraw,yraw)
     recent_crpix1 = crpix1[-1] if len (crpix1) > 0 else 0
@@ -171,7 +487,7 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     index = (np.isfinite(xs)) & np.isfinite(ys) & (xs != 0)  # & (alts>89)
     # print("Min {} Max {} ".format(dobs[index].min(), dobs[index].max()))
     plt.subplot(211)
-    plt.plot(dobs, xs, '.', label="pinhole x",  markersize=1)
+    plotpoints(dobs, xs, '.', 1, rendermode, xlim=daterange(), ylim=(-15, 15), label="pinhole x")
     if recent_x:
         plt.plot (dobs[-1], recent_x -xraw_median, 'o', color='green')
     else:
@@ -181,7 +497,7 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     dateformat()
 
     plt.subplot(212)
-    plt.plot(dobs, ys, '.', label="pinhole y",  markersize=1)
+    plotpoints(dobs, ys, '.', 1, rendermode, xlim=daterange(), ylim=(-15, 15), label="pinhole y")
     if recent_y:
         plt.plot (dobs[-1], recent_y -yraw_median, 'o', color='green')
     else:
@@ -196,38 +512,38 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     with io.BytesIO() as fileobj:
         filename = f'longtermtrend_pinhole_{camera}.png'
         plt.gcf().set_size_inches(12,6)
-        plt.savefig(fileobj, format='png', bbox_inches='tight')
+        with agumetrics.timed('plot_render'):
+            plt.savefig(fileobj, format='png', bbox_inches='tight')
         plt.close()
         write_to_storage_backend(outputpath, filename, fileobj.getvalue())
 
     plt.figure()
 
-    for ii in range(len(dobs)):
-        filteredy[ii] = ys[ii] - np.median(
-            ys[(dobs > dobs[ii] - timewindow) & (dobs < dobs[ii] + timewindow) & (smallnumber)])
-        filteredx[ii] = xs[ii] - np.median(
-            xs[(dobs > dobs[ii] - timewindow) & (dobs < dobs[ii] + timewindow) & (smallnumber)])
+    with agumetrics.timed('running_median'):
+        step = MEDIAN_STEP if rendermode == 'decimated' else None
+        filteredy = running_median_residuals(dobs, ys, timewindow, smallnumber, step)
+        filteredx = running_median_residuals(dobs, xs, timewindow, smallnumber, step)
 
     plt.subplot(221)
-    plt.plot(alts, filteredy - np.nanmedian(filteredy), '.', label="pinhole y",  markersize=2)
+    plotpoints(alts, filteredy - np.nanmedian(filteredy), '.', 2, rendermode, ylim=(-15, 15), label="pinhole y")
     plt.legend()
     plt.ylim([-15, 15])
     plt.xlabel('ALT')
 
     plt.subplot(222)
-    plt.plot(az, filteredy - np.nanmedian(filteredy), '.', label="pinhole y",  markersize=2)
+    plotpoints(az, filteredy - np.nanmedian(filteredy), '.', 2, rendermode, ylim=(-15, 15), label="pinhole y")
     plt.ylim([-15, 15])
     plt.legend()
     plt.xlabel('AZ')
 
     plt.subplot(223)
-    plt.plot(alts, filteredx - np.nanmedian(filteredx), '.', label="pinhole x",  markersize=2)
+    plotpoints(alts, filteredx - np.nanmedian(filteredx), '.', 2, rendermode, ylim=(-15, 15), label="pinhole x")
     plt.ylim([-15, 15])
     plt.legend()
     plt.xlabel('ALT')
 
     plt.subplot(224)
-    plt.plot(az, filteredx - np.nanmedian(filteredx), '.', label="pinhole x",  markersize=2)
+    plotpoints(az, filteredx - np.nanmedian(filteredx), '.', 2, rendermode, ylim=(-15, 15), label="pinhole x")
     plt.ylim([-15, 15])
     plt.legend()
     plt.xlabel('AZ')
@@ -235,7 +551,8 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     plt.tight_layout()
     with io.BytesIO() as fileobj:
         filename = f'altaztrends_pinhole_{camera}.png'
-        plt.savefig(fileobj, format='png', bbox_inches='tight')
+        with agumetrics.timed('plot_render'):
+            plt.savefig(fileobj, format='png', bbox_inches='tight')
         plt.close()
         write_to_storage_backend(outputpath, filename, fileobj.getvalue())
 
@@ -243,7 +560,7 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     plt.subplot(211)
     plt.title("%s pinhole location in focus images " % (camera))
 
-    plt.plot(foctemps, xs, ".", label="pinhole x",  markersize=2)
+    plotpoints(foctemps, xs, ".", 2, rendermode, xlim=(-10, 35), ylim=(-15, 15), label="pinhole x")
     plt.ylabel("x-position")
     plt.xlabel("WMS temp [\deg C]")
     plt.ylim([-15, 15])
@@ -252,7 +569,7 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
     plt.subplot(212)
     plt.title("%s pinhole location in focus images " % (camera))
 
-    plt.plot(foctemps, ys, ".", label="pinhole x",  markersize=2)
+    plotpoints(foctemps, ys, ".", 2, rendermode, xlim=(-10, 35), ylim=(-15, 15), label="pinhole x")
     plt.ylim([-15, 15])
     plt.xlim([-10, 35])
     plt.ylabel("x-position")
@@ -260,10 +577,16 @@ def plotagutrends(camera='ak01', sql='sqlite:///agupinholelocations.sqlite', out
 
     with io.BytesIO() as fileobj:
         filename = f'foctemp_pinhole_{camera}.png'
-        plt.savefig(fileobj, format='png', bbox_inches='tight')
+        with agumetrics.timed('plot_render'):
+            plt.savefig(fileobj, format='png', bbox_inches='tight')
         plt.close()
         write_to_storage_backend(outputpath, filename, fileobj.getvalue())
 
+    if model is not None:
+        usable = np.isfinite(alts) & np.isfinite(az) & np.isfinite(foctemps)
+        plotflexuremodel(model, alts[usable], az[usable], foctemps[usable], dobs[usable], xraw[usable], yraw[usable],
+                         outputpath, rendermode)
+
 
 def parseCommandLine():
     """ Read command line parameters
@@ -278,6 +601,16 @@ def parseCommandLine():
     parser.add_argument('--ncpu', default=1, type=int)
     parser.add_argument('--outputpath', default="aguhistory", help="Root directory for output")
     parser.add_argument('--camera',  choices=available_cameras, help='only process single selected camera')
+    parser.add_argument('--pertelescope', action='store_true',
+                        help='Also plot the history of all cameras per telescope, with camera swaps')
+    parser.add_argument('--rendermode', default='full', choices=RENDERMODES,
+                        help='decimated: draw at most one marker per marker sized cell of each plot, rasterized, so '
+                             'the plot time does not grow with the history')
+    parser.add_argument('--rebuildflexure', action='store_true',
+                        help='Recompute the flexure model statistics from all measurements first, e.g., for a database '
+                             'that predates them')
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help='Write run metrics to this file at the end; json, or Prometheus textfile if it ends in .prom')
 
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.log_level.upper()),
@@ -285,7 +618,7 @@ def parseCommandLine():
     return args
 
 
-def renderHTMLPage(args, cameras):
+def renderHTMLPage(args, cameras, telescopes=()):
     if aws_enabled():
         _logger.info("Since we are working in the context of a AWS bucket, no local index.html is generated here")
         return
@@ -298,6 +631,11 @@ def renderHTMLPage(args, cameras):
 <body><title>LCO NRES AGU Pinhole Location Plots</title>
 """
     message += "<p/>Figures updated %s UTC <p/>\n" % (datetime.datetime.utcnow())
+    if len(telescopes) > 0:
+        message += "<h1> History by Telescope: </h1>\n"
+    for telescope in telescopes:
+        historyname = f'longterm_telescope_{telescope}.png'
+        message += f' <h2> {telescope} </h2>\n<a href="{historyname}"><img src="{historyname}" height="500"/></a><br/>\n'
     message += """
 <h1> Details by Camera: </h1>
 """
@@ -308,9 +646,13 @@ def renderHTMLPage(args, cameras):
         historyname = 'longtermtrend_pinhole_{}.png'.format(camera)
         altazfile = 'altaztrends_pinhole_{}.png'.format(camera)
         tempfilename = 'foctemp_pinhole_{}.png'.format(camera)
+        flexurefile = 'flexuremodel_pinhole_{}.png'.format(camera)
         line = f'<a href="{historyname}"><img src="{historyname}" height="500"/></a>  ' \
                f'<a href="{altazfile}"><img src="{altazfile}" height="500"/></a> ' \
-               f'<a href="{tempfilename}"><img src="{tempfilename}" height="500"/></a><br/>  '
+               f'<a href="{tempfilename}"><img src="{tempfilename}" height="500"/></a>'
+        if os.path.exists(os.path.join(args.outputpath, flexurefile)):
+            line += f' <a href="{flexurefile}"><img src="{flexurefile}" height="500"/></a>'
+        line += '<br/>  '
         message = message + line
 
     message = message + "</body></html>"
@@ -324,11 +666,33 @@ def main():
     args = parseCommandLine()
     cameras = available_cameras if args.camera is None else [args.camera, ]
 
+    dbsession = agupinholedb.get_session(args.database)
+    if args.rebuildflexure:
+        aguflexure.rebuild_statistics(dbsession, instruments=None if args.camera is None else cameras)
+
+    # one session, and one query per telescope for all its cameras; the per telescope plots reuse the histories.
+    telescopehistories = {}
+    histories = readCameraHistories(dbsession, cameras, telescopehistories)
     for camera in cameras:
-        plotagutrends(camera, outputpath=args.outputpath, sql=args.database)
+        with agumetrics.timed('camera'):
+            plotagutrends(camera, outputpath=args.outputpath, sql=args.database, rendermode=args.rendermode,
+                          history=histories[camera], dbsession=dbsession)
         #findrecentPinhole(camera, sql=args.database)
         pass
-    renderHTMLPage(args, cameras)
+    telescopes = []
+    if args.pertelescope:
+        telescopes = listTelescopes(dbsession)
+        for telescope in telescopes:
+            with agumetrics.timed('telescope'):
+                history = telescopehistories.get(telescope)
+                if history is None:
+                    history = readTelescopeHistory(telescope, dbsession=dbsession)
+                plottelescopehistory(history, outputpath=args.outputpath, rendermode=args.rendermode)
+    dbsession.close()
+    renderHTMLPage(args, cameras, telescopes)
+    _logger.debug(f"Database connections: {agupinholedb.connection_stats()}")
+    if args.metrics_file is not None:
+        agumetrics.metrics.write(args.metrics_file, prefix='aguanalysis')
     sys.exit(0)
 
 
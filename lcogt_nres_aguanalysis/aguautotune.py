@@ -0,0 +1,176 @@
+"""
+Worker and download concurrency of agupinholesearch --ncpu auto.
+
+How many worker processes keep the CPUs busy depends on how long a frame waits for I/O: in AWS mode a worker that
+downloads its own frame mostly waits, on a local disk or with the frames fetched in the main process it mostly
+computes. The tuner measures this instead of relying on a fixed --ncpu:
+
+  - every task records its wall time ('frame') and its CPU time ('frame_cpu'), every download its time
+    ('archive_lookup', 'archive_download') and size, in agumetrics.
+  - during the warm-up, the first WARMUP_TASKS frames, there is one worker per CPU of the cgroup limit, and in AWS
+    mode the frames are downloaded in the main process with FETCH_PER_WORKER transfers in flight per worker.
+  - after the warm-up, and again every RETUNE_TASKS frames, from the measurements since the last decision:
+
+        workers = round(cpus * wall / cpu)          enough workers to keep the CPUs busy
+        fetch = ceil(workers * download / wall)     downloads in flight to keep the workers fed
+
+    both scaled down to what fits into the cgroup memory limit, for the measured peak RSS of a worker and the mean
+    frame size.
+
+The pool is sized per batch, i.e., per camera and night, or per claim from the work queue. Every decision is logged with
+the measurements behind it.
+
+"""
+import collections
+import logging
+import math
+import os
+import resource
+
+from lcogt_nres_aguanalysis import agumetrics
+
+log = logging.getLogger(__name__)
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+WARMUP_TASKS = 20
+RETUNE_TASKS = 200
+FETCH_PER_WORKER = 4
+MAX_WORKERS_PER_CPU = 8
+MIN_FETCH = 2
+MAX_FETCH = 64
+# Use at most this part of the memory limit, the rest is for the main process and the page cache.
+MEMORY_FRACTION = 0.8
+# until measured: peak RSS of a worker with the pipeline modules loaded, and the size of a frame
+WORKER_BYTES = 300 * 1024 * 1024
+FRAME_BYTES = 1600 * 1024
+# a download in flight holds its frame while it arrives, in the results queue, and in a ring slot
+FRAMES_PER_FETCH = 3
+
+Plan = collections.namedtuple('Plan', ['workers', 'fetchconcurrency', 'reason'])
+
+
+def _read(filename):
+    try:
+        with open(filename) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_limits(root=CGROUP_ROOT):
+    """ CPUs and memory bytes this process may use: the cgroup v2 or v1 limits, and the CPU affinity.
+        memory is None without a limit.
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    memory = None
+    cpumax = _read(os.path.join(root, 'cpu.max'))
+    if cpumax is not None:
+        quota, period = cpumax.split()
+        if quota != 'max':
+            cpus = min(cpus, int(quota) / int(period))
+        memorymax = _read(os.path.join(root, 'memory.max'))
+        if memorymax not in (None, 'max'):
+            memory = int(memorymax)
+    else:
+        quota = _read(os.path.join(root, 'cpu', 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(root, 'cpu', 'cpu.cfs_period_us'))
+        if quota is not None and period is not None and int(quota) > 0:
+            cpus = min(cpus, int(quota) / int(period))
+        memorymax = _read(os.path.join(root, 'memory', 'memory.limit_in_bytes'))
+        # no limit is a number close to 2^63
+        if memorymax is not None and int(memorymax) < 2 ** 60:
+            memory = int(memorymax)
+    return cpus, memory
+
+
+def plan(cpus, memory, wall, cpu, download=0., fetch=False, workerbytes=WORKER_BYTES, framebytes=FRAME_BYTES,
+         reservedbytes=0):
+    """ Workers and downloads in flight for frames that take wall seconds in a worker, of which cpu seconds on the CPU,
+        and download seconds to fetch in the main process if fetch is set. Returns a Plan.
+    """
+    iofactor = max(wall / max(cpu, 1e-6), 1.)
+    workers = min(max(1, round(cpus * iofactor)), MAX_WORKERS_PER_CPU * max(1, math.ceil(cpus)))
+    fetchconcurrency = min(max(MIN_FETCH, math.ceil(workers * download / max(wall, 1e-6))), MAX_FETCH) if fetch else 0
+    reason = f"{wall:.3f} s wall, {cpu:.3f} s cpu" + (f", {download:.3f} s download" if fetch else "") + \
+             f" per frame on {cpus:g} cpus"
+    if memory is not None:
+        budget = MEMORY_FRACTION * memory - reservedbytes
+        needed = workers * (workerbytes + 2 * framebytes) + fetchconcurrency * FRAMES_PER_FETCH * framebytes
+        if needed > budget:
+            scale = max(budget, 0) / needed
+            workers = max(1, int(workers * scale))
+            fetchconcurrency = max(MIN_FETCH, int(fetchconcurrency * scale)) if fetch else 0
+            reason += f", limited by {memory / 2 ** 20:.0f} MB memory"
+    return Plan(workers, fetchconcurrency, reason)
+
+
+class WorkerTuner:
+    """ Sizes the pool of each batch of agupinholesearch from the metrics of the batches before.
+        fetch: also size the downloads in the main process, args.fetchconcurrency.
+    """
+
+    def __init__(self, fetch=False, cpus=None, memory=None, warmup=WARMUP_TASKS, interval=RETUNE_TASKS,
+                 metrics=None):
+        limitcpus, limitmemory = cgroup_limits()
+        self.cpus = cpus if cpus is not None else limitcpus
+        self.memory = memory if memory is not None else limitmemory
+        self.fetch = fetch
+        self.warmup = warmup
+        self.interval = interval
+        self.metrics = metrics if metrics is not None else agumetrics.metrics
+        workers = max(1, math.ceil(self.cpus))
+        self.current = Plan(workers, FETCH_PER_WORKER * workers if fetch else 0, 'warm-up')
+        self.decisions = 0
+        self.mark = self._totals()
+        log.info(f"Auto tuning within {self.cpus:g} cpus and "
+                 f"{'no memory limit' if self.memory is None else f'{self.memory / 2 ** 20:.0f} MB'}; warm-up with "
+                 f"{self.current.workers} workers" +
+                 (f" and {self.current.fetchconcurrency} downloads in flight" if fetch else ""))
+
+    def _totals(self):
+        totals = {}
+        for name in ['frame', 'frame_cpu', 'archive_lookup', 'archive_download']:
+            h = self.metrics.histograms.get(name)
+            totals[name] = (h.count, h.sum) if h is not None else (0, 0.)
+        for name in ['downloads', 'download_bytes']:
+            totals[name] = self.metrics.counters.get(name, 0)
+        return totals
+
+    def _decide(self, totals):
+        def delta(name):
+            return totals[name][0] - self.mark[name][0], totals[name][1] - self.mark[name][1]
+
+        nframes, wall = delta('frame')
+        cpu = delta('frame_cpu')[1]
+        downloads = totals['downloads'] - self.mark['downloads']
+        download = (delta('archive_lookup')[1] + delta('archive_download')[1]) / downloads if downloads > 0 else 0.
+        framebytes = (totals['download_bytes'] - self.mark['download_bytes']) / downloads if downloads > 0 \
+            else FRAME_BYTES
+        # peak RSS of the workers of the earlier batches, in kB on Linux
+        workerbytes = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024 or WORKER_BYTES
+        reservedbytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        return plan(self.cpus, self.memory, wall / nframes, cpu / nframes, download, self.fetch, workerbytes,
+                    framebytes, reservedbytes)
+
+    def tune(self, args):
+        """ Set args.ncpu, and with fetch args.fetchconcurrency, for the next batch. Returns the current Plan."""
+        totals = self._totals()
+        if totals['frame'][0] - self.mark['frame'][0] >= (self.interval if self.decisions > 0 else self.warmup):
+            new = self._decide(totals)
+            if (new.workers, new.fetchconcurrency) != (self.current.workers, self.current.fetchconcurrency):
+                log.info(f"Auto tuning: {self.current.workers} -> {new.workers} workers" +
+                         (f", {self.current.fetchconcurrency} -> {new.fetchconcurrency} downloads in flight"
+                          if self.fetch else "") + f" for {new.reason}")
+            else:
+                log.info(f"Auto tuning: keeping {new.workers} workers" +
+                         (f" and {new.fetchconcurrency} downloads in flight" if self.fetch else "") +
+                         f" for {new.reason}")
+            self.current = new
+            self.mark = totals
+            self.decisions += 1
+        args.ncpu = self.current.workers
+        if self.fetch:
+            args.fetchconcurrency = self.current.fetchconcurrency
+        self.metrics.gauge('auto_workers', self.current.workers)
+        return self.current
@@ -0,0 +1,448 @@
+"""
+Benchmark the pinhole pipeline stage by stage.
+
+Every stage of agupinholesearch.findPinhole is timed on its own, by its agumetrics timers, on the frames bundled in
+testing/testdata and on a larger set of synthetic frames from agusynthetic, followed by the database write and the
+aguanalysis load and plot. Everything runs offline against a temporary sqlite database. Results go into a json file that can be compared against the file
+of an earlier commit with --compare.
+
+--startup only measures the start up time of the console script modules, and which of their imports it goes to.
+
+"""
+import argparse
+import datetime
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+TESTDATADIR = os.path.join(os.path.dirname(__file__), '..', 'testing', 'testdata')
+
+PIPELINE_STAGES = ['open', 'decompress', 'hotpixel', 'background', 'normalize', 'correlate', 'centroid']
+
+ENTRY_POINT_MODULES = ['lcogt_nres_aguanalysis.agupinholesearch', 'lcogt_nres_aguanalysis.aguanalysis',
+                       'lcogt_nres_aguanalysis.agubenchmark', 'lcogt_nres_aguanalysis.agusynthetic']
+
+
+class StageTimer:
+    """ Collects wall clock durations per stage name."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def time(self, stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        self.add(stage, time.perf_counter() - start)
+        return result
+
+    def add(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        summary = {}
+        for stage, samples in self.samples.items():
+            samples = np.asarray(samples)
+            summary[stage] = {'n': len(samples),
+                              'total': float(np.sum(samples)),
+                              'mean': float(np.mean(samples)),
+                              'median': float(np.median(samples)),
+                              'min': float(np.min(samples)),
+                              'p95': float(np.percentile(samples, 95)),
+                              'max': float(np.max(samples)), }
+        return summary
+
+
+def time_findpinhole_stages(imagename, timer):
+    """ Run findPinhole on one frame from disk, and record the time of each stage from its agumetrics timers.
+        Returns a PinholeMeasurement, or None if the frame was rejected.
+    """
+    import lcogt_nres_aguanalysis.agumetrics as agumetrics
+    import lcogt_nres_aguanalysis.agupinholesearch as agupinholesearch
+
+    before = agumetrics.metrics.snapshot()['histograms']
+    measurement = agupinholesearch.findPinhole(imagename, argparse.Namespace(makepng=False), None)
+    after = agumetrics.metrics.snapshot()['histograms']
+    for stage in PIPELINE_STAGES:
+        old = before.get(stage, {'count': 0, 'sum': 0.})
+        new = after.get(stage, old)
+        if new['count'] > old['count']:
+            timer.add(stage, new['sum'] - old['sum'])
+    return measurement
+
+
+def make_synthetic_set(outputdir, nframes, seed=0):
+    """ Write nframes synthetic AGU frames with agusynthetic, spread over a few cameras.
+        Returns the list of file names.
+    """
+    import lcogt_nres_aguanalysis.agusynthetic as agusynthetic
+
+    cameras = list(agusynthetic.CAMERAS)[:max(1, min(3, nframes // 10))]
+    framespernight = int(np.ceil(nframes / len(cameras)))
+    records = agusynthetic.generate_frames(outputdir, cameras=cameras, framespernight=framespernight, seed=seed)
+    return [os.path.join(outputdir, r['path']) for r in records[:nframes]]
+
+
+def benchmark_pipeline(filenames, timer, repeat=1):
+    measurements = []
+    for ii in range(repeat):
+        for filename in filenames:
+            measurement = time_findpinhole_stages(filename, timer)
+            if (measurement is not None) and (ii == 0):
+                measurements.append(measurement)
+    return measurements
+
+
+def benchmark_prior_acceptance(datadir, seed=0):
+    """ Pinhole match of the prior window peak, see agupinholesearch.is_good_prior_peak, on the synthetic frames in
+        datadir without star contamination, with a prior within 4 pixels of the true pinhole location and one 24 to 35
+        pixels off. Returns the range of the match of both where the peak was inside the window, and how often the
+        prior window was used for each.
+    """
+    import lcogt_nres_aguanalysis.agumetrics as agumetrics
+    import lcogt_nres_aguanalysis.agupinholesearch as agupinholesearch
+    import lcogt_nres_aguanalysis.agusynthetic as agusynthetic
+
+    with open(os.path.join(datadir, agusynthetic.MANIFEST)) as f:
+        records = [r for r in json.load(f) if not r['starcontamination']]
+    rng = np.random.default_rng(seed)
+    args = argparse.Namespace(makepng=False)
+    results = {}
+    for label, distance in (('in_window', (0, 4)), ('off_window', (24, 35))):
+        matches = []
+        used = 0
+        for record in records:
+            angle = rng.uniform(0, 2 * np.pi)
+            radius = rng.uniform(*distance)
+            prior = (record['xcenter'] + radius * np.cos(angle), record['ycenter'] + radius * np.sin(angle))
+            agumetrics.metrics.reset()
+            agupinholesearch.findPinhole(os.path.join(datadir, record['path']), args, None, prior=prior)
+            used += agumetrics.metrics.counters.get('prior_used', 0)
+            if 'prior_match' in agumetrics.metrics.gauges:
+                matches.append(agumetrics.metrics.gauges['prior_match'][0])
+        results[label] = {'n': len(matches), 'prior_used': used,
+                          'min_match': float(np.min(matches)) if matches else None,
+                          'max_match': float(np.max(matches)) if matches else None}
+    agumetrics.metrics.reset()
+    return results
+
+
+def benchmark_dbwrite(measurements, database, timer):
+    import lcogt_nres_aguanalysis.agupinholedb as agupinholedb
+
+    agupinholedb.create_db(database)
+    dbsession = agupinholedb.get_session(database)
+
+    def write():
+        for measurement in measurements:
+            dbsession.merge(measurement)
+        dbsession.commit()
+
+    timer.time('dbwrite', write)
+    dbsession.close()
+
+
+def fill_history(database, npoints, camera='ak01', seed=0):
+    """ Populate the database with npoints of plausible pinhole history for one camera."""
+    import lcogt_nres_aguanalysis.aguflexure as aguflexure
+    import lcogt_nres_aguanalysis.agupinholedb as agupinholedb
+
+    rng = np.random.default_rng(seed)
+    agupinholedb.create_db(database)
+    dbsession = agupinholedb.get_session(database)
+    start = datetime.datetime(2017, 1, 1)
+    span = (datetime.datetime.utcnow() - start).total_seconds()
+    offsets = np.sort(rng.uniform(0, span, npoints))
+    records = [agupinholedb.PinholeMeasurement(imagename=f'bench-{camera}-{ii:08d}-x00.fits.fz', instrument=camera,
+                                               telescopeidentifier='lsc-domb-1m0a',
+                                               altitude=float(rng.uniform(20, 90)),
+                                               azimut=float(rng.uniform(0, 360)),
+                                               xcenter=float(780 + rng.normal(0, 1)),
+                                               ycenter=float(550 + rng.normal(0, 1)),
+                                               crpix1=780., crpix2=550.,
+                                               dateobs=start + datetime.timedelta(seconds=float(offsets[ii])),
+                                               foctemp=float(rng.uniform(-5, 30)))
+               for ii in range(npoints)]
+    dbsession.bulk_save_objects(records)
+    dbsession.commit()
+    aguflexure.rebuild_statistics(dbsession, [camera])
+    dbsession.close()
+
+
+def benchmark_analysis(database, outputpath, timer, camera='ak01'):
+    import matplotlib
+    matplotlib.use('Agg')
+    import lcogt_nres_aguanalysis.aguanalysis as aguanalysis
+
+    timer.time('analysis_load', aguanalysis.readPinHoles, camera, database)
+    timer.time('analysis_plot', aguanalysis.plotagutrends, camera, database, outputpath)
+
+
+def benchmark_plot_scaling(workdir, pointcounts, rendermodes=('full', 'decimated'), camera='ak01'):
+    """ Time of plotagutrends, i.e., all plots of a camera, and the size of the png files, vs. the number of points
+        in the history, for each render mode. Returns a list of dicts.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import lcogt_nres_aguanalysis.aguanalysis as aguanalysis
+    from lcogt_nres_aguanalysis import agumetrics
+
+    results = []
+    for npoints in pointcounts:
+        database = f'sqlite:///{workdir}/plot-{npoints}.sqlite'
+        fill_history(database, npoints, camera=camera)
+        for rendermode in rendermodes:
+            outputpath = os.path.join(workdir, f'plot-{npoints}-{rendermode}')
+            os.makedirs(outputpath)
+            agumetrics.metrics.reset()
+            start = time.perf_counter()
+            aguanalysis.plotagutrends(camera, database, outputpath, rendermode=rendermode)
+            elapsed = time.perf_counter() - start
+            pngbytes = sum(os.path.getsize(f) for f in glob.glob(os.path.join(outputpath, '*.png')))
+            load = agumetrics.metrics.histograms['db_load'].sum
+            render = agumetrics.metrics.histograms['plot_render'].sum
+            results.append({'points': npoints, 'rendermode': rendermode, 'seconds': elapsed, 'load_seconds': load,
+                            'render_seconds': render, 'points_drawn': agumetrics.metrics.counters['plot_points_drawn'],
+                            'png_bytes': pngbytes})
+            log.info(f"Plot {npoints:8d} points {rendermode:>10s}: {elapsed:7.2f} s, of which load {load:5.2f} s "
+                     f"and savefig {render:5.2f} s, {results[-1]['points_drawn']:8d} points drawn, "
+                     f"{pngbytes / 1e6:6.2f} MB png")
+    return results
+
+
+_handoff_ring = None
+
+
+def _set_handoff_ring(ring):
+    global _handoff_ring
+    _handoff_ring = ring
+
+
+def _handoff_task(content, slot):
+    """ Stand-in of agupinholesearch.findPinholeTask that only moves the data: it reads the frame content as read_frame
+        does and returns a cutout and its store record, pickled or in the ring slot.
+    """
+    from lcogt_nres_aguanalysis import agucutoutstore, agusharedring
+
+    if slot is not None:
+        content = _handoff_ring.slots['content'][slot, :_handoff_ring.slots['contentsize'][slot]]
+    # astropy reads about the whole file once
+    data = agusharedring.BufferFile(content).read()
+    cutout, index = agucutoutstore.make_record(np.full(agucutoutstore.CUTOUT_SHAPE, data[-1]), 'frame', 'ak01',
+                                               'lsc-domb-1m0a', '2021-01-01T00:00:00', 60., 120., 10., 780, 550, 100.)
+    if slot is None:
+        return cutout, index
+    _handoff_ring.slots['cutout'][slot], _handoff_ring.slots['index'][slot] = cutout, index
+
+
+def benchmark_handoff(filenames, nframes=200):
+    """ Time per frame to hand the content of a downloaded frame to a pool worker and get a cutout back, pickled
+        through the pipe, and through the shared memory ring of agupinholesearch.findPinHoleInImages.
+        One worker, so this is the latency the transfer adds to every frame.
+    """
+    from lcogt_nres_aguanalysis import agupinholesearch, agusharedring, aguworkerpool
+
+    contents = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            contents.append(f.read())
+    results = {}
+    for mode in ['pickled', 'ring']:
+        ring = agusharedring.SharedRing(2, agupinholesearch.frame_slot_dtype()) if mode == 'ring' else None
+
+        def tasks():
+            for ii in range(nframes):
+                content = contents[ii % len(contents)]
+                if ring is None:
+                    yield ii, (content, None)
+                    continue
+                slot = ring.acquire()
+                ring.slots['content'][slot, :len(content)] = np.frombuffer(content, dtype=np.uint8)
+                ring.slots['contentsize'][slot] = len(content)
+                yield slot, (None, slot)
+
+        pool = aguworkerpool.DeadlinePool(_handoff_task, nworkers=1, initializer=_set_handoff_ring, initargs=(ring,))
+        start = time.perf_counter()
+        for result in pool.map(tasks()):
+            if ring is not None:
+                cutout = ring.slots['cutout'][result.key].copy(), ring.slots['index'][result.key].copy()
+                ring.release(result.key)
+        elapsed = time.perf_counter() - start
+        if ring is not None:
+            ring.close()
+        results[mode] = {'frames': nframes, 'frame_bytes': int(np.mean([len(c) for c in contents])),
+                         'seconds_per_frame': elapsed / nframes}
+        log.info(f"Handoff {mode:>8s}: {elapsed / nframes * 1e3:6.2f} ms per frame")
+    return results
+
+
+def parse_importtime(output):
+    """ Parse the stderr of python -X importtime. Returns a list of (module, self seconds, cumulative seconds, depth)
+        in the order python prints them, i.e., every module after the modules it imported.
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        selftime, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(selftime) / 1e6, int(cumulative) / 1e6, depth))
+    return imports
+
+
+def direct_imports(imports, module):
+    """ The modules imported by module itself, with their cumulative time, heaviest first."""
+    names = [entry[0] for entry in imports]
+    if module not in names:
+        return []
+    children = []
+    for name, selftime, cumulative, depth in reversed(imports[:names.index(module)]):
+        if depth == 0:
+            break
+        if depth == 1:
+            children.append((name, cumulative))
+    return sorted(children, key=lambda child: -child[1])
+
+
+def measure_startup(modules, timer, repeat=3, top=8):
+    """ Time a fresh interpreter importing each module, and break the import time down by what the module imports.
+        Wall clock times go into timer, one stage per module. Returns module -> import report.
+    """
+    report = {}
+    for module in modules:
+        for ii in range(repeat):
+            process = timer.time(module, subprocess.run, [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                 capture_output=True, text=True, check=True)
+        imports = parse_importtime(process.stderr)
+        total = [cumulative for name, selftime, cumulative, depth in imports if name == module]
+        report[module] = {'import': total[0] if total else None,
+                          'heaviest': dict(direct_imports(imports, module)[:top])}
+        log.info(f"{module}: import {report[module]['import']:.3f} s, "
+                 + ", ".join(f"{name} {cumulative:.3f} s" for name, cumulative in report[module]['heaviest'].items()))
+    return report
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def run_benchmarks(args):
+    results = {'commit': git_commit(),
+               'date': datetime.datetime.utcnow().isoformat(),
+               'python': platform.python_version(),
+               'machine': platform.machine(),
+               'numpy': np.__version__,
+               'benchmarks': {}}
+
+    timer = StageTimer()
+    results['startup_imports'] = measure_startup(ENTRY_POINT_MODULES, timer, repeat=args.repeat)
+    results['benchmarks']['startup'] = timer.summary()
+    if getattr(args, 'startup', False):
+        return results
+
+    with tempfile.TemporaryDirectory() as workdir:
+        testdata = sorted(glob.glob(os.path.join(args.testdata, '*.fits.fz')))
+        timer = StageTimer()
+        measurements = benchmark_pipeline(testdata, timer, repeat=args.repeat)
+        results['benchmarks']['testdata'] = timer.summary()
+        if len(testdata) > 0:
+            results['handoff'] = benchmark_handoff(testdata)
+
+        if args.nsynthetic > 0:
+            log.info(f"Generating {args.nsynthetic} synthetic frames")
+            syntheticdir = os.path.join(workdir, 'synthetic')
+            os.makedirs(syntheticdir)
+            filenames = make_synthetic_set(syntheticdir, args.nsynthetic)
+            timer = StageTimer()
+            measurements = benchmark_pipeline(filenames, timer)
+            results['benchmarks']['synthetic'] = timer.summary()
+            results['prior_acceptance'] = benchmark_prior_acceptance(syntheticdir)
+            for label, stats in results['prior_acceptance'].items():
+                log.info(f"Prior {label:>10s}: match {stats['min_match']} - {stats['max_match']}, "
+                         f"prior window used for {stats['prior_used']} of {stats['n']} frames")
+
+        if args.nengineframes > 0:
+            import lcogt_nres_aguanalysis.agucentroid as agucentroid
+            results['centroid_engines'] = agucentroid.benchmark_engines(args.nengineframes)
+            for engine, stats in results['centroid_engines'].items():
+                log.info(f"Centroid engine {engine:>10s}: {stats['frames_per_second']:8.0f} frames/s "
+                         f"rms residual {stats['rms']:6.3f} pixel")
+
+        timer = StageTimer()
+        benchmark_dbwrite(measurements, f'sqlite:///{workdir}/dbwrite.sqlite', timer)
+        database = f'sqlite:///{workdir}/history.sqlite'
+        fill_history(database, args.npoints)
+        outputpath = os.path.join(workdir, 'plots')
+        os.makedirs(outputpath)
+        benchmark_analysis(database, outputpath, timer)
+        results['benchmarks']['database'] = timer.summary()
+
+        if len(getattr(args, 'plotpoints', [])) > 0:
+            results['plot_scaling'] = benchmark_plot_scaling(workdir, args.plotpoints)
+
+    return results
+
+
+def compare(results, reference):
+    """ Print the ratio of median stage times, current over reference."""
+    print(f"{'benchmark':>12s} {'stage':>16s} {'reference':>10s} {'current':>10s} {'ratio':>6s}")
+    for benchmark, stages in results['benchmarks'].items():
+        for stage, stats in stages.items():
+            old = reference.get('benchmarks', {}).get(benchmark, {}).get(stage)
+            if old is None:
+                continue
+            print(f"{benchmark:>12s} {stage:>16s} {old['median']:10.5f} {stats['median']:10.5f} "
+                  f"{stats['median'] / old['median']:6.2f}")
+
+
+def parseCommandLine():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the AGU pinhole pipeline stage by stage, offline.')
+    parser.add_argument('--loglevel', dest='log_level', default='INFO', choices=['DEBUG', 'INFO'],
+                        help='Set the debug level')
+    parser.add_argument('--output', default='agubenchmark.json', help='json file to write the results to')
+    parser.add_argument('--compare', default=None, help='json result file of an earlier run to compare against')
+    parser.add_argument('--testdata', default=TESTDATADIR, help='Directory with the bundled test frames')
+    parser.add_argument('--repeat', default=3, type=int, help='How often to process the bundled test frames')
+    parser.add_argument('--nsynthetic', default=20, type=int, help='Number of synthetic frames to process')
+    parser.add_argument('--nengineframes', default=50, type=int,
+                        help='Number of synthetic frames to compare the centroid engines on')
+    parser.add_argument('--npoints', default=20000, type=int, help='Number of database rows to load and plot')
+    parser.add_argument('--plotpoints', default=[1000, 10000, 100000], type=int, nargs='*',
+                        help='History lengths to time the plots of in each render mode; none to skip')
+    parser.add_argument('--startup', action='store_true',
+                        help='Only measure the start up and import time of the console script modules')
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
+    return args
+
+
+def main():
+    args = parseCommandLine()
+    results = run_benchmarks(args)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    log.info(f"Benchmark results written to {args.output}")
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Local store of the search window cutouts of crawled AGU frames, so the centroiding can be re-run over the full history
+without the archive.
+
+The store is a directory with one chunk per camera and month:
+
+    {root}/{camera}/{YYYYMM}/cutouts.f32    raw float32 cutouts, CUTOUT_SHAPE each, appended back to back
+    {root}/{camera}/{YYYYMM}/index.bin      one INDEX_DTYPE record per cutout: header metadata and image background
+
+Both files are append only. The cutout is written before its index record, so a record is complete once its index
+entry exists. A write that was interrupted leaves cutouts, or a partial index record, past the last complete record:
+reading ignores them, and the next append truncates both files back to the complete records first, so that the n-th
+index record always belongs to the n-th cutout. Cutouts are read back as a memory mapped
+array, so a batch of a chunk costs no more than the pages it touches. There is one writer per store: the crawler
+writes from its main process, not from the pool workers.
+
+A cutout is ~57 kB, about 700 MB per camera and year of focus images.
+
+"""
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+# agupinholesearch.extract_cutout: 2 * EXTRACT_FRAMESIZE - 1 pixels around CRPIX1/2
+CUTOUT_SHAPE = (119, 119)
+CUTOUT_DTYPE = np.float32
+
+INDEX_DTYPE = np.dtype([('imagename', 'S64'),
+                        ('instrument', 'S16'),
+                        ('telescopeidentifier', 'S32'),
+                        ('dateobs', 'datetime64[ms]'),
+                        ('altitude', 'f8'),
+                        ('azimut', 'f8'),
+                        ('foctemp', 'f8'),
+                        ('crpix1', 'i4'),
+                        ('crpix2', 'i4'),
+                        ('background', 'f8')])
+
+CUTOUT_FILE = 'cutouts.f32'
+INDEX_FILE = 'index.bin'
+CUTOUT_BYTES = int(np.prod(CUTOUT_SHAPE)) * np.dtype(CUTOUT_DTYPE).itemsize
+
+
+def _complete_records(directory):
+    """ Number of records of a chunk with both their cutout and their index record written."""
+    sizes = []
+    for filename, recordsize in [(CUTOUT_FILE, CUTOUT_BYTES), (INDEX_FILE, INDEX_DTYPE.itemsize)]:
+        path = os.path.join(directory, filename)
+        sizes.append(os.path.getsize(path) // recordsize if os.path.exists(path) else 0)
+    return min(sizes)
+
+
+def make_record(cutout, imagename, instrument, telescopeidentifier, dateobs, altitude, azimut, foctemp, crpix1,
+                crpix2, background):
+    """ A cutout and its index record, in the form CutoutStore.append takes."""
+    index = np.zeros(1, dtype=INDEX_DTYPE)[0]
+    index['imagename'] = imagename.encode()
+    index['instrument'] = instrument.encode()
+    index['telescopeidentifier'] = telescopeidentifier.encode()
+    index['dateobs'] = np.datetime64(dateobs, 'ms')
+    index['altitude'] = altitude
+    index['azimut'] = azimut
+    index['foctemp'] = foctemp
+    index['crpix1'] = crpix1
+    index['crpix2'] = crpix2
+    index['background'] = background
+    return np.asarray(cutout, dtype=CUTOUT_DTYPE), index
+
+
+class CutoutStore:
+    """ Append only cutout store, one chunk per camera and month."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def chunkdir(self, camera, month):
+        return os.path.join(self.root, camera, month)
+
+    def append(self, records):
+        """ Append (cutout, index record) pairs from make_record. Returns the number of records written."""
+        chunks = {}
+        for cutout, index in records:
+            if cutout.shape != CUTOUT_SHAPE:
+                log.debug(f"Not storing the {cutout.shape} cutout of {index['imagename'].decode()}")
+                continue
+            month = index['dateobs'].astype('datetime64[M]').astype(str).replace('-', '')
+            chunks.setdefault((index['instrument'].decode(), month), []).append((cutout, index))
+        written = 0
+        for (camera, month), chunk in chunks.items():
+            directory = self.chunkdir(camera, month)
+            os.makedirs(directory, exist_ok=True)
+            # drop the remains of an interrupted write, or they would shift the cutouts against the index
+            n = _complete_records(directory)
+            for filename, recordsize in [(CUTOUT_FILE, CUTOUT_BYTES), (INDEX_FILE, INDEX_DTYPE.itemsize)]:
+                path = os.path.join(directory, filename)
+                if os.path.exists(path) and os.path.getsize(path) > n * recordsize:
+                    log.warning(f"Truncating {path} to the {n} complete records of an interrupted write")
+                    os.truncate(path, n * recordsize)
+            with open(os.path.join(directory, CUTOUT_FILE), 'ab') as f:
+                f.write(np.stack([cutout for cutout, index in chunk]).tobytes())
+            with open(os.path.join(directory, INDEX_FILE), 'ab') as f:
+                f.write(np.asarray([index for cutout, index in chunk], dtype=INDEX_DTYPE).tobytes())
+            written += len(chunk)
+        return written
+
+    def cameras(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+    def months(self, camera):
+        directory = os.path.join(self.root, camera)
+        return sorted(m for m in os.listdir(directory) if os.path.isfile(os.path.join(directory, m, INDEX_FILE)))
+
+    def read(self, camera, month):
+        """ Index and memory mapped cutouts of a chunk. If an image was stored more than once, its last cutout is used.
+            Returns index, cutouts
+        """
+        directory = self.chunkdir(camera, month)
+        cutoutfile = os.path.join(directory, CUTOUT_FILE)
+        n = _complete_records(directory)
+        index = np.fromfile(os.path.join(directory, INDEX_FILE), dtype=INDEX_DTYPE, count=n)
+        if n == 0:
+            return index[:0], np.zeros((0,) + CUTOUT_SHAPE, dtype=CUTOUT_DTYPE)
+        cutouts = np.memmap(cutoutfile, dtype=CUTOUT_DTYPE, mode='r', shape=(n,) + CUTOUT_SHAPE)
+        index = index[:n]
+        # last occurrence of every image name
+        names = index['imagename'][::-1]
+        unique, first = np.unique(names, return_index=True)
+        if len(unique) < n:
+            keep = np.sort(n - 1 - first)
+            return index[keep], cutouts[keep]
+        return index, cutouts
+
+    def iter_batches(self, cameras=None, batchsize=4096):
+        """ Yield camera, index, cutouts in batches of up to batchsize cutouts of one chunk."""
+        for camera in (cameras if cameras is not None else self.cameras()):
+            if not os.path.isdir(os.path.join(self.root, camera)):
+                continue
+            for month in self.months(camera):
+                index, cutouts = self.read(camera, month)
+                for start in range(0, len(index), batchsize):
+                    yield camera, index[start:start + batchsize], cutouts[start:start + batchsize]
+
+    def count(self):
+        """ Number of stored cutouts per camera."""
+        return {camera: sum(len(self.read(camera, month)[0]) for month in self.months(camera))
+                for camera in self.cameras()}
@@ -0,0 +1,318 @@
+"""
+Flexure model of the pinhole location vs. altitude, azimuth and focus temperature, per camera.
+
+The pinhole location x, y of a camera is modelled as
+
+    x = x0(month) + a1 sin(alt) + a2 cos(alt) + a3 sin(az) + a4 cos(az) + a5 WMSTEMP
+
+and the same for y, with an offset per calendar month that absorbs the slow drift and the re-mounts of a camera
+(aguanalysis.plotagutrends removes the drift with a running median for the same reason).
+
+The database keeps the least-squares sufficient statistics of every camera and month in PinholeFlexureStatistics:
+n, F^T F, F^T [x y] and the sums of x^2 and y^2, for the features F = [1, sin(alt), cos(alt), sin(az), cos(az),
+WMSTEMP]. The crawler adds each new measurement to them in the same transaction as the measurement itself, and
+takes out the old values of a measurement it replaces, so the statistics cost O(new rows) to maintain. Any range of
+months is then fitted from a handful of small matrices, without reading the measurements:
+
+    model = aguflexure.fit_camera(dbsession, 'ak01')
+    model.coefficients, model.uncertainties, model.rms
+
+rebuild_statistics() fills the table from the measurements once, for a database that predates it.
+
+"""
+import collections
+import datetime
+import json
+import logging
+import math
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+import lcogt_nres_aguanalysis.agupinholedb as agupinholedb
+
+log = logging.getLogger(__name__)
+
+FEATURES = ['sin(alt)', 'cos(alt)', 'sin(az)', 'cos(az)', 'foctemp']
+NFEATURES = len(FEATURES) + 1  # with the constant
+# attempts to add to a statistics row that another writer creates at the same time
+APPLY_ATTEMPTS = 5
+
+
+def features(altitude, azimut, foctemp):
+    """ Design matrix rows [1, sin(alt), cos(alt), sin(az), cos(az), foctemp], for alt and az in degrees."""
+    altitude = np.radians(np.asarray(altitude, dtype=float))
+    azimut = np.radians(np.asarray(azimut, dtype=float))
+    foctemp = np.asarray(foctemp, dtype=float)
+    return np.stack([np.ones_like(altitude), np.sin(altitude), np.cos(altitude), np.sin(azimut), np.cos(azimut),
+                     foctemp], axis=-1)
+
+
+def month_of(dateobs):
+    return f'{dateobs:%Y%m}'
+
+
+class FlexureStatistics:
+    """ Sufficient statistics of the linear least-squares problem of one camera and month."""
+
+    def __init__(self, n=0, xtx=None, xty=None, yty=None):
+        self.n = n
+        self.xtx = np.zeros((NFEATURES, NFEATURES)) if xtx is None else np.asarray(xtx, dtype=float)
+        self.xty = np.zeros((NFEATURES, 2)) if xty is None else np.asarray(xty, dtype=float)
+        self.yty = np.zeros(2) if yty is None else np.asarray(yty, dtype=float)
+
+    def add(self, f, xy, sign=1):
+        """ Add rows of features f and locations xy, or take them out again with sign=-1."""
+        f = np.atleast_2d(f)
+        xy = np.atleast_2d(xy)
+        self.n += sign * len(f)
+        self.xtx += sign * f.T @ f
+        self.xty += sign * f.T @ xy
+        self.yty += sign * np.sum(xy * xy, axis=0)
+
+    def __iadd__(self, other):
+        self.n += other.n
+        self.xtx += other.xtx
+        self.xty += other.xty
+        self.yty += other.yty
+        return self
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(record.n, json.loads(record.xtx), json.loads(record.xty), json.loads(record.yty))
+
+    def to_record(self, record):
+        record.n = self.n
+        record.xtx = json.dumps(self.xtx.tolist())
+        record.xty = json.dumps(self.xty.tolist())
+        record.yty = json.dumps(self.yty.tolist())
+        record.updated = datetime.datetime.utcnow()
+        return record
+
+
+class FlexureModel:
+    """ Fitted flexure coefficients of a camera, for x and y.
+        coefficients, uncertainties: dict feature -> (x, y); offsets: dict month -> (x0, y0); rms: (x, y) of the
+        residuals.
+    """
+
+    def __init__(self, instrument, coefficients, uncertainties, offsets, rms, n):
+        self.instrument = instrument
+        self.coefficients = coefficients
+        self.uncertainties = uncertainties
+        self.offsets = offsets
+        self.rms = rms
+        self.n = n
+
+    def predict(self, altitude, azimut, foctemp, months):
+        """ Model x, y; months is the YYYYMM of each point. Months without an offset give nan."""
+        f = features(altitude, azimut, foctemp)[..., 1:]
+        beta = np.asarray([self.coefficients[feature] for feature in FEATURES])
+        offsets = np.asarray([self.offsets.get(month, (np.nan, np.nan)) for month in np.atleast_1d(months)])
+        predicted = f @ beta + offsets
+        return predicted[..., 0], predicted[..., 1]
+
+    def residuals(self, altitude, azimut, foctemp, months, x, y):
+        """ measured - predicted x and y."""
+        px, py = self.predict(altitude, azimut, foctemp, months)
+        return np.asarray(x, dtype=float) - px, np.asarray(y, dtype=float) - py
+
+    def to_dict(self):
+        return {'instrument': self.instrument, 'n': self.n, 'rms': list(self.rms),
+                'coefficients': {k: list(v) for k, v in self.coefficients.items()},
+                'uncertainties': {k: list(v) for k, v in self.uncertainties.items()},
+                'offsets': {k: list(v) for k, v in self.offsets.items()}}
+
+    def __repr__(self):
+        return f"<FlexureModel(instrument='{self.instrument}', n={self.n}, rms=({self.rms[0]:.2f}, {self.rms[1]:.2f}))>"
+
+
+def fit(instrument, statistics):
+    """ Least-squares fit of the shared flexure coefficients with an offset per month, from the statistics of each
+        month (dict month -> FlexureStatistics). This is the fixed-effects estimator: the statistics of every month
+        are centered on its own means, and the centered statistics are summed.
+        Returns a FlexureModel, or None if there are too few points.
+    """
+    statistics = {month: s for month, s in statistics.items() if s.n > 0}
+    n = sum(s.n for s in statistics.values())
+    dof = n - len(FEATURES) - len(statistics)
+    if dof <= 0:
+        return None
+    sxx = np.zeros((len(FEATURES), len(FEATURES)))
+    sxy = np.zeros((len(FEATURES), 2))
+    syy = np.zeros(2)
+    means = {}
+    for month, s in statistics.items():
+        fmean = s.xtx[0, 1:] / s.n
+        ymean = s.xty[0] / s.n
+        sxx += s.xtx[1:, 1:] - s.n * np.outer(fmean, fmean)
+        sxy += s.xty[1:] - s.n * np.outer(fmean, ymean)
+        syy += s.yty - s.n * ymean * ymean
+        means[month] = fmean, ymean
+    # a feature without any spread, e.g., a constant altitude, is left out of the fit by the pseudo inverse.
+    sxxinv = np.linalg.pinv(sxx, rcond=1e-10, hermitian=True)
+    beta = sxxinv @ sxy
+    rss = np.maximum(syy - np.sum(beta * sxy, axis=0), 0)
+    sigma2 = rss / dof
+    uncertainty = np.sqrt(np.outer(np.maximum(np.diag(sxxinv), 0), sigma2))
+    offsets = {month: tuple(float(v) for v in ymean - fmean @ beta) for month, (fmean, ymean) in sorted(means.items())}
+    return FlexureModel(instrument,
+                        {feature: (float(beta[ii, 0]), float(beta[ii, 1])) for ii, feature in enumerate(FEATURES)},
+                        {feature: (float(uncertainty[ii, 0]), float(uncertainty[ii, 1]))
+                         for ii, feature in enumerate(FEATURES)},
+                        offsets, tuple(float(v) for v in np.sqrt(sigma2)), n)
+
+
+def measurement_row(measurement):
+    """ instrument, month, features and location of a measurement, or None if it can not go into the fit."""
+    values = [measurement.altitude, measurement.azimut, measurement.foctemp, measurement.xcenter, measurement.ycenter]
+    if measurement.instrument is None or measurement.dateobs is None or \
+            any(v is None or not math.isfinite(v) for v in values):
+        return None
+    return measurement.instrument, month_of(measurement.dateobs), features(*values[:3]), values[3:]
+
+
+class StatisticsUpdate:
+    """ Collects the changes of a batch of measurement writes, and applies them to the stored statistics:
+
+        update = StatisticsUpdate()
+        update.merge_all(dbsession, measurements)
+        update.apply(dbsession)
+        dbsession.commit()
+    """
+
+    # measurements looked up per query in merge_all; well below the bound parameter limits of sqlite and PostgreSQL
+    LOOKUP_CHUNK = 500
+
+    def __init__(self):
+        self.changes = collections.defaultdict(FlexureStatistics)
+
+    def add(self, measurement, sign=1):
+        self._add(measurement_row(measurement), sign)
+
+    def _add(self, row, sign=1):
+        if row is not None:
+            instrument, month, f, xy = row
+            self.changes[(instrument, month)].add(f, xy, sign)
+
+    def merge(self, session, measurement):
+        """ session.merge the measurement, taking out the contribution of the measurement it replaces."""
+        previous = session.query(agupinholedb.PinholeMeasurement).get(measurement.imagename)
+        # merge updates previous in place
+        previous = measurement_row(previous) if previous is not None else None
+        merged = session.merge(measurement)
+        self._add(previous, sign=-1)
+        self.add(measurement)
+        return merged
+
+    def merge_all(self, session, measurements):
+        """ merge() a batch of measurements, with the measurements they replace looked up in one query per LOOKUP_CHUNK.
+            A measurement that is not in the database yet is added without another round trip.
+        """
+        model = agupinholedb.PinholeMeasurement
+        merged = []
+        # the current row of each image, and the measurements added in this batch, which are not flushed yet
+        rows = {}
+        added = {}
+        for start in range(0, len(measurements), self.LOOKUP_CHUNK):
+            chunk = measurements[start:start + self.LOOKUP_CHUNK]
+            lookup = {m.imagename for m in chunk} - set(added)
+            # keep the loaded rows referenced, so session.merge finds them in the identity map without a query
+            existing = session.query(model).filter(model.imagename.in_(lookup)).all() if len(lookup) > 0 else []
+            rows.update({m.imagename: measurement_row(m) for m in existing})
+            stored = {m.imagename for m in existing}
+            for measurement in chunk:
+                name = measurement.imagename
+                if name in stored:
+                    target = session.merge(measurement)
+                elif name in added:
+                    # twice in this batch: the later one wins
+                    target = added[name]
+                    for column in model.__table__.columns.keys():
+                        setattr(target, column, getattr(measurement, column))
+                else:
+                    session.add(measurement)
+                    target = added[name] = measurement
+                self._add(rows.get(name), sign=-1)
+                self.add(measurement)
+                rows[name] = measurement_row(measurement)
+                merged.append(target)
+        return merged
+
+    def apply(self, session):
+        """ Add the collected changes to the statistics in the database. Does not commit.
+
+            Several crawlers and queue workers write to one database. Each row is read with a row lock (SELECT ... FOR
+            UPDATE) and updated in this transaction, so the others wait for the commit instead of overwriting the sums.
+            A row that another writer inserts first fails the insert in a savepoint only, and is then locked and added
+            to. sqlite has no row locks, but the flush of the measurements first takes its database write lock, so
+            there is one writer at a time there.
+        """
+        agupinholedb.create_flexure_table(session)
+        session.flush()
+        statistics_model = agupinholedb.PinholeFlexureStatistics
+        # the same lock order in every writer, so two batches never wait on each other's rows
+        for (instrument, month), change in sorted(self.changes.items()):
+            for attempt in range(APPLY_ATTEMPTS):
+                record = session.query(statistics_model).filter_by(instrument=instrument, month=month) \
+                    .with_for_update().populate_existing().one_or_none()
+                if record is not None:
+                    statistics = FlexureStatistics.from_record(record)
+                    statistics += change
+                    statistics.to_record(record)
+                    break
+                statistics = FlexureStatistics()
+                statistics += change
+                record = statistics.to_record(statistics_model(instrument=instrument, month=month))
+                try:
+                    with session.begin_nested():
+                        session.add(record)
+                    break
+                except IntegrityError:
+                    log.debug(f"Flexure statistics of {instrument} {month} were created by another writer, retrying")
+            else:
+                raise RuntimeError(f"Could not update the flexure statistics of {instrument} {month}")
+        n = len(self.changes)
+        self.changes.clear()
+        return n
+
+
+def load_statistics(session, instrument, start=None, end=None):
+    """ Statistics of a camera per month, for the months from start to end (datetimes, inclusive)."""
+    agupinholedb.create_flexure_table(session)
+    q = session.query(agupinholedb.PinholeFlexureStatistics) \
+        .filter(agupinholedb.PinholeFlexureStatistics.instrument == instrument)
+    if start is not None:
+        q = q.filter(agupinholedb.PinholeFlexureStatistics.month >= month_of(start))
+    if end is not None:
+        q = q.filter(agupinholedb.PinholeFlexureStatistics.month <= month_of(end))
+    return {record.month: FlexureStatistics.from_record(record) for record in q}
+
+
+def fit_camera(session, instrument, start=None, end=None):
+    """ Flexure model of a camera from the stored statistics. Returns a FlexureModel, or None."""
+    return fit(instrument, load_statistics(session, instrument, start, end))
+
+
+def rebuild_statistics(session, instruments=None, chunksize=5000):
+    """ Recompute the stored statistics from all measurements of the cameras, or of all cameras. This is the one full
+        scan, for a database with measurements from before the statistics were kept.
+    """
+    agupinholedb.create_flexure_table(session)
+    measurement = agupinholedb.PinholeMeasurement
+    statistics = agupinholedb.PinholeFlexureStatistics
+    q = session.query(measurement)
+    if instruments is not None:
+        q = q.filter(measurement.instrument.in_(instruments))
+        session.query(statistics).filter(statistics.instrument.in_(instruments)).delete(synchronize_session=False)
+    else:
+        session.query(statistics).delete(synchronize_session=False)
+    update = StatisticsUpdate()
+    n = 0
+    for m in q.yield_per(chunksize):
+        update.add(m)
+        n += 1
+    update.apply(session)
+    session.commit()
+    log.info(f"Rebuilt the flexure statistics from {n} measurements")
+    return n
@@ -0,0 +1,199 @@
+"""
+Run time metrics for the crawler and the plotter.
+
+Code paths record per-stage latencies into histograms, byte and item counts into counters, and queue depths into
+gauges, all in a process-wide registry:
+
+    with agumetrics.timed('correlate'):
+        ...
+    agumetrics.count('download_bytes', len(content))
+    agumetrics.gauge('pool_pending', len(futures))
+
+Worker processes ship a snapshot() of their registry back with each result, and the parent merge()s it. At the end of
+a run, write() saves a json summary, or a Prometheus textfile-collector snapshot if the file name ends in .prom.
+
+"""
+import contextlib
+import json
+import math
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., math.inf]
+
+
+class Histogram:
+    """ Latency histogram with fixed bucket upper bounds, in seconds."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = list(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.
+        self.min = math.inf
+        self.max = 0.
+
+    def observe(self, value):
+        for ii, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[ii] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ Estimate of the q quantile: upper bound of the bucket that holds it, capped by the largest value seen."""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        cumulative = 0
+        for bound, n in zip(self.buckets, self.counts):
+            cumulative += n
+            if cumulative >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'buckets': [b if math.isfinite(b) else 'inf' for b in self.buckets], 'counts': list(self.counts),
+                'count': self.count, 'sum': self.sum,
+                'min': self.min if self.count > 0 else None, 'max': self.max if self.count > 0 else None}
+
+    def merge(self, d):
+        for ii, n in enumerate(d['counts']):
+            self.counts[ii] += n
+        self.count += d['count']
+        self.sum += d['sum']
+        if d['count'] > 0:
+            self.min = min(self.min, d['min'])
+            self.max = max(self.max, d['max'])
+
+
+class MetricsRegistry:
+    """ Histograms, counters and gauges by name. Safe to update from several threads, e.g., the fetch threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            if stage not in self.histograms:
+                self.histograms[stage] = Histogram()
+            self.histograms[stage].observe(seconds)
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, value):
+        with self.lock:
+            last, peak = self.gauges.get(name, (value, value))
+            self.gauges[name] = (value, max(peak, value))
+
+    def snapshot(self):
+        """ Plain, picklable copy of the registry content."""
+        with self.lock:
+            return {'histograms': {stage: h.to_dict() for stage, h in self.histograms.items()},
+                    'counters': dict(self.counters),
+                    'gauges': {name: {'last': last, 'max': peak} for name, (last, peak) in self.gauges.items()}}
+
+    def merge(self, snapshot):
+        """ Add the content of another registry's snapshot, e.g., from a worker process."""
+        if snapshot is None:
+            return
+        with self.lock:
+            for stage, d in snapshot['histograms'].items():
+                if stage not in self.histograms:
+                    self.histograms[stage] = Histogram()
+                self.histograms[stage].merge(d)
+            for name, n in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+            for name, d in snapshot['gauges'].items():
+                last, peak = self.gauges.get(name, (d['last'], d['max']))
+                self.gauges[name] = (d['last'], max(peak, d['max']))
+
+    def summary(self):
+        """ json-able summary with per-stage latency quantiles."""
+        stages = {}
+        for stage, h in self.histograms.items():
+            stages[stage] = h.to_dict()
+            stages[stage].update({'mean': h.sum / h.count if h.count > 0 else None,
+                                  'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99)})
+        snapshot = self.snapshot()
+        return {'stages': stages, 'counters': snapshot['counters'], 'gauges': snapshot['gauges']}
+
+    def prometheus(self, prefix):
+        lines = [f'# TYPE {prefix}_stage_seconds histogram']
+        for stage, h in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, n in zip(h.buckets, h.counts):
+                cumulative += n
+                le = '+Inf' if not math.isfinite(bound) else repr(bound)
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} {h.sum}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {h.count}')
+        for name, n in sorted(self.counters.items()):
+            lines.append(f'# TYPE {prefix}_{name}_total counter')
+            lines.append(f'{prefix}_{name}_total {n}')
+        for name, (last, peak) in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {prefix}_{name} gauge')
+            lines.append(f'{prefix}_{name} {last}')
+            lines.append(f'# TYPE {prefix}_{name}_max gauge')
+            lines.append(f'{prefix}_{name}_max {peak}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename, prefix='agupinhole'):
+        """ Write a json summary, or a Prometheus textfile if filename ends with .prom.
+            The file is replaced atomically so a textfile collector never reads a partial file.
+        """
+        if filename.endswith('.prom'):
+            content = self.prometheus(prefix)
+        else:
+            content = json.dumps(self.summary(), indent=2)
+        tmpfile = f'{filename}.{os.getpid()}.tmp'
+        with open(tmpfile, 'w') as f:
+            f.write(content)
+        os.replace(tmpfile, filename)
+
+
+metrics = MetricsRegistry()
+
+
+def _new_lock_after_fork():
+    # a lock held by another thread of the parent at fork time would never be released in the child
+    metrics.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_new_lock_after_fork)
+
+
+def timed(stage):
+    return metrics.timed(stage)
+
+
+def observe(stage, seconds):
+    metrics.observe(stage, seconds)
+
+
+def count(name, n=1):
+    metrics.count(name, n)
+
+
+def gauge(name, value):
+    metrics.gauge(name, value)
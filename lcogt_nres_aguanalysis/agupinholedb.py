@@ -1,10 +1,18 @@
+import datetime
 import logging
 import os
+import socket
+import threading
 
-from sqlalchemy import Column, Float, String, DateTime, create_engine, pool, exists
+import numpy as np
+
+from sqlalchemy import Column, Float, Integer, String, DateTime, create_engine, event, exists, func, select, update
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+from lcogt_nres_aguanalysis import agumetrics
+
 log = logging.getLogger(__name__)
 
 Base = declarative_base()
@@ -32,6 +40,43 @@ class PinholeMeasurement(Base):
             self.ycenter if self.ycenter is not None else 0)
 
 
+class PinholeWorkItem(Base):
+    """ A frame in the work queue shared by crawler instances on several nodes.
+        state goes from queued to leased to done or failed. A leased item whose leaseexpiry has passed is queued again.
+    """
+    __tablename__ = 'pinholeworkqueue'
+
+    imagename = Column(String, primary_key=True)  # basename, as in PinholeMeasurement
+    filename = Column(String)  # full path in disk mode
+    frameid = Column(Integer)  # archive frame id, or None in disk mode
+    instrument = Column(String, index=True)
+    state = Column(String, index=True, default='queued')
+    leaseowner = Column(String)
+    leaseexpiry = Column(DateTime, index=True)
+    attempts = Column(Integer, default=0)
+
+    def __repr__(self):
+        return f"<PinholeWorkItem(image='{self.imagename}', state='{self.state}', owner='{self.leaseowner}')>"
+
+
+class PinholeFlexureStatistics(Base):
+    """ Least-squares sufficient statistics of the pinhole location of one camera in one month, see aguflexure.
+        The matrices are json encoded lists, so the table is the same on sqlite and PostgreSQL.
+    """
+    __tablename__ = 'pinholeflexurestatistics'
+
+    instrument = Column(String, primary_key=True)
+    month = Column(String, primary_key=True)  # YYYYMM of dateobs
+    n = Column(Integer, default=0)
+    xtx = Column(String)  # features^T features
+    xty = Column(String)  # features^T [x, y]
+    yty = Column(String)  # [sum x^2, sum y^2]
+    updated = Column(DateTime)
+
+    def __repr__(self):
+        return f"<PinholeFlexureStatistics(instrument='{self.instrument}', month='{self.month}', n={self.n})>"
+
+
 Base_v1 = declarative_base()
 
 
@@ -96,29 +141,223 @@ def doesRecordExists(session, filename):
     return ret
 
 
+def get_recent_location(session, instrument, ndays=14, minmeasurements=5):
+    """ Median pinhole location x, y of a camera over the last ndays before its most recent measurement.
+        Returns None if the camera has fewer than minmeasurements there.
+    """
+    resultset = session.query(PinholeMeasurement.dateobs, PinholeMeasurement.xcenter, PinholeMeasurement.ycenter) \
+        .filter(PinholeMeasurement.instrument == instrument) \
+        .filter(PinholeMeasurement.xcenter.isnot(None)).filter(PinholeMeasurement.ycenter.isnot(None)) \
+        .order_by(PinholeMeasurement.dateobs.desc()).limit(500).all()
+    if len(resultset) == 0:
+        return None
+    last = resultset[0].dateobs
+    recent = [(r.xcenter, r.ycenter) for r in resultset if r.dateobs > last - datetime.timedelta(days=ndays)]
+    if len(recent) < minmeasurements:
+        return None
+    x, y = np.median(np.asarray(recent), axis=0)
+    return float(x), float(y)
+
+
+def enqueue_work(session, items, skipmeasured=True):
+    """ Add frames to the work queue. items is an iterable of (filename, frameid, instrument).
+        Frames already in the queue, and with skipmeasured frames that already have a measurement, are left out.
+        Returns the number of frames added.
+    """
+    items = {os.path.basename(str(filename)): (str(filename), frameid, instrument)
+             for filename, frameid, instrument in items}
+    if len(items) == 0:
+        return 0
+    names = list(items)
+    known = set()
+    # keep the IN lists below the sqlite parameter limit
+    for ii in range(0, len(names), 500):
+        chunk = names[ii:ii + 500]
+        known.update(r[0] for r in session.query(PinholeWorkItem.imagename)
+                     .filter(PinholeWorkItem.imagename.in_(chunk)))
+        if skipmeasured:
+            known.update(r[0] for r in session.query(PinholeMeasurement.imagename)
+                         .filter(PinholeMeasurement.imagename.in_(chunk)))
+    new = [PinholeWorkItem(imagename=name, filename=filename, frameid=frameid, instrument=instrument,
+                           state='queued', attempts=0)
+           for name, (filename, frameid, instrument) in items.items() if name not in known]
+    session.bulk_save_objects(new)
+    session.commit()
+    log.info(f"Enqueued {len(new)} of {len(items)} frames")
+    return len(new)
+
+
+def default_lease_owner():
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+def requeue_expired(session, maxattempts=3, now=None):
+    """ Queue leased items again whose lease has expired, or mark them failed after maxattempts.
+        Returns the number of items requeued.
+    """
+    now = now if now is not None else datetime.datetime.utcnow()
+    expired = (PinholeWorkItem.state == 'leased') & (PinholeWorkItem.leaseexpiry < now)
+    session.query(PinholeWorkItem).filter(expired & (PinholeWorkItem.attempts >= maxattempts)) \
+        .update({'state': 'failed'}, synchronize_session=False)
+    n = session.query(PinholeWorkItem).filter(expired) \
+        .update({'state': 'queued', 'leaseowner': None, 'leaseexpiry': None}, synchronize_session=False)
+    session.commit()
+    if n > 0:
+        log.info(f"Requeued {n} work items with expired leases")
+    return n
+
+
+def claim_work(session, owner, batchsize=10, leaseseconds=600):
+    """ Atomically lease up to batchsize queued items to owner, for leaseseconds.
+        On PostgreSQL the rows are locked with FOR UPDATE SKIP LOCKED, so concurrent claims do not wait on each other.
+        Elsewhere, e.g., sqlite, the claim is a single UPDATE of a LIMIT subquery, which the database serializes.
+        Returns the list of claimed PinholeWorkItem.
+    """
+    expiry = datetime.datetime.utcnow() + datetime.timedelta(seconds=leaseseconds)
+    lease = {'state': 'leased', 'leaseowner': owner, 'leaseexpiry': expiry,
+             'attempts': PinholeWorkItem.attempts + 1}
+    if session.bind.dialect.name == 'postgresql':
+        names = [r[0] for r in session.query(PinholeWorkItem.imagename)
+                 .filter(PinholeWorkItem.state == 'queued').order_by(PinholeWorkItem.imagename)
+                 .limit(batchsize).with_for_update(skip_locked=True)]
+        session.execute(update(PinholeWorkItem).where(PinholeWorkItem.imagename.in_(names)).values(**lease))
+    else:
+        candidates = select(PinholeWorkItem.imagename).where(PinholeWorkItem.state == 'queued') \
+            .order_by(PinholeWorkItem.imagename).limit(batchsize).scalar_subquery()
+        session.execute(update(PinholeWorkItem)
+                        .where(PinholeWorkItem.imagename.in_(candidates) & (PinholeWorkItem.state == 'queued'))
+                        .values(**lease).execution_options(synchronize_session=False))
+    session.commit()
+    return session.query(PinholeWorkItem).filter(PinholeWorkItem.state == 'leased') \
+        .filter(PinholeWorkItem.leaseowner == owner).filter(PinholeWorkItem.leaseexpiry == expiry).all()
+
+
+def complete_work(session, imagenames, owner, state='done'):
+    """ Mark leased items of owner as done, or failed."""
+    for ii in range(0, len(imagenames), 500):
+        session.query(PinholeWorkItem).filter(PinholeWorkItem.imagename.in_(imagenames[ii:ii + 500])) \
+            .filter(PinholeWorkItem.leaseowner == owner).update({'state': state}, synchronize_session=False)
+    session.commit()
+
+
+def release_work(session, imagenames, owner, maxattempts=3):
+    """ Queue leased items of owner again for another attempt, e.g., after a timeout, or mark them failed after
+        maxattempts. Returns the number of items queued again.
+    """
+    n = 0
+    for ii in range(0, len(imagenames), 500):
+        mine = PinholeWorkItem.imagename.in_(imagenames[ii:ii + 500]) & (PinholeWorkItem.leaseowner == owner) & \
+            (PinholeWorkItem.state == 'leased')
+        session.query(PinholeWorkItem).filter(mine & (PinholeWorkItem.attempts >= maxattempts)) \
+            .update({'state': 'failed'}, synchronize_session=False)
+        n += session.query(PinholeWorkItem).filter(mine) \
+            .update({'state': 'queued', 'leaseowner': None, 'leaseexpiry': None}, synchronize_session=False)
+    session.commit()
+    return n
+
+
+def count_work(session):
+    """ Number of work items per state."""
+    return dict(session.query(PinholeWorkItem.state, func.count(PinholeWorkItem.imagename))
+                .group_by(PinholeWorkItem.state).all())
+
+
+# Process-wide engines by database url, with the connection pool of the dialect, e.g., a QueuePool for PostgreSQL.
+# sqlite file databases keep SQLAlchemy's default NullPool, since their connections are cheap and tied to a thread.
+_engines = {}
+_sessionmakers = {}
+_schemas = set()
+_stats = {}
+_inherited = []
+_lock = threading.Lock()
+
+
+def _count(db_address, name):
+    # never keep the password around in the statistics
+    key = repr(make_url(db_address))
+    stats = _stats.setdefault(key, {'engines': 0, 'connects': 0, 'checkouts': 0, 'schema_checks': 0})
+    stats[name] += 1
+    if name == 'connects':
+        agumetrics.count('db_connects')
+
+
+def get_engine(db_address):
+    """ The engine of this process for a database url, created on first use."""
+    with _lock:
+        engine = _engines.get(db_address)
+        if engine is None:
+            kwargs = {} if db_address.startswith('sqlite') else {'pool_pre_ping': True}
+            engine = create_engine(db_address, echo=False, **kwargs)
+            event.listen(engine, 'connect', lambda *args: _count(db_address, 'connects'))
+            event.listen(engine, 'checkout', lambda *args: _count(db_address, 'checkouts'))
+            _engines[db_address] = engine
+            _sessionmakers[db_address] = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+            _count(db_address, 'engines')
+    return engine
+
+
+def _create_schema(db_address, tables):
+    """ Create the tables if they do not exist, once per process and database url."""
+    key = (db_address, tuple(table.name for table in tables))
+    if key in _schemas:
+        return
+    tables[0].metadata.create_all(get_engine(db_address), tables=tables, checkfirst=True)
+    _count(db_address, 'schema_checks')
+    _schemas.add(key)
+
+
+def connection_stats():
+    """ Per database url: engines created, new database connections, pool checkouts, and schema checks, in this
+        process. With a working pool, connects stays well below checkouts.
+    """
+    return {url: dict(stats) for url, stats in _stats.items()}
+
+
+def _reset_after_fork():
+    # A forked worker must neither use nor close the pooled connections of its parent. Keep the inherited engines
+    # referenced, so they are never garbage collected in the child, and start over with new ones.
+    global _lock
+    _inherited.extend(_engines.values())
+    _engines.clear()
+    _sessionmakers.clear()
+    _stats.clear()
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
 def get_session(db_address, Base=Base):
     """
     Get a connection to the database.
+    The engine and its connection pool are shared by all sessions of this process for the same url.
+    Only the measurement table of Base is created if it does not exist, e.g., Base_v1 for a v1 database to read from.
     Returns
     -------
     session: SQLAlchemy Database Session
     """
-    # Build a new engine for each session. This makes things thread safe.
-    engine = create_engine(db_address, poolclass=pool.NullPool, echo=False)
-    PinholeMeasurement.__table__.create(bind=engine, checkfirst=True)
-    Base.metadata.bind = engine
+    get_engine(db_address)
+    _create_schema(db_address, [Base.metadata.tables[PinholeMeasurement.__tablename__]])
 
     # We don't use autoflush typically. I have run into issues where SQLAlchemy would try to flush
     # incomplete records causing a crash. None of the queries here are large, so it should be ok.
-    db_session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
-    session = db_session()
+    session = _sessionmakers[db_address]()
+    session.info['db_address'] = db_address
     return session
 
 
-def create_db(db_address):
-    # Create an engine for the database
-    engine = create_engine(db_address)
+def create_flexure_table(session):
+    """ Create the flexure statistics table in the database of session if it does not exist, for the code that reads
+        or writes it, see aguflexure.
+    """
+    db_address = session.info.get('db_address')
+    if db_address is None:
+        PinholeFlexureStatistics.__table__.create(session.get_bind(), checkfirst=True)
+    else:
+        _create_schema(db_address, [PinholeFlexureStatistics.__table__])
+
 
+def create_db(db_address):
     # Create all tables in the engine
     # This only needs to be run once on initialization.
-    Base.metadata.create_all(engine)
+    _create_schema(db_address, Base.metadata.sorted_tables)
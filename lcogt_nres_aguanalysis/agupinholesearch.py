@@ -1,51 +1,387 @@
 import argparse
-import concurrent
+import cProfile
+import concurrent.futures
+import datetime
 import faulthandler
+import functools
+import importlib
+import json
 import logging
 import os
 import sys
+import time
 import warnings
 import math
-from concurrent.futures.process import ProcessPoolExecutor
-
-import astropy.stats
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.signal
-from astropy.io import fits
-from astropy.time import Time
-from scipy import ndimage
 
 import lcogt_nres_aguanalysis.agupinholedb as agupinholedb
+from lcogt_nres_aguanalysis import agucentroid, agucutoutstore, aguflexure, agumetrics, agusharedring, aguworkerpool
+from lcogt_nres_aguanalysis import aguautotune
+from lcogt_awsarchiveaccess import lco_archive_utilities
 from lcogt_awsarchiveaccess.lco_archive_utilities import get_frames_by_identifiers, download_from_archive
-from lcogt_awsarchiveaccess.lco_archive_utilities import ArchiveDiskCrawler
+from lcogt_awsarchiveaccess.lco_archive_utilities import iter_frames_from_archive
+from lcogt_awsarchiveaccess.lco_archive_utilities import ArchiveDiskCrawler, ScandirArchiveCrawler, ARCHIVE_ROOT
 
 log = logging.getLogger(__name__)
 
+# archive queries and downloads, in this process and in the workers
+lco_archive_utilities.set_metrics(agumetrics.metrics)
+
 TEMPLATE_FRAMESIZE = 50
 TEMPLATE_RADIUS = 6
 EXTRACT_FRAMESIZE = 60
+# correlate2d in 'same' mode with the even sized template puts the correlation peak one pixel left of and below the
+# pinhole center.
+CORRELATION_OFFSET = 1
 
-def findPinhole(imagename, args, frameid):
-    """
-        Find pinhole by cross-correlation with a template
-        if frameid is not none, fetch from archive
-    """
+# With a prior from the database, only a small window around it is correlated, with a smaller template.
+PRIOR_FRAMESIZE = 20
+PRIOR_TEMPLATE_FRAMESIZE = 15
+# The peak in the prior window is accepted if it is not at the window edge, and the window around it matches a pinhole
+# template of this size, as the normalized cross-correlation, by at least PRIOR_MIN_MATCH. On 200 synthetic frames
+# (agubenchmark prior_acceptance) the match was 0.67 - 0.92 with the prior within 4 pixels of the pinhole, and at most
+# 0.18 with the prior 24 - 35 pixels off; on the test frames ~0.76, and at most 0.12 with the prior 42 pixels off.
+PRIOR_MATCH_FRAMESIZE = 2 * TEMPLATE_RADIUS
+PRIOR_MIN_MATCH = 0.42
+# An accepted peak is then located on the full template correlation of a square of PRIOR_REFINE_HALFWINDOW around it,
+# with the requested centroid engine. The square leaves room for the largest engine window around the peak.
+PRIOR_REFINE_MARGIN = max(agucentroid.COM_HALFWINDOW, agucentroid.DFT_HALFWINDOW)
+PRIOR_REFINE_HALFWINDOW = PRIOR_REFINE_MARGIN + 3
+
+# Known bad pixels per camera; a new camera is an entry in this file.
+BADPIXEL_REGISTRY = os.path.join(os.path.dirname(__file__), 'badpixels.json')
+
+# The background for the star contamination check is sampled every BACKGROUND_STRIDE pixels, BACKGROUND_MARGIN away
+# from the left and right edge of the image, and outside the columns of the search window.
+BACKGROUND_STRIDE = 4
+BACKGROUND_MARGIN = 350
+
+# Imported at first use, not at module load, so the command line and queue coordination start fast. Worker
+# processes forked after preload_pipeline() inherit them.
+PIPELINE_MODULES = ['scipy.signal', 'astropy.io.fits', 'astropy.time']
+
+# Frames downloaded in the main process go to the workers through a shared memory ring with room for this many bytes
+# per frame, ~1.5 MB each; a larger frame is pickled to its worker instead.
+FRAME_SLOT_BYTES = 4 * 1024 * 1024
+
+ntasks = 0
+# the worker side of the ring of findPinHoleInImages
+worker_ring = None
+# aguautotune.WorkerTuner with --ncpu auto
+tuner = None
 
-    log.debug(f"Processing pinhole in {imagename} {frameid}")
 
-    # Create a template
-    y, x = np.ogrid[-TEMPLATE_FRAMESIZE:TEMPLATE_FRAMESIZE, -TEMPLATE_FRAMESIZE:TEMPLATE_FRAMESIZE]
+def preload_pipeline(makepng=False):
+    """ Import the modules of the frame pipeline, and matplotlib if makepng is set, before the process pool forks."""
+    for module in PIPELINE_MODULES + (['matplotlib.pyplot'] if makepng else []):
+        importlib.import_module(module)
+
+
+@functools.lru_cache()
+def make_template(framesize=TEMPLATE_FRAMESIZE):
+    """ Dark disk of TEMPLATE_RADIUS on a bright background, zero-mean, to correlate the pinhole against."""
+    y, x = np.ogrid[-framesize:framesize, -framesize:framesize]
     mask = x * x + y * y <= TEMPLATE_RADIUS * TEMPLATE_RADIUS
-    array = np.ones((TEMPLATE_FRAMESIZE * 2, TEMPLATE_FRAMESIZE * 2))
+    array = np.ones((framesize * 2, framesize * 2))
     array[mask] = -1
     array = array - np.mean(array)
+    return array
 
-    # image
+
+def read_frame(imagename, frameid=None, rows=None, content=None):
+    """ Open an AGU frame from disk, or from the archive if frameid is not None. Returns an astropy HDUList.
+        rows is passed on to download_from_archive to fetch only some image rows, e.g., band_rows.
+        If the file content was fetched already, it is opened from memory, in place, e.g., in a slot of the shared ring.
+    """
+    from astropy.io import fits
+    if content is not None:
+        return fits.open(agusharedring.BufferFile(content))
     if frameid is None:
-        image = fits.open(imagename)
-    else:
-        image = download_from_archive(frameid)
+        return fits.open(imagename)
+    return download_from_archive(frameid, rows=rows)
+
+
+def band_rows(header):
+    """ First and last 0-indexed image row read by read_band, from the compressed image header."""
+    CRPIX2 = int(header['CRPIX2'])
+    return CRPIX2 - EXTRACT_FRAMESIZE, CRPIX2 + EXTRACT_FRAMESIZE - 2
+
+
+@functools.lru_cache()
+def load_badpixels(filename=BADPIXEL_REGISTRY):
+    """ Per camera bad pixel lists from the json registry, loaded once per process.
+        The registry maps a camera name to a list of [x, y] ds9 coordinates (1-indexed) of its bad pixels.
+        Returns a dict camera: (x, y) with 0-indexed pixel coordinate arrays.
+    """
+    with open(filename) as f:
+        registry = json.load(f)
+    badpixels = {}
+    for camera, pixels in registry.items():
+        pixels = np.asarray(pixels, dtype=int).reshape(-1, 2) - 1
+        badpixels[camera] = (pixels[:, 0], pixels[:, 1])
+    return badpixels
+
+
+def fix_badpixels(extractdata, instrument, x0, y0, badpixels=None):
+    """ Patch the registered bad pixels of the camera that fall into the cutout in place, by averaging their left and
+        right neighbours. x0, y0 are the 0-indexed frame coordinates of the cutout's first pixel.
+    """
+    if badpixels is None:
+        badpixels = load_badpixels()
+    for camera, (x, y) in badpixels.items():
+        if camera not in instrument:
+            continue
+        x = x - x0
+        y = y - y0
+        inside = (x >= 0) & (x < extractdata.shape[1]) & (y >= 0) & (y < extractdata.shape[0])
+        if not inside.any():
+            continue
+        x = x[inside]
+        y = y[inside]
+        log.debug(f"Fix {len(x)} bad pixels of {camera} in the cutout")
+        left = extractdata[y, np.maximum(x - 1, 0)]
+        right = extractdata[y, np.minimum(x + 1, extractdata.shape[1] - 1)]
+        # at the cutout border, only the neighbour inside the cutout is used
+        left = np.where(x > 0, left, right)
+        right = np.where(x < extractdata.shape[1] - 1, right, left)
+        extractdata[y, x] = 0.5 * (left + right)
+
+
+def read_band(data, CRPIX2):
+    """ Full width rows of the search window around CRPIX2.
+        data can be an image array, or the section of a (compressed) image HDU so only the tiles of these rows are
+        decompressed. AGU frames are compressed in tiles of one row, so the full rows cost the same as the cutout.
+    """
+    return data[CRPIX2 - EXTRACT_FRAMESIZE: CRPIX2 + (EXTRACT_FRAMESIZE - 1), :]
+
+
+def extract_cutout(data, CRPIX1, CRPIX2, first_row=0):
+    """ Cut out the search window around the CRPIX prior, as float.
+        first_row is the frame row of data[0], e.g., CRPIX2 - EXTRACT_FRAMESIZE for the output of read_band.
+    """
+    return data[CRPIX2 - EXTRACT_FRAMESIZE - first_row: CRPIX2 + (EXTRACT_FRAMESIZE - 1) - first_row,
+                CRPIX1 - EXTRACT_FRAMESIZE: CRPIX1 + (EXTRACT_FRAMESIZE - 1)].astype(float)
+
+
+def estimate_background(data, CRPIX1=None, stride=BACKGROUND_STRIDE):
+    """ Background level of the image, as the median of a strided sample of data away from the left and right edges.
+        data is the band of the search window from read_band, or the full image. With CRPIX1, the columns of the
+        search window are left out, so a star on or near the pinhole does not raise the level it is compared to.
+
+        For the 119 x 675 pixel band and stride 4, the sample has ~4200 pixels outside the search window. The standard
+        error of a sample median is 1 / (2 f sqrt(n)) for a density f at the median, 1.25 sigma / sqrt(n) ~ 0.02 sigma
+        for gaussian noise. Against the previous statistic, the median of the full central [350:-350, 350:-350]
+        region, the test frames differ by < 5 ADU, including the cpt frame with a star on the pinhole (711 vs. 709
+        ADU, cutout mean 1084 ADU); well below the 50 ADU star contamination threshold.
+    """
+    columns = np.arange(BACKGROUND_MARGIN, data.shape[1] - BACKGROUND_MARGIN, stride)
+    if CRPIX1 is not None:
+        columns = columns[(columns < CRPIX1 - EXTRACT_FRAMESIZE) | (columns >= CRPIX1 + EXTRACT_FRAMESIZE - 1)]
+    return np.median(data[::stride][:, columns])
+
+
+def is_star_contaminated(extractdata, imagebackground):
+    """ A star on the pinhole raises the cutout level above the image background."""
+    centerbackground = np.mean(extractdata)
+    if centerbackground > imagebackground + 50:
+        log.info("Elevated background - probably star contamination - ignoring\n"
+                 + " background: % 8.1f  cutout: % 8.1f" % (imagebackground, centerbackground))
+        return True
+    return False
+
+
+def normalize_cutout(extractdata):
+    """ remove outliers (like hot pixels) and normalize data around window, normalize data to [-1 ... +1]
+        Modifies and returns extractdata.
+    """
+    centerbackground = np.median(extractdata)
+    std = np.std(extractdata)
+    extractdata[extractdata > centerbackground + 5 * std] = centerbackground
+    min = np.min(extractdata)
+    max = np.median(extractdata) + 3 * std
+    extractdata[extractdata > max] = max
+
+    extractdata = extractdata - min
+    extractdata = extractdata / (0.5 * (max - min)) - 1
+    return extractdata
+
+
+def correlate_template(extractdata, template):
+    """ Cross-correlate the normalized cutout with the pinhole template."""
+    import scipy.signal
+    return scipy.signal.correlate2d(extractdata, template, boundary='symm', mode='same')
+
+
+def normalize_cutouts(stack):
+    """ normalize_cutout for a stack of cutouts along the first axis. Returns a new array."""
+    stack = np.array(stack, dtype=float)
+    centerbackground = np.median(stack, axis=(1, 2), keepdims=True)
+    std = np.std(stack, axis=(1, 2), keepdims=True)
+    stack = np.where(stack > centerbackground + 5 * std, centerbackground, stack)
+    min = np.min(stack, axis=(1, 2), keepdims=True)
+    max = np.median(stack, axis=(1, 2), keepdims=True) + 3 * std
+    stack = np.minimum(stack, max)
+    return (stack - min) / (0.5 * (max - min)) - 1
+
+
+def correlate_templates(stack, template):
+    """ correlate_template for a stack of normalized cutouts along the first axis, with FFTs.
+        The symmetric boundary of correlate2d is reproduced by padding the cutouts by half the template size.
+        The results agree with correlate_template to ~1e-12, at ~1/100 of the time for the full size template.
+    """
+    import scipy.signal
+    pad = template.shape[0] // 2
+    padded = np.pad(stack, ((0, 0), (pad, pad), (pad, pad)), mode='symmetric')
+    cor = scipy.signal.fftconvolve(padded, template[None, ::-1, ::-1], mode='valid', axes=(1, 2))
+    return cor[:, 1:1 + stack.shape[1], 1:1 + stack.shape[2]]
+
+
+def find_centroid(cor, engine='com'):
+    """ Sub-pixel location of the pinhole from the correlation peak, in 0-indexed cutout pixel coordinates.
+        engine is one of agucentroid.CENTROID_ENGINES.
+        Returns xo, yo, peak_x, peak_y
+    """
+    peak_y, peak_x = np.unravel_index(np.argmax(cor), cor.shape)
+    xo, yo = agucentroid.CENTROID_ENGINES[engine](cor)
+    return xo + CORRELATION_OFFSET, yo + CORRELATION_OFFSET, peak_x, peak_y
+
+
+def locate_in_window(window, template, engine):
+    """ Normalize a window, correlate it with the template, and find the pinhole in it.
+        Returns xo, yo, peak_x, peak_y, cor, normalized window
+    """
+    with agumetrics.timed('normalize'):
+        window = normalize_cutout(window)
+    with agumetrics.timed('correlate'):
+        cor = correlate_template(window, template)
+    with agumetrics.timed('centroid'):
+        xo, yo, peak_x, peak_y = find_centroid(cor, engine)
+    return xo, yo, peak_x, peak_y, cor, window
+
+
+def prior_window(extractdata, prior, CRPIX1, CRPIX2):
+    """ Small window of the cutout centered on the prior pinhole location, in FITS coordinates.
+        Returns the window and its origin within the cutout, or None if the window does not fit into the cutout.
+    """
+    px = int(round(prior[0])) - 1 - (CRPIX1 - EXTRACT_FRAMESIZE)
+    py = int(round(prior[1])) - 1 - (CRPIX2 - EXTRACT_FRAMESIZE)
+    x0, y0 = px - PRIOR_FRAMESIZE, py - PRIOR_FRAMESIZE
+    if (x0 < 0) or (y0 < 0) or (px + PRIOR_FRAMESIZE > extractdata.shape[1]) or \
+            (py + PRIOR_FRAMESIZE > extractdata.shape[0]):
+        return None
+    return extractdata[y0:py + PRIOR_FRAMESIZE - 1, x0:px + PRIOR_FRAMESIZE - 1].copy(), x0, y0
+
+
+def prior_match(window, peak_x, peak_y):
+    """ Normalized cross-correlation of the normalized window around a correlation peak with a pinhole template, 1 for
+        a perfect match. Unlike the height of the peak over the map, it does not depend on what else is in the window.
+    """
+    template = make_template(PRIOR_MATCH_FRAMESIZE)
+    padded = np.pad(window, PRIOR_MATCH_FRAMESIZE, mode='symmetric')
+    x = peak_x + CORRELATION_OFFSET
+    y = peak_y + CORRELATION_OFFSET
+    patch = padded[y:y + 2 * PRIOR_MATCH_FRAMESIZE, x:x + 2 * PRIOR_MATCH_FRAMESIZE]
+    patch = patch - np.mean(patch)
+    norm = np.sqrt(np.sum(patch * patch) * np.sum(template * template))
+    return float(np.sum(patch * template) / norm) if norm > 0 else 0.
+
+
+def is_good_prior_peak(window, cor, peak_x, peak_y):
+    """ The pinhole was found in the prior window if the peak is not at its edge, and the window matches a pinhole
+        there."""
+    margin = TEMPLATE_RADIUS
+    if not (margin <= peak_x < cor.shape[1] - margin and margin <= peak_y < cor.shape[0] - margin):
+        log.debug("Correlation peak at the edge of the prior window")
+        return False
+    match = prior_match(window, peak_x, peak_y)
+    agumetrics.gauge('prior_match', match)
+    if match < PRIOR_MIN_MATCH:
+        log.debug(f"Poor pinhole match at the correlation peak in the prior window: {match:5.2f}")
+        return False
+    return True
+
+
+def refine_near_peak(normalized, template, peak_x, peak_y, engine):
+    """ Correlate the normalized cutout with the template only in a square of PRIOR_REFINE_HALFWINDOW around peak_x,
+        peak_y, and find the centroid there. The values are those of correlate_template on the full cutout, and so is
+        the centroid as long as the peak is PRIOR_REFINE_MARGIN away from the edges of the square within the cutout.
+        Returns the locate_in_window tuple for the square and its origin in the cutout, or None otherwise.
+    """
+    import scipy.signal
+    size = template.shape[0] // 2
+    x0, x1 = max(peak_x - PRIOR_REFINE_HALFWINDOW, 0), min(peak_x + PRIOR_REFINE_HALFWINDOW + 1, normalized.shape[1])
+    y0, y1 = max(peak_y - PRIOR_REFINE_HALFWINDOW, 0), min(peak_y + PRIOR_REFINE_HALFWINDOW + 1, normalized.shape[0])
+    with agumetrics.timed('correlate'):
+        # correlate2d in 'same' mode with the symmetric boundary is the 'valid' correlation of the padded cutout,
+        # shifted by a pixel for the even sized template; see correlate_templates.
+        padded = np.pad(normalized, size, mode='symmetric')
+        cor = scipy.signal.correlate2d(padded[y0 + 1:y1 + 2 * size, x0 + 1:x1 + 2 * size], template, mode='valid')
+    peak_y, peak_x = np.unravel_index(np.argmax(cor), cor.shape)
+    if ((x0 > 0) and (peak_x < PRIOR_REFINE_MARGIN)) or ((y0 > 0) and (peak_y < PRIOR_REFINE_MARGIN)) or \
+            ((x1 < normalized.shape[1]) and (cor.shape[1] - peak_x < PRIOR_REFINE_MARGIN)) or \
+            ((y1 < normalized.shape[0]) and (cor.shape[0] - peak_y < PRIOR_REFINE_MARGIN)):
+        log.debug("Full template correlation peak too close to the edge of the refine window")
+        return None
+    with agumetrics.timed('centroid'):
+        xo, yo, peak_x, peak_y = find_centroid(cor, engine)
+    return (xo, yo, peak_x, peak_y, cor, normalized[y0:y1, x0:x1]), x0, y0
+
+
+def locate_near_prior(extractdata, prior, CRPIX1, CRPIX2, engine):
+    """ Look for the pinhole with the small template in the window around the prior, and if it is there, locate it
+        with the full template in a small square around it. The result is that of the full cutout search, at a
+        fraction of the correlation cost.
+        Returns the locate_in_window tuple and the origin of its window in the cutout, or None to search the full
+        cutout.
+    """
+    window = prior_window(extractdata, prior, CRPIX1, CRPIX2)
+    if window is None:
+        return None
+    window, x0, y0 = window
+    with agumetrics.timed('normalize'):
+        window = normalize_cutout(window)
+    with agumetrics.timed('correlate'):
+        cor = correlate_template(window, make_template(PRIOR_TEMPLATE_FRAMESIZE))
+    peak_y, peak_x = np.unravel_index(np.argmax(cor), cor.shape)
+    if not is_good_prior_peak(window, cor, peak_x, peak_y):
+        return None
+    with agumetrics.timed('normalize'):
+        normalized = normalize_cutout(extractdata.copy())
+    return refine_near_peak(normalized, make_template(), x0 + peak_x, y0 + peak_y, engine)
+
+
+class PinholePriors:
+    """ Recent pinhole location of each camera from the database, looked up once per crawl and then cached."""
+
+    def __init__(self, dbsession):
+        self.dbsession = dbsession
+        self.cache = {}
+
+    def get(self, camera):
+        camera = os.path.basename(camera)
+        if camera not in self.cache:
+            self.cache[camera] = agupinholedb.get_recent_location(self.dbsession, camera)
+            log.info(f"Prior pinhole location for {camera}: {self.cache[camera]}")
+        return self.cache[camera]
+
+
+def findPinhole(imagename, args, frameid, prior=None, content=None, cutouts=None):
+    """
+        Find pinhole by cross-correlation with a template
+        if frameid is not none, fetch from archive, unless the file content is given already
+        If a prior location x, y is given, only a small window around it is searched first, falling back to the
+        full cutout if the pinhole is not found there.
+        If cutouts is a list, the raw cutout and its metadata are appended to it for the cutout store.
+    """
+
+    from astropy.time import Time
+
+    log.debug(f"Processing pinhole in {imagename} {frameid}")
+
+    # image
+    with agumetrics.timed('open'):
+        image = read_frame(imagename, frameid, rows=band_rows if getattr(args, 'rangefetch', False) else None,
+                           content=content)
 
     # CRPIX1/2 is an ok prior for the pinhole location within 10 pixels at least.
     CRPIX1 = int(image[1].header['CRPIX1'])
@@ -62,60 +398,45 @@ def findPinhole(imagename, args, frameid):
     if (alt == 'UNKNOWN') or (az == ' UNKNOWN'):
         return None
 
-    if 'ak05' in instrument:
-        # fix central hot pixel
-        log.debug("Fix ak05 hot pixel")
-        hpx = 716 - 1 # ds9 coordinate, 1-indexed.
-        hpy = 590 - 1
-        image[1].data[hpy, hpx] = 1 / 2. * (image[1].data[hpy, hpx + 1] + image[1].data[hpy, hpx - 1])
-    if 'ak16' in instrument:
-        # fix central hot pixel
-        log.debug("Fix ak05 hot pixel")
-        hpx = 609 - 1 # ds9 coordinate, 1-indexed.
-        hpy = 548 - 1
-        image[1].data[hpy, hpx] = 1 / 2. * (image[1].data[hpy, hpx + 1] + image[1].data[hpy, hpx - 1])
-
-    extractdata = image[1].data[CRPIX2 - EXTRACT_FRAMESIZE: CRPIX2 + (EXTRACT_FRAMESIZE-1),
-                  CRPIX1 - EXTRACT_FRAMESIZE: CRPIX1 + (EXTRACT_FRAMESIZE-1)].astype(float)
-
-    imagebackground = np.median(image[1].data[350:-350, 350:-350])
+    # read through the section so only the tiles we need are decompressed, never the full frame.
+    with agumetrics.timed('decompress'):
+        band = read_band(image[1].section, CRPIX2)
     image.close()
+    extractdata = extract_cutout(band, CRPIX1, CRPIX2, first_row=CRPIX2 - EXTRACT_FRAMESIZE)
+    rawcutout = extractdata.astype(agucutoutstore.CUTOUT_DTYPE) if cutouts is not None else None
+    with agumetrics.timed('hotpixel'):
+        fix_badpixels(extractdata, instrument, CRPIX1 - EXTRACT_FRAMESIZE, CRPIX2 - EXTRACT_FRAMESIZE)
 
-    # check if pinhole is illuminated by star. if so, reject
-    centerbackground = np.mean(extractdata)
-    if centerbackground > imagebackground + 50:
-        log.info("Elevated background - probably star contamination - ignoring\n"
-                 + " background: % 8.1f  cutout: % 8.1f" % (imagebackground, centerbackground))
-        return None
+    with agumetrics.timed('background'):
+        imagebackground = estimate_background(band, CRPIX1)
 
-    # remove outliers (like hot pixels) and normalize data around window, normalize data to [-1 ... +1]
-    centerbackground = np.median(extractdata)
-    std = np.std (extractdata)
-    extractdata[extractdata > centerbackground + 5 * std] = centerbackground
-    min = np.min(extractdata)
-    max = np.median(extractdata) + 3 * std
-    extractdata[extractdata>max] = max
+    if cutouts is not None:
+        cutouts.append(agucutoutstore.make_record(rawcutout, os.path.basename(str(imagename)), instrument,
+                                                  f'{site}-{enclosure}-{telescope}', do, alt, az, foctemp, CRPIX1,
+                                                  CRPIX2, imagebackground))
 
-    extractdata = extractdata - min
-    extractdata = extractdata / (0.5 * (max - min)) - 1
+    # check if pinhole is illuminated by star. if so, reject
+    if is_star_contaminated(extractdata, imagebackground):
+        agumetrics.count('rejected_star')
+        return None
 
     # correlate and find centroid of correlation
-    cor = scipy.signal.correlate2d(extractdata, array, boundary='symm', mode='same')
-    peak_y, peak_x = np.unravel_index(np.argmax(cor), cor.shape)
-    center = ndimage.measurements.center_of_mass(cor[peak_y - TEMPLATE_RADIUS*3:peak_y + TEMPLATE_RADIUS*3, peak_x - TEMPLATE_RADIUS*3: peak_x + TEMPLATE_RADIUS*3])
-
-    xo = center[1] + (peak_x - TEMPLATE_RADIUS*3) + 1 # needed to center the coordinate. not sure why.
-    yo = center[0] + (peak_y - TEMPLATE_RADIUS*3) + 1
-
-    peak_x + peak_x + 1
-    peak_y + peak_y + 1
+    engine = getattr(args, 'centroid', 'com')
+    located = None
+    if prior is not None:
+        located = locate_near_prior(extractdata, prior, CRPIX1, CRPIX2, engine)
+        agumetrics.count('prior_fallback' if located is None else 'prior_used')
+    if located is None:
+        located = locate_in_window(extractdata, make_template(), engine), 0, 0
+    (xo, yo, peak_x, peak_y, cor, extractdata), x0, y0 = located
 
-    x =  xo + (CRPIX1 - EXTRACT_FRAMESIZE) + 1 # IRAF / FITS starts at pixel 1, and is center of pixel
-    y =  yo + (CRPIX2 - EXTRACT_FRAMESIZE) + 1
+    x =  xo + x0 + (CRPIX1 - EXTRACT_FRAMESIZE) + 1 # IRAF / FITS starts at pixel 1, and is center of pixel
+    y =  yo + y0 + (CRPIX2 - EXTRACT_FRAMESIZE) + 1
 
     ## FITS starts stuff at 1
 
     if args.makepng:
+        import matplotlib.pyplot as plt
 
         plt.imshow(cor)
         plt.plot(peak_x, peak_y, 'x', color='red')
@@ -134,49 +455,440 @@ def findPinhole(imagename, args, frameid):
         plt.savefig(f"center-{os.path.basename (imagename)}.png", dpi=300)
         plt.close()
 
-    measurement = agupinholedb.PinholeMeasurement(imagename=str(imagename), instrument=instrument, altitude=alt,
+    measurement = agupinholedb.PinholeMeasurement(imagename=os.path.basename(str(imagename)), instrument=instrument, altitude=alt,
                                                   azimut=az, xcenter=x if math.isfinite(x) else None, ycenter=y if math.isfinite(y) else None, dateobs=do, foctemp=foctemp,
                                                   telescopeidentifier=f'{site}-{enclosure}-{telescope}', crpix1=CRPIX1, crpix2=CRPIX2)
     log.info(f"Measurement: {measurement}")
     return measurement
 
 
-def findPinHoleInImages(imagelist, dbsession, args):
+def frame_slot_dtype(contentbytes=FRAME_SLOT_BYTES):
+    """ Shared ring slot of one frame task: the file content in, and the raw cutout and its cutout store record out."""
+    return np.dtype([('contentsize', 'i8'), ('content', 'u1', (contentbytes,)), ('ncutouts', 'i4'),
+                     ('cutout', agucutoutstore.CUTOUT_DTYPE, agucutoutstore.CUTOUT_SHAPE),
+                     ('index', agucutoutstore.INDEX_DTYPE)], align=True)
+
+
+def set_worker_ring(ring):
+    """ Worker initializer of findPinHoleInImages."""
+    global worker_ring
+    worker_ring = ring
+
+
+def findPinholeTask(imagename, args, frameid, profile=False, prior=None, content=None, slot=None):
+    """ Worker side of findPinHoleInImages: findPinhole, plus the metrics recorded in this worker for this frame.
+        If profile is set, the task runs under cProfile and the stats are dumped into args.profile_dir.
+        With a slot of the shared ring, the file content is read from it, unless given, and the cutout store record
+        is written to it instead of returned.
+        Returns measurement, metrics snapshot, cutout store records
+    """
+    agumetrics.metrics.reset()
+    cutouts = [] if getattr(args, 'cutoutstore', None) is not None else None
+    if slot is not None and content is None and worker_ring.slots['contentsize'][slot] > 0:
+        content = worker_ring.slots['content'][slot, :worker_ring.slots['contentsize'][slot]]
+    profiler = cProfile.Profile() if profile else None
+    cpustart = time.process_time()
+    with agumetrics.timed('frame'):
+        if profiler is not None:
+            profiler.enable()
+        try:
+            measurement = findPinhole(imagename, args, frameid, prior, content, cutouts)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(args.profile_dir, f'profile-{os.path.basename(imagename)}.prof'))
+            agumetrics.observe('frame_cpu', time.process_time() - cpustart)
+    if slot is not None and cutouts:
+        worker_ring.slots['cutout'][slot], worker_ring.slots['index'][slot] = cutouts[-1]
+        worker_ring.slots['ncutouts'][slot] = 1
+        cutouts = None
+    return measurement, agumetrics.metrics.snapshot(), cutouts
+
+
+def findPinHoleInImages(imagelist, dbsession, args, prior=None):
+    """ Measure the pinhole in a list of images in a process pool, and write the results to the database.
+        Each frame gets args.fetchdeadline seconds for its download and args.taskdeadline seconds in the pool. A frame
+        over its deadline, or whose worker died, is given up and left for a retry.
+        Downloaded frames and the cutouts for the store cross to and from the workers in a shared memory ring with a
+        slot per task in flight, see agusharedring, so only slot indices are pickled.
+        With --ncpu auto, the tuner sets the number of workers and downloads in flight first.
+        Returns the lists of image names that failed with an exception, and that timed out or crashed.
+    """
+    if tuner is not None:
+        tuner.tune(args)
     results = []
-    futures = []
-
-    # TODO: This makes the out for loop give up.
-    with ProcessPoolExecutor(max_workers=args.ncpu) as e:
-        for image in imagelist:
-            imagefilename = os.path.basename(str(image['filename']))
-            imageid = int(image['frameid']) if args.useaws else None
-            log.debug(f'Extracted file info: {imagefilename}  {imageid}')
-            if (args.reprocess is False) and (dbsession is not None):
-                # test if image has been processed already.
-                if agupinholedb.doesRecordExists(dbsession, imagefilename):
-                    log.debug("Image %s already has a record in database, skipping" % image)
-                    continue
-
-            futures.append(e.submit(findPinhole, imagefilename, args, imageid))
-
-        e.shutdown(wait=True)
-
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                results.append(future.result())
-            except:
-                log.exception("While reading back future)")
-
-    for datum in results:
-        if datum is not None:
+    cutouts = []
+    failed = []
+    retry = []
+
+    todo = []
+    for image in imagelist:
+        imagefilename = os.path.basename(str(image['filename']))
+        imageid = int(image['frameid']) if args.useaws else None
+        log.debug(f'Extracted file info: {imagefilename}  {imageid}')
+        if (args.reprocess is False) and (dbsession is not None):
+            # test if image has been processed already.
+            with agumetrics.timed('db_lookup'):
+                exists = agupinholedb.doesRecordExists(dbsession, imagefilename)
+            if exists:
+                log.debug("Image %s already has a record in database, skipping" % image)
+                agumetrics.count('skipped_existing')
+                continue
+        todo.append((str(image['filename']), imagefilename, imageid))
+
+    fetchconcurrency = getattr(args, 'fetchconcurrency', 0) if args.useaws else 0
+    if fetchconcurrency > 0:
+        # download in the parent with many transfers in flight, and hand the content to the workers as it arrives.
+        names = {imageid: (filename, imagefilename) for filename, imagefilename, imageid in todo}
+        rows = band_rows if getattr(args, 'rangefetch', False) else None
+        work = ((*names[frameid], frameid, content)
+                for frameid, content in iter_frames_from_archive(list(names), fetchconcurrency, rows=rows,
+                                                                 deadline=getattr(args, 'fetchdeadline', None) or None))
+    else:
+        work = ((filename, imagefilename, imageid, None) for filename, imagefilename, imageid in todo)
+
+    ring = None
+    if fetchconcurrency > 0 or getattr(args, 'cutoutstore', None) is not None:
+        # one slot per task in flight, and as many again for the results that are being read back
+        ring = agusharedring.SharedRing(2 * max(args.ncpu, 1),
+                                        frame_slot_dtype(FRAME_SLOT_BYTES if fetchconcurrency > 0 else 0))
+    slots = {}
+
+    def tasks():
+        global ntasks
+        for filename, imagefilename, imageid, content in work:
+            if isinstance(content, TimeoutError):
+                retry.append(imagefilename)
+                continue
+            if isinstance(content, Exception):
+                agumetrics.count('failed')
+                failed.append(imagefilename)
+                continue
+            profile = args.profile and (ntasks % args.profile_sample == 0)
+            ntasks += 1
+            slot = None
+            if ring is not None:
+                slot = slots[imagefilename] = ring.acquire()
+                ring.slots['ncutouts'][slot] = 0
+                ring.slots['contentsize'][slot] = 0
+                if content is not None and len(content) <= ring.dtype['content'].shape[0]:
+                    ring.slots['content'][slot, :len(content)] = np.frombuffer(content, dtype=np.uint8)
+                    ring.slots['contentsize'][slot] = len(content)
+                    content = None
+                elif content is not None:
+                    agumetrics.count('ring_overflow')
+            yield imagefilename, (filename, args, imageid, profile, prior, content, slot)
+
+    preload_pipeline(args.makepng)
+    pool = aguworkerpool.DeadlinePool(findPinholeTask, nworkers=args.ncpu,
+                                      deadline=getattr(args, 'taskdeadline', None),
+                                      initializer=set_worker_ring, initargs=(ring,))
+    try:
+        for result in pool.map(tasks()):
+            slot = slots.pop(result.key, None)
+            if result.outcome == 'done':
+                measurement, workermetrics, records = result.value
+                agumetrics.metrics.merge(workermetrics)
+                results.append(measurement)
+                if records is not None:
+                    cutouts.extend(records)
+                if slot is not None and ring.slots['ncutouts'][slot] > 0:
+                    cutouts.append((ring.slots['cutout'][slot].copy(), ring.slots['index'][slot].copy()))
+            elif result.outcome == 'error':
+                agumetrics.count('failed')
+                failed.append(result.key)
+                log.error(f"While measuring {result.key}: {result.value}")
+            else:
+                retry.append(result.key)
+            if slot is not None:
+                # a timed out or crashed worker is gone already, nothing writes to the slot anymore
+                ring.release(slot)
+    finally:
+        if ring is not None:
+            ring.close()
+
+    with agumetrics.timed('db_write'):
+        flexure = aguflexure.StatisticsUpdate()
+        results = [datum for datum in results if datum is not None]
+        for datum in results:
             log.info("Adding to database: %s " % datum)
-            try:
-                dbsession.merge(datum)
-            except:
-                log.warn (f"Could not add datum: {datum}")
+        flexure.merge_all(dbsession, results)
+        agumetrics.count('measurements', len(results))
+        flexure.apply(dbsession)
+        dbsession.commit()
 
-    dbsession.commit()
-    return None
+    if len(cutouts) > 0:
+        # the store has one writer, this process.
+        with agumetrics.timed('cutout_write'):
+            agumetrics.count('cutouts_stored', agucutoutstore.CutoutStore(args.cutoutstore).append(cutouts))
+    if len(retry) > 0:
+        log.warning(f"{len(retry)} frames timed out or crashed and are left for a retry")
+    return failed, retry
+
+
+def processFiles(camera, date, files, dbsession, args, priors=None):
+    """ Measure the files of a camera and night, or put them into the work queue with --queue enqueue.
+        Returns the lists of image names that failed, and that timed out or crashed and were queued for a retry.
+    """
+    log.info(f'         {camera} / {date} has {len(files) if files is not None else "None"} images.')
+    if (files is not None) and (len(files) > 0):
+        if getattr(args, 'queue', None) == 'enqueue':
+            # coordinator: leave the work to the queue workers
+            agupinholedb.enqueue_work(dbsession, [(image['filename'], int(image['frameid']) if args.useaws else None,
+                                                   os.path.basename(camera)) for image in files],
+                                      skipmeasured=not args.reprocess)
+            return [], []
+        failed, retry = findPinHoleInImages(files, dbsession, args,
+                                            prior=priors.get(camera) if priors is not None else None)
+        if len(retry) > 0:
+            # a queue worker, `--queue work`, picks them up; so does the next crawl, as they have no measurement yet.
+            retry = set(retry)
+            agupinholedb.enqueue_work(dbsession, [(image['filename'], int(image['frameid']) if args.useaws else None,
+                                                   os.path.basename(camera)) for image in files
+                                                  if os.path.basename(str(image['filename'])) in retry])
+        return failed, list(retry)
+    return [], []
+
+
+def processQueue(dbsession, args, priors=None):
+    """ Queue worker: claim batches of frames from the database work queue and process them, until no frame is queued
+        or leased anymore. Any number of workers on any number of nodes can share one queue.
+    """
+    owner = agupinholedb.default_lease_owner()
+    log.info(f"Working on the queue as {owner}")
+    while True:
+        agupinholedb.requeue_expired(dbsession)
+        with agumetrics.timed('queue_claim'):
+            items = agupinholedb.claim_work(dbsession, owner, batchsize=args.batchsize, leaseseconds=args.leaseseconds)
+        if len(items) == 0:
+            if agupinholedb.count_work(dbsession).get('leased', 0) == 0:
+                break
+            # other workers still hold leases; wait until they are done or expire.
+            time.sleep(min(30, args.leaseseconds))
+            continue
+        agumetrics.count('queue_claimed', len(items))
+        failed = []
+        retry = []
+        for camera in sorted(set(item.instrument for item in items)):
+            files = [{'filename': item.filename, 'frameid': item.frameid if item.frameid is not None else -1}
+                     for item in items if item.instrument == camera]
+            camerafailed, cameraretry = findPinHoleInImages(files, dbsession, args,
+                                                            prior=priors.get(camera) if priors is not None else None)
+            failed.extend(camerafailed)
+            retry.extend(cameraretry)
+        agupinholedb.complete_work(dbsession, [item.imagename for item in items
+                                               if item.imagename not in failed and item.imagename not in retry], owner)
+        agupinholedb.complete_work(dbsession, failed, owner, state='failed')
+        agupinholedb.release_work(dbsession, retry, owner)
+    log.info(f"Work queue is empty: {agupinholedb.count_work(dbsession)}")
+
+
+def month_chunks(first, last):
+    """ (first, last) day-obs, as YYYYMMDD, of each calendar month from first to last, clipped to the range."""
+    start = datetime.datetime.strptime(first, '%Y%m%d').date()
+    end = datetime.datetime.strptime(last, '%Y%m%d').date()
+    chunks = []
+    while start <= end:
+        nextmonth = (start.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        chunks.append((start.strftime('%Y%m%d'), min(nextmonth - datetime.timedelta(days=1), end).strftime('%Y%m%d')))
+        start = nextmonth
+    return chunks
+
+
+def list_chunk(crawler, camera, first, last, args):
+    """ The frames of a camera from day-obs first to last: one archive query in AWS mode, one listing per night on
+        disk. Returns a list of {'filename', 'frameid'} records.
+    """
+    with agumetrics.timed('backfill_listing'):
+        if args.useaws:
+            files = get_frames_by_identifiers(first, camera=camera, mintexp=5, obstype='EXPERIMENTAL', rlevel=0,
+                                              lastdayobs=last)
+            return list(files) if files is not None else []
+        start = datetime.datetime.strptime(first, '%Y%m%d')
+        ndays = (datetime.datetime.strptime(last, '%Y%m%d') - start).days + 1
+        dates = [(start + datetime.timedelta(days=ii)).strftime('%Y%m%d') for ii in range(ndays)]
+        files = []
+        if args.diskcrawler == 'glob':
+            for date in dates:
+                nightfiles = ArchiveDiskCrawler.findfiles_for_camera_dates(camera, date, 'raw', "*[x]00.fits*")
+                files.extend(nightfiles if nightfiles is not None else [])
+        else:
+            for sitecamera, date, nightfiles in crawler.iter_files_for_cameras_dates([camera], dates, 'raw',
+                                                                                      "*[x]00.fits*"):
+                files.extend(nightfiles)
+        return files
+
+
+class BackfillProgress:
+    """ Checkpoint of a backfill, a json file with the chunks of a camera and month done so far, written after each
+        chunk. A run that is interrupted and started again with the same file skips them.
+        A chunk with frames that failed or timed out is not done; its pending frames are kept instead, and a run
+        started again processes only those.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = {}
+        self.pending = {}
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                checkpoint = json.load(f)
+            self.done = checkpoint['done']
+            self.pending = checkpoint.get('pending', {})
+        self.started = time.monotonic()
+        self.frames = 0
+
+    @staticmethod
+    def key(camera, first, last):
+        return f'{os.path.basename(camera)}:{first}-{last}'
+
+    def complete(self, key, nframes, seconds, pending=None):
+        """ Record a processed chunk as done, or, with a list of {'filename', 'frameid'} records of frames that failed
+            or timed out, as pending those.
+        """
+        if pending:
+            self.pending[key] = pending
+        else:
+            self.pending.pop(key, None)
+            self.done[key] = {'frames': nframes, 'seconds': round(seconds, 1),
+                              'finished': datetime.datetime.utcnow().isoformat(timespec='seconds')}
+        self.frames += nframes
+        if self.filename is None:
+            return
+        # replace, so an interrupted write does not lose the checkpoint
+        tmpfile = f'{self.filename}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'done': self.done, 'pending': self.pending}, f, indent=1)
+        os.replace(tmpfile, self.filename)
+
+    def rate(self):
+        """ Frames per second of this run."""
+        elapsed = time.monotonic() - self.started
+        return self.frames / elapsed if elapsed > 0 else 0.
+
+    def eta(self, remaining):
+        """ Seconds left for remaining chunks of the mean size of the chunks done, at this run's rate, or None."""
+        rate = self.rate()
+        if rate <= 0 or len(self.done) == 0:
+            return None
+        perchunk = sum(chunk['frames'] for chunk in self.done.values()) / len(self.done)
+        return remaining * perchunk / rate
+
+
+def backfill(crawler, cameras, dbsession, args, priors=None):
+    """ Process all frames of cameras from day-obs args.backfill[0] to args.backfill[1], in chunks of a camera and
+        calendar month. The frame list of the next chunk is fetched in a thread while the current chunk is processed,
+        in batches of args.backfillbatch frames. Each completed chunk goes into the args.backfillcheckpoint file, and is
+        skipped when the backfill is started again. Of a chunk with frames that failed or timed out, only those are
+        processed again.
+    """
+    first, last = args.backfill
+    progress = BackfillProgress(args.backfillcheckpoint)
+    chunks = [(camera, chunkfirst, chunklast) for camera in cameras
+              for chunkfirst, chunklast in month_chunks(first, last)]
+    todo = [chunk for chunk in chunks if progress.key(*chunk) not in progress.done]
+    log.info(f"Backfill from {first} to {last}: {len(chunks)} chunks of a camera and month, "
+             f"{len(chunks) - len(todo)} done before, {len(progress.pending)} with frames pending")
+    if len(todo) == 0:
+        return
+
+    def chunk_files(camera, chunkfirst, chunklast):
+        pending = progress.pending.get(progress.key(camera, chunkfirst, chunklast))
+        return pending if pending is not None else list_chunk(crawler, camera, chunkfirst, chunklast, args)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as prefetch:
+        listing = prefetch.submit(chunk_files, *todo[0])
+        for ii, (camera, chunkfirst, chunklast) in enumerate(todo):
+            with agumetrics.timed('backfill_listing_wait'):
+                files = listing.result()
+            if ii + 1 < len(todo):
+                listing = prefetch.submit(chunk_files, *todo[ii + 1])
+            start = time.monotonic()
+            unfinished = set()
+            for batch in range(0, len(files), args.backfillbatch):
+                failed, retry = processFiles(camera, f'{chunkfirst}-{chunklast}',
+                                             files[batch:batch + args.backfillbatch], dbsession, args, priors)
+                unfinished.update(failed, retry)
+            pending = [{'filename': str(image['filename']), 'frameid': str(image['frameid'])} for image in files
+                       if os.path.basename(str(image['filename'])) in unfinished]
+            progress.complete(progress.key(camera, chunkfirst, chunklast), len(files), time.monotonic() - start,
+                              pending=pending)
+            agumetrics.count('backfill_pending' if pending else 'backfill_chunks')
+
+            remaining = len(todo) - ii - 1
+            eta = progress.eta(remaining)
+            state = f'has {len(pending)} frames failed or timed out' if pending else 'done'
+            message = f"Backfill: {camera} {chunkfirst}-{chunklast} {state}, {len(files)} frames in " \
+                      f"{time.monotonic() - start:.0f} s; {progress.rate():.2f} frames/s, {remaining} chunks left"
+            if remaining > 0 and eta is not None:
+                finish = datetime.datetime.utcnow() + datetime.timedelta(seconds=eta)
+                message += f", ETA {eta / 3600:.1f} h ({finish.strftime('%Y-%m-%d %H:%M')} UTC)"
+            log.info(message)
+
+
+def recentroid_batch(index, cutouts, engine='com'):
+    """ The pinhole search of findPinhole, from the bad pixel fix on, for a batch of cutouts from the cutout store.
+        Normalization and correlation run on the whole batch at once. The prior window is not used.
+        Returns a list of PinholeMeasurements, without the frames rejected for star contamination.
+    """
+    data = np.array(cutouts, dtype=float)
+    with agumetrics.timed('hotpixel'):
+        for ii in range(len(data)):
+            fix_badpixels(data[ii], index['instrument'][ii].decode(), index['crpix1'][ii] - EXTRACT_FRAMESIZE,
+                          index['crpix2'][ii] - EXTRACT_FRAMESIZE)
+    contaminated = np.mean(data, axis=(1, 2)) > index['background'] + 50
+    agumetrics.count('rejected_star', int(np.sum(contaminated)))
+    index = index[~contaminated]
+    if len(index) == 0:
+        return []
+    with agumetrics.timed('normalize'):
+        data = normalize_cutouts(data[~contaminated])
+    with agumetrics.timed('correlate'):
+        cor = correlate_templates(data, make_template())
+
+    measurements = []
+    with agumetrics.timed('centroid'):
+        for ii, record in enumerate(index):
+            xo, yo, peak_x, peak_y = find_centroid(cor[ii], engine)
+            x = xo + (record['crpix1'] - EXTRACT_FRAMESIZE) + 1
+            y = yo + (record['crpix2'] - EXTRACT_FRAMESIZE) + 1
+            measurements.append(agupinholedb.PinholeMeasurement(
+                imagename=record['imagename'].decode(), instrument=record['instrument'].decode(),
+                telescopeidentifier=record['telescopeidentifier'].decode(), altitude=float(record['altitude']),
+                azimut=float(record['azimut']), xcenter=float(x) if math.isfinite(x) else None,
+                ycenter=float(y) if math.isfinite(y) else None, dateobs=record['dateobs'].astype(object),
+                foctemp=float(record['foctemp']), crpix1=int(record['crpix1']), crpix2=int(record['crpix2'])))
+    return measurements
+
+
+def recentroidStore(dbsession, args):
+    """ Re-measure all frames in the cutout store, or those of --single, and overwrite their database records.
+        Needs no archive access.
+    """
+    store = agucutoutstore.CutoutStore(args.cutoutstore)
+    cameras = [args.single] if args.single is not None else None
+    nmeasured = 0
+    for camera, index, cutouts in store.iter_batches(cameras, batchsize=args.recentroidbatch):
+        with agumetrics.timed('recentroid_batch'):
+            measurements = recentroid_batch(index, cutouts, args.centroid)
+        with agumetrics.timed('db_write'):
+            flexure = aguflexure.StatisticsUpdate()
+            flexure.merge_all(dbsession, measurements)
+            flexure.apply(dbsession)
+            dbsession.commit()
+        agumetrics.count('measurements', len(measurements))
+        nmeasured += len(measurements)
+        log.info(f"{camera}: re-measured {len(measurements)} of {len(index)} cutouts, {nmeasured} in total")
+    return nmeasured
+
+
+def ncpu_count(value):
+    return value if value == 'auto' else int(value)
+
+
+def dayobs(value):
+    datetime.datetime.strptime(value, '%Y%m%d')
+    return value
 
 
 def parseCommandLine():
@@ -189,26 +901,92 @@ def parseCommandLine():
     parser.add_argument('--loglevel', dest='log_level', default='INFO', choices=['DEBUG', 'INFO'],
                         help='Set the debug level')
     parser.add_argument('--database', default='sqlite:///agupinholelocations.sqlite')
-    parser.add_argument('--ncpu', default=1, type=int)
+    parser.add_argument('--ncpu', default=1, type=ncpu_count,
+                        help="Worker processes, or auto to size the workers, and with --useaws the downloads in the "
+                             "main process, from the measured I/O wait and compute time per frame within the cgroup "
+                             "CPU and memory limits")
     parser.add_argument('--reprocess', action='store_true')
     parser.add_argument('--makepng', action='store_true')
     parser.add_argument('--useaws', action='store_true')
+    parser.add_argument('--rangefetch', action='store_true',
+                        help="With --useaws, fetch only the headers and the compressed tiles of the search window with "
+                             "HTTP range requests instead of the full frame")
+    parser.add_argument('--fetchconcurrency', default=0, type=int,
+                        help="With --useaws, download frames in the main process with this many concurrent requests "
+                             "and pass them to the workers. 0: each worker downloads its own frames")
+    parser.add_argument('--fetchdeadline', default=120, type=float,
+                        help="With --fetchconcurrency, seconds a frame download may take before it is given up and "
+                             "left for a retry. 0: no limit")
+    parser.add_argument('--taskdeadline', default=300, type=float,
+                        help="Seconds a frame may take in a worker, including its download without --fetchconcurrency, "
+                             "before the worker is replaced and the frame left for a retry. 0: no limit")
+    parser.add_argument('--useprior', action='store_true',
+                        help='Search a small window around the recent pinhole location from the database first')
+    parser.add_argument('--centroid', default='com', choices=list(agucentroid.CENTROID_ENGINES),
+                        help='Sub-pixel peak finder on the correlation map')
 
     parser.add_argument('--ndays', default=3, type=int, help="How many days to look into the past")
+    parser.add_argument('--backfill', default=None, type=dayobs, nargs=2, metavar=('START', 'END'),
+                        help="Process all frames from day-obs START to END (YYYYMMDD) in chunks of a camera and month, "
+                             "instead of the last --ndays")
+    parser.add_argument('--backfillcheckpoint', default='agubackfill-checkpoint.json',
+                        help="Chunks of a --backfill done so far; a backfill started again skips them")
+    parser.add_argument('--backfillbatch', default=1000, type=int,
+                        help="Frames per batch within a --backfill chunk")
     parser.add_argument('--cameratype', type=str, nargs='+', default=['ak??', ],
                         help='Type of cameras to parse')
     parser.add_argument('--single', default = None)
+    parser.add_argument('--archiveroot', default=ARCHIVE_ROOT, help="Root of the /archive mount for disk mode")
+    parser.add_argument('--diskcrawler', default='scandir', choices=['scandir', 'glob'],
+                        help="How to list the /archive directories in disk mode")
+    parser.add_argument('--crawlthreads', default=16, type=int, help="Concurrent directory listings in disk mode")
+    parser.add_argument('--listingcache', default=None,
+                        help="json file to cache past days' directory listings in between runs")
+    parser.add_argument('--metrics-file', dest='metrics_file', default=None,
+                        help='Write run metrics to this file at the end; json, or Prometheus textfile if it ends in .prom')
+    parser.add_argument('--queue', default=None, choices=['enqueue', 'work'],
+                        help="Distributed crawl: enqueue the listed frames into the database work queue, or claim "
+                             "and process frames from it until it is empty")
+    parser.add_argument('--batchsize', default=20, type=int, help="Frames per claim from the work queue")
+    parser.add_argument('--leaseseconds', default=900, type=int,
+                        help="Claimed frames that are not done after this time are queued again")
+    parser.add_argument('--cutoutstore', default=None,
+                        help="Directory of the local cutout store. Every processed frame's search window cutout is "
+                             "saved there")
+    parser.add_argument('--recentroid', action='store_true',
+                        help="Re-measure all frames of the --cutoutstore, or of the --single camera, and overwrite "
+                             "their database records. No archive access")
+    parser.add_argument('--recentroidbatch', default=256, type=int,
+                        help="Cutouts per vectorized batch with --recentroid")
+    parser.add_argument('--profile', action='store_true', help='cProfile a sample of the worker tasks')
+    parser.add_argument('--profile-sample', dest='profile_sample', default=20, type=int,
+                        help='With --profile, profile every n-th task')
+    parser.add_argument('--profile-dir', dest='profile_dir', default='.', help='Where to write the .prof files')
     args = parser.parse_args()
     logging.basicConfig(level=getattr(logging, args.log_level.upper()),
                         format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
     log.debug("cameratype: {} ".format(args.cameratype))
+    if args.recentroid and args.cutoutstore is None:
+        parser.error('--recentroid needs --cutoutstore')
+    if args.backfill is not None and args.backfill[0] > args.backfill[1]:
+        parser.error('--backfill START must not be after END')
     return args
 
 
+def log_task_latency():
+    task = agumetrics.metrics.histograms.get('task')
+    if task is not None:
+        counters = agumetrics.metrics.counters
+        log.info(f"Task latency of {task.count} frames: p50 {task.quantile(0.5):.2f} s, p95 {task.quantile(0.95):.2f} s, "
+                 f"p99 {task.quantile(0.99):.2f} s; {counters.get('tasks_timeout', 0)} timed out, "
+                 f"{counters.get('tasks_crashed', 0)} crashed, {counters.get('fetch_timeouts', 0)} downloads timed out")
+
+
 def main():
     faulthandler.enable()
     global args
     global reprocess
+    global tuner
     args = parseCommandLine()
     reprocess = args.reprocess
     warnings.simplefilter("ignore")
@@ -216,7 +994,28 @@ def main():
     agupinholedb.create_db(args.database)
     dbsession = agupinholedb.get_session(args.database)
 
-    c = ArchiveDiskCrawler()
+    priors = PinholePriors(dbsession) if args.useprior else None
+
+    if args.ncpu == 'auto':
+        # an explicit --fetchconcurrency is kept
+        tuner = aguautotune.WorkerTuner(fetch=args.useaws and args.fetchconcurrency == 0)
+        tuner.tune(args)
+
+    if args.recentroid or args.queue == 'work':
+        if args.recentroid:
+            recentroidStore(dbsession, args)
+        else:
+            processQueue(dbsession, args, priors)
+            log_task_latency()
+        dbsession.close()
+        if args.metrics_file is not None:
+            agumetrics.metrics.write(args.metrics_file, prefix='agupinholesearch')
+        sys.exit(0)
+
+    if args.diskcrawler == 'scandir':
+        c = ScandirArchiveCrawler(args.archiveroot, nthreads=args.crawlthreads, cachefile=args.listingcache)
+    else:
+        c = ArchiveDiskCrawler(args.archiveroot)
     dates = c.get_last_n_days(args.ndays)
     if not args.useaws:
         cameras = c.find_cameras(sites=['lsc', 'elp', 'tlv', 'cpt'], cameras=args.cameratype)
@@ -226,20 +1025,37 @@ def main():
     log.info("Found cameras: {}".format(cameras))
 
     if args.single is not None:
-        cameras = [args.single,]
+        if args.useaws:
+            cameras = [args.single,]
+        else:
+            # on disk, cameras are /archive paths
+            cameras = [camera for camera in cameras if os.path.basename(camera) == args.single]
         log.info (f"Cameras is now: {cameras}")
 
-    for camera in cameras:
-        log.info(f"Crawling {camera} ")
-        for date in dates:
-            if args.useaws:
+    if args.backfill is not None:
+        backfill(c, cameras, dbsession, args, priors)
+    elif args.useaws:
+        for camera in cameras:
+            log.info(f"Crawling {camera} ")
+            for date in dates:
                 files = get_frames_by_identifiers(date, camera=camera, mintexp=5, obstype='EXPERIMENTAL', rlevel=0)
-            else:
+                processFiles(camera, date, files, dbsession, args, priors)
+    elif args.diskcrawler == 'glob':
+        for camera in cameras:
+            log.info(f"Crawling {camera} ")
+            for date in dates:
                 files = ArchiveDiskCrawler.findfiles_for_camera_dates(camera, date, 'raw', "*[x]00.fits*")
-            log.info(f'         {camera} / {date} has {len(files) if files is not None else "None"} images.')
-            if (files is not None) and (len(files) > 0):
-                findPinHoleInImages(files, dbsession, args)
+                processFiles(camera, date, files, dbsession, args, priors)
+    else:
+        # listings stream in as they complete, in no particular camera / date order.
+        for camera, date, files in c.iter_files_for_cameras_dates(cameras, dates, 'raw', "*[x]00.fits*"):
+            processFiles(camera, date, files, dbsession, args, priors)
+    log_task_latency()
+    log.debug(f"Database connections: {agupinholedb.connection_stats()}")
     dbsession.close()
+    if args.metrics_file is not None:
+        agumetrics.metrics.write(args.metrics_file, prefix='agupinholesearch')
+        log.info(f"Metrics written to {args.metrics_file}")
     sys.exit(0)
 
 
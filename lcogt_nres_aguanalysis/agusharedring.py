@@ -0,0 +1,113 @@
+"""
+Ring of fixed size slots in shared memory, to hand frame data between the crawler's main process and its workers
+without pickling it.
+
+The slots are the records of a numpy structured array on one multiprocessing.shared_memory segment. The main process
+creates the ring and hands out the slots; only a slot index crosses the process boundary, the data is read and written
+in place:
+
+    ring = SharedRing(nslots, dtype)              # main process
+    slot = ring.acquire()
+    ring.slots['content'][slot, :n] = ...
+    ... the worker reads ring.slots['content'][slot, :n] and writes ring.slots['cutout'][slot] ...
+    ring.release(slot)
+    ring.close()
+
+Workers forked after the ring was created use the inherited mapping; a ring that is pickled, e.g., to a spawned
+process, attaches to the segment by name. Memory use is nslots * dtype.itemsize, however many frames go through.
+
+"""
+import collections
+import io
+import logging
+from multiprocessing import shared_memory
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+class SharedRing:
+    """ nslots records of dtype in shared memory. Only the process that created the ring acquires and releases
+        slots, and unlinks the segment on close().
+    """
+
+    def __init__(self, nslots, dtype, name=None):
+        self.nslots = nslots
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=max(nslots * self.dtype.itemsize, 1))
+        self.slots = np.ndarray((nslots,), dtype=self.dtype, buffer=self.shm.buf)
+        self.free = collections.deque(range(nslots))
+
+    def __getstate__(self):
+        return {'nslots': self.nslots, 'dtype': self.dtype, 'name': self.shm.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['nslots'], state['dtype'], name=state['name'])
+
+    def acquire(self):
+        """ Index of a free slot. The caller bounds the slots in use, e.g., by the number of tasks in flight."""
+        if len(self.free) == 0:
+            raise RuntimeError(f"All {self.nslots} slots of the shared ring are in use")
+        return self.free.popleft()
+
+    def release(self, slot):
+        self.free.append(slot)
+
+    def close(self):
+        self.slots = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # a view of a slot is still around; the mapping goes with it
+            log.debug(f"Shared ring {self.shm.name} is still in use, not closing it")
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BufferFile(io.RawIOBase):
+    """ Read-only file over a buffer, e.g., the content of a ring slot, to open it with astropy in place. Unlike
+        io.BytesIO, it does not copy the buffer first; each read copies only what it returns.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.buffer)}[whence]
+        self.position = max(start + offset, 0)
+        return self.position
+
+    def read(self, size=-1):
+        end = len(self.buffer) if (size is None) or (size < 0) else min(self.position + size, len(self.buffer))
+        data = self.buffer[self.position:end].tobytes()
+        self.position = max(self.position, end)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            # no views of the buffer are handed out, so nothing keeps the slot in use
+            self.buffer.release()
+        super().close()
@@ -0,0 +1,438 @@
+"""
+Synthetic AGU frames, and local stand-ins for the LCO archive API and the OpenSearch fits header index.
+
+The generator writes fpack (RICE_1) compressed AGU focus frames with a dark pinhole at a known and optionally drifting
+position, hot pixels, field stars, the occasional star on top of the pinhole, and the header keywords that
+agupinholesearch reads. A manifest.json next to the frames records the header index entries and the true pinhole
+location of every frame.
+
+The stand-in server answers the 'lco-fitsheaders' scan queries that get_frames_by_identifiers sends, the archive API
+/frames/{id} lookup, and serves the frame files themselves with HTTP Range support. Point the crawler at it with
+
+    OPENSEARCH_URL=http://localhost:8088 ARCHIVE_API_URL=http://localhost:8088 agupinholesearch --useaws ...
+
+so that a whole crawl can be load tested and profiled on one machine without network access.
+
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import uuid
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+NAXIS1 = 1375
+NAXIS2 = 1100
+BACKGROUND = 2250.
+BIASLEVEL = 480.
+PINHOLE_RADIUS = 6.5
+PINHOLE_DEPTH = 0.78
+
+CAMERAS = {'ak01': ('lsc', 'domb', '1m0a'),
+           'ak02': ('lsc', 'domc', '1m0a'),
+           'ak03': ('tlv', 'doma', '1m0a'),
+           'ak04': ('elp', 'doma', '1m0a'),
+           'ak05': ('cpt', 'domc', '1m0a'),
+           'ak06': ('cpt', 'domb', '1m0a'), }
+
+MANIFEST = 'manifest.json'
+
+
+def pinhole_location(camera, dateobs, altitude, azimuth, foctemp, drift=0., start=None, seed=0):
+    """ True pinhole location, FITS convention, of a camera at a given time and telescope pointing.
+        A per-camera home position, plus an optional linear drift in pixel per day, plus a small flexure term with
+        altitude, azimuth, and focus temperature.
+    """
+    rng = np.random.default_rng(zlib.crc32(f'{camera}-{seed}'.encode()))
+    x0, y0 = 780 + rng.uniform(-5, 5), 550 + rng.uniform(-5, 5)
+    days = 0 if start is None else (dateobs - start).total_seconds() / 86400.
+    alt = np.radians(altitude)
+    az = np.radians(azimuth)
+    x = x0 + drift * days + 0.8 * np.cos(alt) + 0.3 * np.sin(az) + 0.02 * (foctemp - 10)
+    y = y0 - 0.5 * drift * days + 0.6 * np.cos(alt) - 0.2 * np.cos(az) - 0.03 * (foctemp - 10)
+    return float(x), float(y)
+
+
+def _add_gaussian(data, x, y, flux, sigma):
+    """ Add a gaussian point source at 0-indexed pixel coordinates x, y, only touching a small stamp."""
+    size = int(5 * sigma) + 1
+    x0, x1 = max(int(x) - size, 0), min(int(x) + size + 1, data.shape[1])
+    y0, y1 = max(int(y) - size, 0), min(int(y) + size + 1, data.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    yy, xx = np.mgrid[y0:y1, x0:x1]
+    data[y0:y1, x0:x1] += flux / (2 * np.pi * sigma ** 2) * np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / (2 * sigma ** 2))
+
+
+def _pinhole_transmission(shape, x, y, radius=PINHOLE_RADIUS, oversample=5, blur=1.2):
+    """ Fractional transmission of a blurred dark disk at 0-indexed pixel coordinates x, y, on a local stamp.
+        Returns the stamp and its lower left corner.
+    """
+    from scipy import ndimage
+
+    size = int(radius + 4 * blur) + 2
+    x0, y0 = int(round(x)) - size, int(round(y)) - size
+    n = 2 * size + 1
+    sub = (np.arange(n * oversample) + 0.5) / oversample - 0.5
+    yy, xx = np.meshgrid(sub + y0, sub + x0, indexing='ij')
+    disk = ((xx - x) ** 2 + (yy - y) ** 2 <= radius ** 2).astype(float)
+    disk = disk.reshape(n, oversample, n, oversample).mean(axis=(1, 3))
+    disk = ndimage.gaussian_filter(disk, blur)
+    stamp = 1 - PINHOLE_DEPTH * disk
+    return stamp, x0, y0
+
+
+def make_frame(x, y, rng, nstars=20, nhotpixels=30, starcontamination=False, hotpixels=None):
+    """ Pixel data of an AGU focus frame with the pinhole centered at FITS coordinate x, y.
+        hotpixels is a list of fixed (x, y) FITS coordinates of the camera's known hot pixels.
+        Returns an uint16 array.
+    """
+    yy, xx = np.ogrid[0:NAXIS2, 0:NAXIS1]
+    # mild vignetting, so the background is not flat
+    r2 = ((xx - NAXIS1 / 2) / NAXIS1) ** 2 + ((yy - NAXIS2 / 2) / NAXIS2) ** 2
+    sky = (BACKGROUND - BIASLEVEL) * (1 - 0.4 * r2)
+    data = np.empty((NAXIS2, NAXIS1), dtype=np.float32)
+    data[:] = sky
+
+    for ii in range(nstars):
+        _add_gaussian(data, rng.uniform(0, NAXIS1), rng.uniform(0, NAXIS2), rng.uniform(2e4, 5e5),
+                      rng.uniform(1.5, 3))
+    if starcontamination:
+        _add_gaussian(data, x - 1 + rng.uniform(-4, 4), y - 1 + rng.uniform(-4, 4), rng.uniform(2e6, 5e6), 6)
+
+    stamp, x0, y0 = _pinhole_transmission(data.shape, x - 1, y - 1)
+    data[y0:y0 + stamp.shape[0], x0:x0 + stamp.shape[1]] *= stamp
+
+    # shot noise at gain ~ 0.26 e/ADU is close to sqrt(signal) * 2 in ADU, plus bias and read noise
+    data = data + rng.normal(0, 1, data.shape) * np.sqrt(np.clip(data, 1, None) * 2) + BIASLEVEL
+    data += rng.normal(0, 4, data.shape)
+
+    for ii in range(nhotpixels):
+        data[rng.integers(0, NAXIS2), rng.integers(0, NAXIS1)] = rng.uniform(1e4, 65535)
+    for hx, hy in (hotpixels or []):
+        data[hy - 1, hx - 1] = 60000.
+    return np.clip(data, 0, 65535).astype(np.uint16)
+
+
+def make_header(camera, frameno, dateobs, dayobs, altitude, azimuth, foctemp, crpix1, crpix2, exptime=15.):
+    from astropy.io import fits
+
+    site, enclosure, telescope = CAMERAS.get(camera, ('lsc', 'doma', '1m0a'))
+    filename = f'{site}1m0XX-{camera}-{dayobs}-{frameno:04d}-x00.fits'
+    header = fits.Header()
+    header['SITEID'] = (site, 'ID code of the Observatory site')
+    header['ENCID'] = (enclosure, 'ID code of the Enclosure')
+    header['TELID'] = (telescope, 'ID code of the Telescope')
+    header['INSTRUME'] = (camera, 'Instrument used')
+    header['OBSTYPE'] = ('EXPERIMENTAL', 'Observation type')
+    header['MOLTYPE'] = ('AUTO_FOCUS', 'Molecule type')
+    header['ORIGNAME'] = (filename, 'Fname written by ICS')
+    header['DATE-OBS'] = (dateobs.isoformat(timespec='milliseconds'), '[UTC] Start of the observation')
+    header['DAY-OBS'] = (dayobs, '[UTC] Start of local observing night')
+    header['EXPTIME'] = (exptime, '[s] Exposure length')
+    header['FOCOBOFF'] = (0., '[mm] Offset to focus for observer')
+    header['RLEVEL'] = (0, 'Reduction level')
+    header['CCDSUM'] = ('2 2', 'CCD on-chip summing/binning')
+    header['GAIN'] = (0.26, '[electrons/count] Pixel gain')
+    header['RDNOISE'] = (4.0, '[electrons/pixel] Read noise')
+    header['ALTITUDE'] = (altitude, '[deg] Altitude of telescope')
+    header['AZIMUTH'] = (azimuth, '[deg] Azimuth of telescope')
+    header['WMSTEMP'] = (foctemp, '[deg C] WMS temperature')
+    header['CRPIX1'] = (crpix1, '[pixel] Reference pixel, axis 1')
+    header['CRPIX2'] = (crpix2, '[pixel] Reference pixel, axis 2')
+    return header, filename + '.fz'
+
+
+def generate_frames(outputdir, cameras=('ak01',), nights=1, framespernight=10, startdate=datetime.date(2021, 1, 1),
+                    drift=0., starcontamination=0.05, seed=0, firstframeid=1000000):
+    """ Write a set of synthetic AGU frames into outputdir/<site>/<camera>/<dayobs>/raw/, and add them to the manifest.
+        The directory layout matches the /archive mount, so ArchiveDiskCrawler finds the frames as well.
+        Returns the list of new manifest records.
+    """
+    from astropy.io import fits
+
+    manifestfile = os.path.join(outputdir, MANIFEST)
+    existing = []
+    if os.path.exists(manifestfile):
+        with open(manifestfile) as f:
+            existing = json.load(f)
+
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime.combine(startdate, datetime.time(0, 0))
+    records = []
+    frameid = max([firstframeid, ] + [r['frameid'] + 1 for r in existing])
+    for camera in cameras:
+        site = CAMERAS.get(camera, ('lsc',))[0]
+        hotpixels = [(int(hx), int(hy)) for hx, hy in zip(rng.integers(700, 860, 2), rng.integers(480, 620, 2))]
+        for night in range(nights):
+            dayobs = (startdate + datetime.timedelta(days=night)).strftime('%Y%m%d')
+            rawdir = os.path.join(outputdir, site, camera, dayobs, 'raw')
+            os.makedirs(rawdir, exist_ok=True)
+            for frameno in range(framespernight):
+                dateobs = start + datetime.timedelta(days=night, hours=1, minutes=int(frameno * 600 / framespernight))
+                altitude = float(rng.uniform(20, 90))
+                azimuth = float(rng.uniform(0, 360))
+                foctemp = float(rng.uniform(-5, 30))
+                x, y = pinhole_location(camera, dateobs, altitude, azimuth, foctemp, drift=drift, start=start,
+                                        seed=seed)
+                contaminated = bool(rng.uniform() < starcontamination)
+                header, filename = make_header(camera, frameno, dateobs, dayobs, altitude, azimuth, foctemp,
+                                               crpix1=round(x + rng.uniform(-3, 3), 1),
+                                               crpix2=round(y + rng.uniform(-3, 3), 1))
+                data = make_frame(x, y, rng, starcontamination=contaminated, hotpixels=hotpixels)
+                path = os.path.join(rawdir, filename)
+                fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header=header, compression_type='RICE_1')]) \
+                    .writeto(path, overwrite=True)
+                records.append({'frameid': frameid, 'filename': filename,
+                                'path': os.path.relpath(path, outputdir),
+                                'DAY-OBS': dayobs, 'DATE-OBS': header['DATE-OBS'], 'INSTRUME': camera,
+                                'SITEID': site, 'OBSTYPE': header['OBSTYPE'], 'RLEVEL': 0,
+                                'EXPTIME': header['EXPTIME'], 'FOCOBOFF': 0, 'starcontamination': contaminated,
+                                'xcenter': x, 'ycenter': y})
+                frameid += 1
+        log.info(f"Generated {nights * framespernight} frames for {camera}")
+
+    with open(manifestfile, 'w') as f:
+        json.dump(existing + records, f)
+    return records
+
+
+def _matches(record, clause):
+    """ Evaluate one OpenSearch filter clause, term, terms, range, or prefix, against a manifest record."""
+    kind, condition = next(iter(clause.items()))
+    field, value = next(iter(condition.items()))
+    if field not in record:
+        return False
+    if kind == 'term':
+        value = value['value'] if isinstance(value, dict) else value
+        return str(record[field]) == str(value) if isinstance(record[field], str) else record[field] == value
+    if kind == 'terms':
+        return record[field] in value
+    if kind == 'prefix':
+        value = value['value'] if isinstance(value, dict) else value
+        return str(record[field]).startswith(value)
+    if kind == 'range':
+        v = record[field]
+        return all([('gte' not in value) or v >= value['gte'], ('gt' not in value) or v > value['gt'],
+                    ('lte' not in value) or v <= value['lte'], ('lt' not in value) or v < value['lt']])
+    if kind == 'bool':
+        return _matches_bool(record, condition)
+    raise ValueError(f'Unsupported query clause {kind}')
+
+
+def _matches_bool(record, boolquery):
+    for key in ('filter', 'must'):
+        clauses = boolquery.get(key, [])
+        clauses = clauses if isinstance(clauses, list) else [clauses]
+        if not all(_matches(record, c) for c in clauses):
+            return False
+    clauses = boolquery.get('must_not', [])
+    clauses = clauses if isinstance(clauses, list) else [clauses]
+    return not any(_matches(record, c) for c in clauses)
+
+
+def search_manifest(manifest, query):
+    """ Records of the manifest matching an OpenSearch query body."""
+    query = (query or {}).get('query', {'match_all': {}})
+    if 'match_all' in query:
+        return list(manifest)
+    if 'bool' in query:
+        return [r for r in manifest if _matches_bool(r, query['bool'])]
+    return [r for r in manifest if _matches(r, query)]
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """ Answers the subset of the OpenSearch and archive API that the crawler uses, out of a generated data set."""
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length > 0 else {}
+
+    def _hits(self, scroll_id):
+        server = self.server
+        with server.lock:
+            records = server.scrolls.get(scroll_id, [])
+            page, server.scrolls[scroll_id] = records[:server.pagesize], records[server.pagesize:]
+        hits = [{'_index': 'lco-fitsheaders', '_id': str(r['frameid']), '_score': None, '_source': r} for r in page]
+        return {'_scroll_id': scroll_id, 'took': 1, 'timed_out': False,
+                '_shards': {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0},
+                'hits': {'total': {'value': len(page), 'relation': 'eq'}, 'max_score': None, 'hits': hits}}
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        server = self.server
+        match = re.fullmatch(r'/frames/(\d+)/?', url.path)
+        if match:
+            record = server.frames.get(int(match.group(1)))
+            if record is None:
+                return self._send_json({}, 404)
+            host = self.headers.get('Host')
+            return self._send_json({'id': record['frameid'], 'filename': record['filename'],
+                                    'url': f"http://{host}/files/{record['path']}"})
+        if url.path.startswith('/files/'):
+            return self._send_file(url.path[len('/files/'):])
+        if url.path in ('', '/'):
+            return self._send_json({'name': 'agusynthetic', 'version': {'distribution': 'opensearch',
+                                                                        'number': '2.11.0'}})
+        if url.path.endswith('/_search'):
+            return self.do_POST()
+        self._send_json({'error': 'not found'}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        server = self.server
+        if url.path.endswith('/_search/scroll'):
+            return self._send_json(self._hits(self._read_json().get('scroll_id')))
+        if url.path.endswith('/_search'):
+            records = search_manifest(server.manifest, self._read_json())
+            scroll_id = uuid.uuid4().hex
+            with server.lock:
+                server.scrolls[scroll_id] = records
+                server.searches += 1
+            size = parse_qs(url.query).get('size')
+            if size:
+                server.pagesize = int(size[0])
+            return self._send_json(self._hits(scroll_id))
+        self._send_json({'error': 'not found'}, 404)
+
+    def do_DELETE(self):
+        if self.path.startswith('/_search/scroll'):
+            for scroll_id in self._read_json().get('scroll_id', []):
+                with self.server.lock:
+                    self.server.scrolls.pop(scroll_id, None)
+            return self._send_json({'succeeded': True, 'num_freed': 1})
+        self._send_json({'error': 'not found'}, 404)
+
+    def _send_file(self, relpath):
+        server = self.server
+        path = os.path.realpath(os.path.join(server.datadir, relpath))
+        if not path.startswith(os.path.realpath(server.datadir)) or not os.path.isfile(path):
+            return self._send_json({'error': 'not found'}, 404)
+        size = os.path.getsize(path)
+        start, end, status = 0, size - 1, 200
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+        if match and server.ranges:
+            if match.group(1):
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            else:
+                start = max(size - int(match.group(2)), 0)
+            status = 206
+        with open(path, 'rb') as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(body)))
+        if server.ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        with server.lock:
+            server.bytes_sent += len(body)
+
+
+def make_server(datadir, host='127.0.0.1', port=0, ranges=True, pagesize=1000):
+    """ Create the stand-in server for a data set written by generate_frames. port=0 picks a free port.
+        Use server.serve_forever(), or start_server() to run it in a background thread.
+    """
+    with open(os.path.join(datadir, MANIFEST)) as f:
+        manifest = json.load(f)
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.datadir = datadir
+    server.manifest = manifest
+    server.frames = {r['frameid']: r for r in manifest}
+    server.scrolls = {}
+    server.pagesize = pagesize
+    server.ranges = ranges
+    server.lock = threading.Lock()
+    server.searches = 0
+    server.bytes_sent = 0
+    server.url = f'http://{host}:{server.server_address[1]}'
+    return server
+
+
+def start_server(datadir, **kwargs):
+    server = make_server(datadir, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Stand-in archive and OpenSearch serving {datadir} at {server.url}")
+    return server
+
+
+def parseCommandLine():
+    parser = argparse.ArgumentParser(
+        description='Generate synthetic AGU frames, and serve them through local archive and OpenSearch stand-ins')
+    parser.add_argument('--loglevel', dest='log_level', default='INFO', choices=['DEBUG', 'INFO'],
+                        help='Set the debug level')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    generate = subparsers.add_parser('generate', help='Write synthetic frames and their manifest')
+    generate.add_argument('--outputdir', required=True)
+    generate.add_argument('--cameras', nargs='+', default=['ak01', 'ak02'])
+    generate.add_argument('--nights', type=int, default=3)
+    generate.add_argument('--framespernight', type=int, default=20)
+    generate.add_argument('--startdate', default='20210101', help='First DAY-OBS, YYYYMMDD')
+    generate.add_argument('--drift', type=float, default=0., help='Pinhole drift in pixel per day')
+    generate.add_argument('--starcontamination', type=float, default=0.05,
+                          help='Fraction of frames with a star on the pinhole')
+    generate.add_argument('--seed', type=int, default=0)
+
+    serve = subparsers.add_parser('serve', help='Serve a generated data set')
+    serve.add_argument('--datadir', required=True)
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8088)
+    serve.add_argument('--noranges', action='store_true', help='Ignore HTTP Range requests')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()),
+                        format='%(asctime)s.%(msecs).03d %(levelname)7s: %(module)20s: %(message)s')
+    return args
+
+
+def main():
+    args = parseCommandLine()
+    if args.command == 'generate':
+        startdate = datetime.datetime.strptime(args.startdate, '%Y%m%d').date()
+        generate_frames(args.outputdir, cameras=args.cameras, nights=args.nights,
+                        framespernight=args.framespernight, startdate=startdate, drift=args.drift,
+                        starcontamination=args.starcontamination, seed=args.seed)
+    else:
+        server = make_server(args.datadir, host=args.host, port=args.port, ranges=not args.noranges)
+        log.info(f"Serving {args.datadir}; export OPENSEARCH_URL={server.url} ARCHIVE_API_URL={server.url}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""
+Process pool with a deadline per task, for the crawler.
+
+concurrent.futures.ProcessPoolExecutor can not stop a single task: a hung archive download or a pathological frame
+holds its worker, and the batch waits for it in shutdown(wait=True). DeadlinePool gives each worker process one task at
+a time, and waits for results no longer than up to the earliest deadline of the tasks in flight. A task past its
+deadline is given up, and its worker is killed and replaced by a fresh one. A worker that dies, e.g., of a segfault or
+the OOM killer, is replaced too. The other tasks keep running, so a batch takes as long as its throughput allows, not
+as long as its worst frame.
+
+    pool = DeadlinePool(findPinholeTask, nworkers=4, deadline=300)
+    for result in pool.map((imagename, (filename, args, frameid)) for ...):
+        result.key, result.outcome, result.value, result.seconds
+
+outcome is 'done' with the return value, 'error' with the exception, 'timeout' or 'crashed'. Tasks are taken from the
+iterable only when a worker is free, so a generator of downloads is not drained ahead of the workers.
+
+The latency of every task, from handing it to a worker to its result, goes into the 'task' histogram of agumetrics;
+a task that timed out counts with the time it was given up at.
+
+"""
+import collections
+import logging
+import multiprocessing
+import multiprocessing.connection
+import time
+import traceback
+
+from lcogt_nres_aguanalysis import agumetrics
+
+log = logging.getLogger(__name__)
+
+TaskResult = collections.namedtuple('TaskResult', ['key', 'outcome', 'value', 'seconds'])
+
+# seconds a worker gets to exit after it is asked to
+STOP_TIMEOUT = 5
+
+
+class TaskError(Exception):
+    """ Exception of a task in a worker, with the worker side traceback, for exceptions that do not pickle."""
+
+
+def _work(function, connection, initializer, initargs):
+    if initializer is not None:
+        initializer(*initargs)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        try:
+            result = ('done', function(*task))
+        except Exception as e:
+            result = ('error', TaskError(f"{type(e).__name__}: {e}\n{traceback.format_exc()}"))
+        try:
+            connection.send(result)
+        except Exception as e:
+            # the result does not pickle
+            connection.send(('error', TaskError(f"Could not return the result: {type(e).__name__}: {e}")))
+
+
+class _Worker:
+
+    def __init__(self, context, function, initializer=None, initargs=()):
+        self.connection, child = context.Pipe()
+        self.process = context.Process(target=_work, args=(function, child, initializer, initargs), daemon=True)
+        self.process.start()
+        child.close()
+        self.key = None
+        self.started = None
+
+    def submit(self, key, args):
+        self.key = key
+        self.started = time.monotonic()
+        self.connection.send(args)
+
+    def stop(self):
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(STOP_TIMEOUT)
+        self.kill()
+
+    def kill(self):
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class DeadlinePool:
+    """ nworkers processes that run function(*args), each task within deadline seconds, or without a limit if
+        deadline is None or 0. Every worker, including a replacement, first calls initializer(*initargs).
+    """
+
+    def __init__(self, function, nworkers=1, deadline=None, initializer=None, initargs=()):
+        self.function = function
+        self.nworkers = max(1, nworkers)
+        self.deadline = deadline if deadline else None
+        self.initializer = initializer
+        self.initargs = initargs
+        self.context = multiprocessing.get_context()
+
+    def _start(self):
+        return _Worker(self.context, self.function, self.initializer, self.initargs)
+
+    def _replace(self, worker, busy, idle):
+        del busy[worker.connection]
+        worker.kill()
+        agumetrics.count('workers_replaced')
+        idle.append(self._start())
+
+    def map(self, tasks):
+        """ Run function(*args) for each (key, args) of tasks, and yield a TaskResult per task as they complete."""
+        tasks = iter(tasks)
+        idle = [self._start() for ii in range(self.nworkers)]
+        busy = {}
+        exhausted = False
+        try:
+            while True:
+                while len(idle) > 0 and not exhausted:
+                    try:
+                        key, args = next(tasks)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    worker = idle.pop()
+                    worker.submit(key, args)
+                    busy[worker.connection] = worker
+                agumetrics.gauge('pool_busy', len(busy))
+                if len(busy) == 0:
+                    break
+
+                timeout = None
+                if self.deadline is not None:
+                    first = min(worker.started for worker in busy.values())
+                    timeout = max(first + self.deadline - time.monotonic(), 0)
+                ready = set(multiprocessing.connection.wait(
+                    list(busy) + [worker.process.sentinel for worker in busy.values()], timeout))
+
+                now = time.monotonic()
+                for worker in list(busy.values()):
+                    seconds = now - worker.started
+                    if worker.connection in ready:
+                        try:
+                            outcome, value = worker.connection.recv()
+                        except (EOFError, OSError):
+                            # died before or while sending its result
+                            outcome, value = 'crashed', None
+                    elif worker.process.sentinel in ready:
+                        outcome, value = 'crashed', None
+                    elif self.deadline is not None and seconds >= self.deadline:
+                        outcome, value = 'timeout', None
+                    else:
+                        continue
+
+                    agumetrics.observe('task', seconds)
+                    if outcome in ('done', 'error'):
+                        del busy[worker.connection]
+                        idle.append(worker)
+                    else:
+                        agumetrics.count(f'tasks_{outcome}')
+                        log.warning(f"Task {worker.key} {'timed out' if outcome == 'timeout' else 'crashed'} after "
+                                    f"{seconds:.1f} s, replacing worker {worker.process.pid} "
+                                    f"(exit code {worker.process.exitcode})")
+                        self._replace(worker, busy, idle)
+                    yield TaskResult(worker.key, outcome, value, seconds)
+        finally:
+            for worker in idle:
+                worker.stop()
+            for worker in busy.values():
+                worker.kill()
@@ -1,11 +1,154 @@
 '''
 Tool to copy gain history data from one database to another, in particular to support hte migration from local sqlite to online postgress.
+
+The source table is streamed in imagename order and copied in chunks. Every chunk is committed together with a
+checkpoint row in the output database, so an interrupted copy resumes after the last committed imagename when it is
+started again with the same arguments. With --nranges, the imagename key space is split into ranges that are copied in
+parallel processes.
 '''
 import argparse
 import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy import Boolean, Column, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
 
 import lcogt_nres_aguanalysis.agupinholedb as agupinholedb
 
+log = logging.getLogger(__name__)
+
+CheckpointBase = declarative_base()
+
+
+class CopyCheckpoint(CheckpointBase):
+    """ Progress of copying one key range, [lowkey, highkey) of source imagenames; None is open ended."""
+    __tablename__ = 'copycheckpoints'
+
+    rangeid = Column(Integer, primary_key=True)
+    lowkey = Column(String)
+    highkey = Column(String)
+    lastkey = Column(String)  # last source imagename that is committed in the output
+    rows = Column(Integer, default=0)
+    done = Column(Boolean, default=False)
+
+
+def copy_measurement(e: agupinholedb.PinholeMeasurement):
+    return agupinholedb.PinholeMeasurement(**{c.name: getattr(e, c.name)
+                                              for c in agupinholedb.PinholeMeasurement.__table__.columns})
+
+
+# source schema: declarative base, record class, conversion into the current PinholeMeasurement
+SCHEMAS = {'v1': (agupinholedb.Base_v1, agupinholedb.PinholeMeasurement_v1, agupinholedb.pinholefrompinhole_v1),
+           'v2': (agupinholedb.Base, agupinholedb.PinholeMeasurement, copy_measurement)}
+
+
+def get_output_session(outputurl):
+    output = agupinholedb.get_session(outputurl)
+    CopyCheckpoint.__table__.create(bind=output.get_bind(), checkfirst=True)
+    return output
+
+
+def split_keys(input, model, nranges):
+    """ Boundaries of nranges key ranges with about the same number of source rows.
+        Returns a list of (lowkey, highkey).
+    """
+    total = input.query(model.imagename).count()
+    boundaries = []
+    for ii in range(1, nranges):
+        key = input.query(model.imagename).order_by(model.imagename).offset(ii * total // nranges).limit(1).scalar()
+        if key is not None and key not in boundaries:
+            boundaries.append(key)
+    lows = [None] + boundaries
+    highs = boundaries + [None]
+    return list(zip(lows, highs))
+
+
+def init_checkpoints(inputurl, outputurl, schema='v1', nranges=1):
+    """ Checkpoint rows of all key ranges. Existing checkpoints are kept, so a restarted copy resumes with the same
+        ranges. Returns the list of range ids that are not done yet.
+    """
+    base, model, convert = SCHEMAS[schema]
+    output = get_output_session(outputurl)
+    if output.query(CopyCheckpoint).count() == 0:
+        input = agupinholedb.get_session(inputurl, Base=base)
+        ranges = split_keys(input, model, nranges)
+        input.close()
+        for rangeid, (lowkey, highkey) in enumerate(ranges):
+            output.add(CopyCheckpoint(rangeid=rangeid, lowkey=lowkey, highkey=highkey, lastkey=None, rows=0,
+                                      done=False))
+        output.commit()
+    else:
+        log.info("Resuming from the checkpoints in the output database")
+    rangeids = [cp.rangeid for cp in output.query(CopyCheckpoint).filter(CopyCheckpoint.done.is_(False))
+                .order_by(CopyCheckpoint.rangeid)]
+    output.close()
+    return rangeids
+
+
+def copy_range(inputurl, outputurl, rangeid, schema='v1', chunksize=5000):
+    """ Copy the rows of one key range, starting after its checkpoint. Each chunk is committed with its checkpoint.
+        Returns the number of rows copied in this call.
+    """
+    base, model, convert = SCHEMAS[schema]
+    input = agupinholedb.get_session(inputurl, Base=base)
+    output = get_output_session(outputurl)
+    checkpoint = output.query(CopyCheckpoint).get(rangeid)
+
+    q = input.query(model).order_by(model.imagename)
+    if checkpoint.lastkey is not None:
+        q = q.filter(model.imagename > checkpoint.lastkey)
+    elif checkpoint.lowkey is not None:
+        q = q.filter(model.imagename >= checkpoint.lowkey)
+    if checkpoint.highkey is not None:
+        q = q.filter(model.imagename < checkpoint.highkey)
+
+    copied = 0
+    start = time.perf_counter()
+
+    def flush(chunk):
+        output.bulk_save_objects([convert(e) for e in chunk])
+        checkpoint.lastkey = chunk[-1].imagename
+        checkpoint.rows += len(chunk)
+        output.commit()
+
+    chunk = []
+    try:
+        # yield_per streams the result set, with a server side cursor on PostgreSQL
+        for e in q.yield_per(chunksize):
+            chunk.append(e)
+            if len(chunk) == chunksize:
+                flush(chunk)
+                copied += len(chunk)
+                chunk = []
+                log.info(f"Range {rangeid}: {checkpoint.rows} rows up to {checkpoint.lastkey}, "
+                         f"{copied / (time.perf_counter() - start):.0f} rows/s")
+        if len(chunk) > 0:
+            flush(chunk)
+            copied += len(chunk)
+        checkpoint.done = True
+        output.commit()
+    finally:
+        input.close()
+        output.close()
+    log.info(f"Range {rangeid} done: {copied} rows in {time.perf_counter() - start:.1f} s")
+    return copied
+
+
+def copy_database(inputurl, outputurl, schema='v1', nranges=1, chunksize=5000):
+    """ Copy all pending key ranges, in parallel processes if there are more than one. Returns the rows copied."""
+    rangeids = init_checkpoints(inputurl, outputurl, schema, nranges)
+    start = time.perf_counter()
+    if len(rangeids) > 1:
+        with ProcessPoolExecutor(max_workers=len(rangeids)) as e:
+            copied = sum(e.map(copy_range, [inputurl] * len(rangeids), [outputurl] * len(rangeids), rangeids,
+                               [schema] * len(rangeids), [chunksize] * len(rangeids)))
+    else:
+        copied = sum(copy_range(inputurl, outputurl, rangeid, schema, chunksize) for rangeid in rangeids)
+    elapsed = time.perf_counter() - start
+    log.info(f"Copied {copied} rows in {elapsed:.1f} s, {copied / max(elapsed, 1e-9):.0f} rows/s")
+    return copied
+
 
 def parseCommandLine():
     parser = argparse.ArgumentParser(
@@ -14,6 +157,10 @@ def parseCommandLine():
                         help='Set the debug level')
     parser.add_argument('--inputurl', type=str, default='sqlite:///noisegain.sqlite', help="input database")
     parser.add_argument('--outputurl', type=str, default='sqlite:///noisegain.sqlite', help="input database")
+    parser.add_argument('--schema', default='v1', choices=list(SCHEMAS), help="schema of the input database")
+    parser.add_argument('--chunksize', default=5000, type=int, help="rows per committed chunk")
+    parser.add_argument('--nranges', default=1, type=int,
+                        help="split the imagename key space into this many ranges copied in parallel")
     args = parser.parse_args()
 
     logging.basicConfig(level=getattr(logging, args.log_level.upper()),
@@ -24,19 +171,4 @@ def parseCommandLine():
 if __name__ == '__main__':
     args = parseCommandLine()
     print(f"Copy from {args.inputurl} -> {args.outputurl}")
-
-    input = agupinholedb.get_session(args.inputurl, Base=agupinholedb.Base_v1)
-    output = agupinholedb.get_session(args.outputurl)
-
-    q = input.query(agupinholedb.PinholeMeasurement_v1)
-
-    print("Found {} records to copy.".format(q.count()))
-    print("Refactoring data")
-    newdata = [agupinholedb.pinholefrompinhole_v1(e) for e in q.all()]
-
-    print("Now doing bulk insert")
-    output.bulk_save_objects(newdata)
-    output.commit()
-
-    input.close()
-    output.close()
+    copy_database(args.inputurl, args.outputurl, schema=args.schema, nranges=args.nranges, chunksize=args.chunksize)
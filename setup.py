@@ -7,6 +7,7 @@ setuptools.setup(
     name='nresaguflexure',
     version='1.2.10',
     packages=setuptools.find_packages(),
+    package_data={'lcogt_nres_aguanalysis': ['badpixels.json']},
     url='',
     author='Daniel Harbeck',
     author_email='dharbeck@lco.global',
@@ -18,7 +19,9 @@ setuptools.setup(
     ],
     entry_points={
         'console_scripts': ['agupinholesearch = lcogt_nres_aguanalysis.agupinholesearch:main',
-                             'aguanalysis = lcogt_nres_aguanalysis.aguanalysis:main'],
+                             'aguanalysis = lcogt_nres_aguanalysis.aguanalysis:main',
+                             'agubenchmark = lcogt_nres_aguanalysis.agubenchmark:main',
+                             'agusynthetic = lcogt_nres_aguanalysis.agusynthetic:main'],
 
     }
 )
@@ -0,0 +1,85 @@
+import argparse
+import glob
+
+from lcogt_nres_aguanalysis import agumetrics, aguautotune, agupinholedb, agupinholesearch
+
+TESTDATADIR = 'testing/testdata'
+
+
+def test_cgroup_limits(tmp_path):
+    affinity, memory = aguautotune.cgroup_limits(str(tmp_path))
+    assert affinity >= 1 and memory is None
+
+    (tmp_path / 'cpu.max').write_text('50000 100000\n')
+    (tmp_path / 'memory.max').write_text('1073741824\n')
+    assert aguautotune.cgroup_limits(str(tmp_path)) == (0.5, 2 ** 30)
+    (tmp_path / 'cpu.max').write_text('max 100000\n')
+    (tmp_path / 'memory.max').write_text('max\n')
+    assert aguautotune.cgroup_limits(str(tmp_path)) == (affinity, None)
+
+    v1 = tmp_path / 'v1'
+    (v1 / 'cpu').mkdir(parents=True)
+    (v1 / 'memory').mkdir()
+    (v1 / 'cpu' / 'cpu.cfs_quota_us').write_text('-1\n')
+    (v1 / 'cpu' / 'cpu.cfs_period_us').write_text('100000\n')
+    (v1 / 'memory' / 'memory.limit_in_bytes').write_text('9223372036854771712\n')
+    assert aguautotune.cgroup_limits(str(v1)) == (affinity, None)
+    (v1 / 'cpu' / 'cpu.cfs_quota_us').write_text('25000\n')
+    (v1 / 'memory' / 'memory.limit_in_bytes').write_text('536870912\n')
+    assert aguautotune.cgroup_limits(str(v1)) == (0.25, 2 ** 29)
+
+
+def test_plan():
+    # compute bound: one worker per cpu
+    assert aguautotune.plan(4, None, wall=0.30, cpu=0.28).workers == 4
+    # a worker that downloads its own frame waits 3/4 of the time
+    assert aguautotune.plan(2, None, wall=1.0, cpu=0.25).workers == 8
+    assert aguautotune.plan(2, None, wall=100., cpu=0.01).workers == 2 * aguautotune.MAX_WORKERS_PER_CPU
+    # downloads in the main process: enough in flight to feed the workers
+    fetching = aguautotune.plan(2, None, wall=0.2, cpu=0.2, download=1.0, fetch=True)
+    assert fetching.workers == 2 and fetching.fetchconcurrency == 10
+    # within the memory limit
+    limited = aguautotune.plan(2, 2 ** 30, wall=1.0, cpu=0.25, workerbytes=200 * 2 ** 20)
+    assert limited.workers == 4 and 'memory' in limited.reason
+
+
+def test_tuner_warms_up_and_retunes():
+    registry = agumetrics.MetricsRegistry()
+    tuner = aguautotune.WorkerTuner(fetch=True, cpus=2, warmup=5, interval=10, metrics=registry)
+    args = argparse.Namespace(ncpu='auto', fetchconcurrency=0)
+    assert tuner.tune(args).reason == 'warm-up'
+    assert (args.ncpu, args.fetchconcurrency) == (2, 2 * aguautotune.FETCH_PER_WORKER)
+
+    for ii in range(5):
+        registry.observe('frame', 0.4)
+        registry.observe('frame_cpu', 0.1)
+        registry.observe('archive_download', 1.0)
+        registry.count('downloads')
+    tuner.tune(args)
+    assert (args.ncpu, args.fetchconcurrency) == (8, 20)
+
+    # not retuned before another interval of frames
+    for ii in range(5):
+        registry.observe('frame', 0.1)
+        registry.observe('frame_cpu', 0.1)
+    tuner.tune(args)
+    assert args.ncpu == 8
+    for ii in range(5):
+        registry.observe('frame', 0.1)
+        registry.observe('frame_cpu', 0.1)
+    tuner.tune(args)
+    assert args.ncpu == 2
+
+
+def test_crawl_with_auto_workers(tmp_path, monkeypatch):
+    monkeypatch.setattr(agupinholesearch, 'tuner', aguautotune.WorkerTuner(cpus=2, warmup=2))
+    database = f'sqlite:///{tmp_path}/auto.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    args = argparse.Namespace(makepng=False, useaws=False, reprocess=True, ncpu='auto', profile=False)
+    files = [{'filename': f, 'frameid': -1} for f in sorted(glob.glob(f'{TESTDATADIR}/*.fits.fz'))]
+    for ii in range(2):
+        assert agupinholesearch.findPinHoleInImages(files, session, args) == ([], [])
+        assert isinstance(args.ncpu, int) and args.ncpu >= 1
+    assert agupinholesearch.tuner.decisions == 1
+    session.close()
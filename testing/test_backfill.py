@@ -0,0 +1,97 @@
+import argparse
+import datetime
+import functools
+import json
+import os
+
+from lcogt_awsarchiveaccess import lco_archive_utilities
+from lcogt_nres_aguanalysis import agupinholedb, agupinholesearch, agusynthetic
+
+
+def test_month_chunks():
+    assert agupinholesearch.month_chunks('20210115', '20210115') == [('20210115', '20210115')]
+    assert agupinholesearch.month_chunks('20201215', '20210310') == [('20201215', '20201231'),
+                                                                     ('20210101', '20210131'),
+                                                                     ('20210201', '20210228'),
+                                                                     ('20210301', '20210310')]
+    assert agupinholesearch.month_chunks('20240201', '20240229') == [('20240201', '20240229')]
+    assert agupinholesearch.month_chunks('20210201', '20210131') == []
+
+
+def test_backfill_resumes_from_checkpoint(tmp_path, monkeypatch):
+    # two nights in each of January and February
+    records = agusynthetic.generate_frames(str(tmp_path / 'data'), cameras=['ak01', 'ak02'], nights=4,
+                                           framespernight=2, startdate=datetime.date(2021, 1, 30),
+                                           starcontamination=0)
+    server = agusynthetic.start_server(str(tmp_path / 'data'))
+    monkeypatch.setattr(lco_archive_utilities, 'ARCHIVE_API_URL', server.url)
+    monkeypatch.setattr(agupinholesearch, 'get_frames_by_identifiers',
+                        functools.partial(lco_archive_utilities.get_frames_by_identifiers, es_url=server.url))
+    database = f'sqlite:///{tmp_path}/backfill.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    checkpoint = tmp_path / 'checkpoint.json'
+    # ak02 in January was done by an earlier run
+    checkpoint.write_text(json.dumps({'done': {'ak02:20210101-20210131': {'frames': 4}}}))
+    args = argparse.Namespace(makepng=False, useaws=True, reprocess=False, ncpu=1, profile=False, fetchconcurrency=0,
+                              backfill=['20210101', '20210228'], backfillcheckpoint=str(checkpoint), backfillbatch=3)
+    try:
+        agupinholesearch.backfill(None, ['ak01', 'ak02'], session, args)
+    finally:
+        server.shutdown()
+
+    measured = {r.imagename for r in session.query(agupinholedb.PinholeMeasurement).all()}
+    skipped = {r['filename'] for r in records if r['INSTRUME'] == 'ak02' and r['DAY-OBS'] < '20210201'}
+    assert measured == {r['filename'] for r in records} - skipped
+    done = json.loads(checkpoint.read_text())['done']
+    assert sorted(done) == ['ak01:20210101-20210131', 'ak01:20210201-20210228', 'ak02:20210101-20210131',
+                            'ak02:20210201-20210228']
+    assert done['ak01:20210101-20210131']['frames'] == 4
+
+    # all chunks done: nothing to do
+    agupinholesearch.backfill(None, ['ak01', 'ak02'], session, args)
+    session.close()
+
+
+def test_backfill_keeps_failed_frames_pending(tmp_path, monkeypatch):
+    records = agusynthetic.generate_frames(str(tmp_path / 'data'), cameras=['ak01'], nights=2, framespernight=2,
+                                           startdate=datetime.date(2021, 1, 1), starcontamination=0)
+    server = agusynthetic.start_server(str(tmp_path / 'data'))
+    monkeypatch.setattr(lco_archive_utilities, 'ARCHIVE_API_URL', server.url)
+    monkeypatch.setattr(agupinholesearch, 'get_frames_by_identifiers',
+                        functools.partial(lco_archive_utilities.get_frames_by_identifiers, es_url=server.url))
+    database = f'sqlite:///{tmp_path}/backfill.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    checkpoint = tmp_path / 'checkpoint.json'
+    args = argparse.Namespace(makepng=False, useaws=True, reprocess=True, ncpu=1, profile=False, fetchconcurrency=0,
+                              backfill=['20210101', '20210131'], backfillcheckpoint=str(checkpoint), backfillbatch=3)
+    broken = records[1]['filename']
+    findPinhole = agupinholesearch.findPinhole
+
+    def failing(imagename, *args, **kwargs):
+        if os.path.basename(str(imagename)) == broken:
+            raise OSError('truncated download')
+        return findPinhole(imagename, *args, **kwargs)
+
+    try:
+        # the workers fork from this process, and see the patched findPinhole
+        monkeypatch.setattr(agupinholesearch, 'findPinhole', failing)
+        agupinholesearch.backfill(None, ['ak01'], session, args)
+        state = json.loads(checkpoint.read_text())
+        assert state['done'] == {}
+        assert [r['filename'] for r in state['pending']['ak01:20210101-20210131']] == [broken]
+
+        # started again, only the pending frame is processed, and the chunk is done
+        monkeypatch.setattr(agupinholesearch, 'findPinhole', findPinhole)
+        session.query(agupinholedb.PinholeMeasurement).delete()
+        session.commit()
+        agupinholesearch.backfill(None, ['ak01'], session, args)
+    finally:
+        server.shutdown()
+
+    assert [r.imagename for r in session.query(agupinholedb.PinholeMeasurement).all()] == [broken]
+    state = json.loads(checkpoint.read_text())
+    assert state['pending'] == {}
+    assert state['done']['ak01:20210101-20210131']['frames'] == 1
+    session.close()
@@ -0,0 +1,37 @@
+import glob
+
+import numpy as np
+from astropy.io import fits
+
+from lcogt_nres_aguanalysis import agupinholesearch, agusynthetic
+
+TESTDATADIR = 'testing/testdata'
+
+
+def test_sampled_background_matches_full_median():
+    for filename in sorted(glob.glob(f'{TESTDATADIR}/*.fits.fz')):
+        with fits.open(filename) as image:
+            CRPIX1 = int(image[1].header['CRPIX1'])
+            CRPIX2 = int(image[1].header['CRPIX2'])
+            band = agupinholesearch.read_band(image[1].section, CRPIX2)
+            full = np.median(image[1].data[350:-350, 350:-350])
+        assert abs(agupinholesearch.estimate_background(band, CRPIX1) - full) < 5, filename
+
+
+def test_star_rejection_from_band():
+    rng = np.random.default_rng(1)
+    for contaminated in [False, True] * 3:
+        data = agusynthetic.make_frame(780.3, 550.6, rng, starcontamination=contaminated)
+        band = agupinholesearch.read_band(data, 550)
+        extractdata = agupinholesearch.extract_cutout(band, 780, 550, first_row=550 - agupinholesearch.EXTRACT_FRAMESIZE)
+        np.testing.assert_array_equal(extractdata, agupinholesearch.extract_cutout(data, 780, 550))
+        background = agupinholesearch.estimate_background(band, 780)
+        assert agupinholesearch.is_star_contaminated(extractdata, background) == contaminated
+
+
+def test_star_on_pinhole_does_not_raise_background():
+    data = agusynthetic.make_frame(780.3, 550.6, np.random.default_rng(2))
+    band = agupinholesearch.read_band(data, 550)
+    background = agupinholesearch.estimate_background(band, 780)
+    band[:, 780 - agupinholesearch.EXTRACT_FRAMESIZE: 780 + agupinholesearch.EXTRACT_FRAMESIZE - 1] += 1000
+    assert agupinholesearch.estimate_background(band, 780) == background
@@ -0,0 +1,29 @@
+import json
+
+import numpy as np
+
+from lcogt_nres_aguanalysis import agupinholesearch
+
+
+def test_registry_loads_known_cameras():
+    badpixels = agupinholesearch.load_badpixels()
+    x, y = badpixels['ak05']
+    assert (x[0], y[0]) == (716 - 1, 590 - 1)
+    assert 'ak16' in badpixels
+
+
+def test_fix_badpixels_only_inside_cutout(tmp_path):
+    registry = tmp_path / 'badpixels.json'
+    registry.write_text(json.dumps({'ak99': [[11, 21], [101, 21], [500, 500]]}))
+    badpixels = agupinholesearch.load_badpixels(str(registry))
+
+    cutout = np.ones((20, 20))
+    cutout[10, 0] = 1000  # frame pixel 101, 21 in ds9 coordinates, at the left border of the cutout
+    cutout[10, 1] = 3
+    agupinholesearch.fix_badpixels(cutout, 'ak99', 100, 10, badpixels)
+    assert cutout[10, 0] == 3
+    assert cutout[10, 1] == 3
+
+    untouched = cutout.copy()
+    agupinholesearch.fix_badpixels(cutout, 'ak01', 100, 10, badpixels)
+    np.testing.assert_array_equal(cutout, untouched)
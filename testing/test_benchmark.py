@@ -0,0 +1,25 @@
+import argparse
+import json
+
+from lcogt_nres_aguanalysis import agubenchmark, agupinholesearch
+
+TESTDATADIR = 'testing/testdata'
+
+
+def test_benchmark_records_all_stages():
+    args = argparse.Namespace(testdata=TESTDATADIR, repeat=1, nsynthetic=2, nengineframes=0, npoints=500)
+    results = agubenchmark.run_benchmarks(args)
+
+    for stage in agubenchmark.PIPELINE_STAGES:
+        assert stage in results['benchmarks']['testdata']
+        assert results['benchmarks']['synthetic'][stage]['n'] > 0
+    assert results['handoff']['ring']['seconds_per_frame'] > 0
+    inwindow, offwindow = results['prior_acceptance']['in_window'], results['prior_acceptance']['off_window']
+    assert inwindow['prior_used'] == inwindow['n'] > 0
+    assert offwindow['prior_used'] == 0
+    assert inwindow['min_match'] > agupinholesearch.PRIOR_MIN_MATCH
+    assert (offwindow['max_match'] or 0) < agupinholesearch.PRIOR_MIN_MATCH
+    for stage in ['dbwrite', 'analysis_load', 'analysis_plot']:
+        assert stage in results['benchmarks']['database']
+    # must survive the round trip to a file
+    assert json.loads(json.dumps(results)) == results
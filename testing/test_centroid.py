@@ -0,0 +1,21 @@
+import numpy as np
+
+from lcogt_nres_aguanalysis import agucentroid, agupinholesearch
+
+ACCURACY = 0.3
+
+
+def test_engines_recover_synthetic_positions():
+    results = agucentroid.benchmark_engines(nframes=10)
+    for engine in agucentroid.CENTROID_ENGINES:
+        assert results[engine]['rms'] < ACCURACY, engine
+
+
+def test_engines_agree_on_analytic_peak():
+    # symmetric peak at a known sub-pixel location
+    y, x = np.mgrid[0:119, 0:119]
+    cor = np.exp(-((x - 60.3) ** 2 + (y - 57.8) ** 2) / (2 * 4. ** 2))
+    for engine in agucentroid.CENTROID_ENGINES:
+        xo, yo, peak_x, peak_y = agupinholesearch.find_centroid(cor, engine)
+        assert abs(xo - agupinholesearch.CORRELATION_OFFSET - 60.3) < 0.05, engine
+        assert abs(yo - agupinholesearch.CORRELATION_OFFSET - 57.8) < 0.05, engine
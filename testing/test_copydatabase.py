@@ -0,0 +1,67 @@
+import datetime
+import importlib.util
+import sys
+
+import pytest
+import sqlalchemy
+
+from lcogt_nres_aguanalysis import agupinholedb
+
+spec = importlib.util.spec_from_file_location('copydatabase', 'migrationtools/copydatabase.py')
+copydatabase = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(copydatabase)
+# the parallel copy pickles copy_range by module name
+sys.modules['copydatabase'] = copydatabase
+
+
+def make_v1_database(database, nrows):
+    session = agupinholedb.get_session(database, Base=agupinholedb.Base_v1)
+    agupinholedb.Base_v1.metadata.create_all(session.get_bind())
+    start = datetime.datetime(2019, 1, 1)
+    session.bulk_save_objects([agupinholedb.PinholeMeasurement_v1(
+        imagename=f'/archive/engineering/lsc/ak01/raw/lsc1m005-ak01-{ii:06d}-x00.fits.fz', instrument='ak01',
+        altitude=60., azimut=180., xcenter=780. + ii % 7, ycenter=550., dateobs=start + datetime.timedelta(hours=ii),
+        foctemp=10.) for ii in range(nrows)])
+    session.commit()
+    session.close()
+
+
+def test_chunked_parallel_copy_resumes(tmp_path, monkeypatch):
+    inputurl = f'sqlite:///{tmp_path}/v1.sqlite'
+    outputurl = f'sqlite:///{tmp_path}/v2.sqlite'
+    make_v1_database(inputurl, 1000)
+
+    # fail in the middle of the copy, in each of the range processes
+    convert = agupinholedb.pinholefrompinhole_v1
+    calls = []
+
+    def failing(e):
+        calls.append(e.imagename)
+        if len(calls) > 250:
+            raise RuntimeError('connection lost')
+        return convert(e)
+
+    monkeypatch.setitem(copydatabase.SCHEMAS, 'v1', (agupinholedb.Base_v1, agupinholedb.PinholeMeasurement_v1, failing))
+    with pytest.raises(RuntimeError):
+        copydatabase.copy_database(inputurl, outputurl, nranges=3, chunksize=100)
+    output = agupinholedb.get_session(outputurl)
+    # two committed chunks of each of the three ~333 row ranges
+    assert output.query(agupinholedb.PinholeMeasurement).count() == 600
+
+    monkeypatch.setitem(copydatabase.SCHEMAS, 'v1', (agupinholedb.Base_v1, agupinholedb.PinholeMeasurement_v1, convert))
+    assert copydatabase.copy_database(inputurl, outputurl, nranges=3, chunksize=100) == 400
+    assert output.query(agupinholedb.PinholeMeasurement).count() == 1000
+    assert output.query(copydatabase.CopyCheckpoint).count() == 3
+    record = output.query(agupinholedb.PinholeMeasurement).get('lsc1m005-ak01-000123-x00.fits.fz')
+    assert record.telescopeidentifier == 'lsc-domb-1m0a'
+    assert record.xcenter == 780. + 123 % 7
+    # nothing left to do
+    assert copydatabase.copy_database(inputurl, outputurl, nranges=3, chunksize=100) == 0
+
+
+def test_reading_v1_database_creates_no_tables(tmp_path):
+    inputurl = f'sqlite:///{tmp_path}/v1.sqlite'
+    make_v1_database(inputurl, 10)
+    session = agupinholedb.get_session(inputurl, Base=agupinholedb.Base_v1)
+    assert sqlalchemy.inspect(session.get_bind()).get_table_names() == ['pinholemasurements']
+    session.close()
@@ -0,0 +1,86 @@
+import argparse
+import glob
+
+import numpy as np
+
+from lcogt_nres_aguanalysis import agucutoutstore, agupinholedb, agupinholesearch
+
+TESTDATADIR = 'testing/testdata'
+
+
+def test_correlate_templates_matches_correlate_template():
+    rng = np.random.default_rng(1)
+    raw = rng.normal(100, 10, size=(3,) + agucutoutstore.CUTOUT_SHAPE)
+    stack = agupinholesearch.normalize_cutouts(raw)
+    template = agupinholesearch.make_template()
+    cor = agupinholesearch.correlate_templates(stack, template)
+    for ii in range(len(stack)):
+        assert np.allclose(agupinholesearch.normalize_cutout(raw[ii].copy()), stack[ii])
+        assert np.allclose(cor[ii], agupinholesearch.correlate_template(stack[ii], template), atol=1e-8)
+
+
+def test_recentroid_from_store_matches_findpinhole(tmp_path):
+    for engine in ['com', 'quadratic']:
+        store = agucutoutstore.CutoutStore(str(tmp_path / engine))
+        args = argparse.Namespace(makepng=False, centroid=engine)
+        reference = {}
+        records = []
+        for filename in sorted(glob.glob(f'{TESTDATADIR}/*.fits.fz')):
+            measurement = agupinholesearch.findPinhole(filename, args, None, cutouts=records)
+            if measurement is not None:
+                reference[measurement.imagename] = measurement
+        assert len(reference) > 0
+        assert store.append(records) == len(records)
+
+        session = agupinholedb.get_session(f'sqlite:///{tmp_path}/{engine}.sqlite')
+        recentroid = argparse.Namespace(cutoutstore=store.root, single=None, recentroidbatch=2, centroid=engine)
+        assert agupinholesearch.recentroidStore(session, recentroid) == len(reference)
+        for imagename, expected in reference.items():
+            measurement = session.query(agupinholedb.PinholeMeasurement).get(imagename)
+            assert abs(measurement.xcenter - expected.xcenter) < 1e-6
+            assert abs(measurement.ycenter - expected.ycenter) < 1e-6
+            assert measurement.dateobs == expected.dateobs
+            assert measurement.telescopeidentifier == expected.telescopeidentifier
+        session.close()
+
+
+def test_store_keeps_last_copy_and_ignores_torn_writes(tmp_path):
+    store = agucutoutstore.CutoutStore(str(tmp_path))
+
+    def record(name, value):
+        return agucutoutstore.make_record(np.full(agucutoutstore.CUTOUT_SHAPE, value), name, 'ak01', 'lsc-domb-1m0a',
+                                          np.datetime64('2021-03-04T05:06:07'), 60., 120., 10., 780, 550, 100.)
+
+    store.append([record('a', 1), record('b', 2), record('a', 3)])
+    # a cutout clipped at the frame edge is not stored
+    assert store.append([record('c', 4), (np.zeros((10, 10), dtype=np.float32), record('d', 5)[1])]) == 1
+    index, cutouts = store.read('ak01', '202103')
+    assert [name.decode() for name in index['imagename']] == ['b', 'a', 'c']
+    assert [cutout[0, 0] for cutout in cutouts] == [2, 3, 4]
+
+    # a cutout without its index record is not read back
+    with open(tmp_path / 'ak01' / '202103' / agucutoutstore.CUTOUT_FILE, 'ab') as f:
+        f.write(np.zeros(agucutoutstore.CUTOUT_SHAPE, dtype=agucutoutstore.CUTOUT_DTYPE).tobytes())
+    assert store.count() == {'ak01': 3}
+
+
+def test_append_after_an_interrupted_write(tmp_path):
+    store = agucutoutstore.CutoutStore(str(tmp_path))
+
+    def record(name, value):
+        return agucutoutstore.make_record(np.full(agucutoutstore.CUTOUT_SHAPE, value), name, 'ak01', 'lsc-domb-1m0a',
+                                          np.datetime64('2021-03-04T05:06:07'), 60., 120., 10., 780, 550, 100.)
+
+    store.append([record('img1', 1)])
+    chunk = tmp_path / 'ak01' / '202103'
+    # interrupted: the cutout of img2 is written, and part of its index record
+    with open(chunk / agucutoutstore.CUTOUT_FILE, 'ab') as f:
+        f.write(record('img2', 2)[0].tobytes())
+    with open(chunk / agucutoutstore.INDEX_FILE, 'ab') as f:
+        f.write(record('img2', 2)[1].tobytes()[:10])
+    assert store.count() == {'ak01': 1}
+
+    store.append([record('img3', 3)])
+    index, cutouts = store.read('ak01', '202103')
+    assert [name.decode() for name in index['imagename']] == ['img1', 'img3']
+    assert [cutout[0, 0] for cutout in cutouts] == [1, 3]
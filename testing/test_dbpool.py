@@ -0,0 +1,37 @@
+import multiprocessing
+
+from lcogt_nres_aguanalysis import agupinholedb
+
+
+def _child_stats(database, results):
+    session = agupinholedb.get_session(database)
+    session.query(agupinholedb.PinholeMeasurement).count()
+    session.close()
+    results.put(agupinholedb.connection_stats())
+
+
+def test_engine_is_shared_and_reset_after_fork(tmp_path):
+    database = f'sqlite:///{tmp_path}/pool.sqlite'
+    agupinholedb.create_db(database)
+    for ii in range(5):
+        session = agupinholedb.get_session(database)
+        session.query(agupinholedb.PinholeMeasurement).count()
+        session.close()
+    engine = agupinholedb.get_engine(database)
+    assert agupinholedb.get_engine(database) is engine
+
+    stats = agupinholedb.connection_stats()[database]
+    assert stats['engines'] == 1
+    # create_db for all tables, get_session for the measurement table; both once.
+    assert stats['schema_checks'] == 2
+    assert stats['checkouts'] >= 5
+
+    results = multiprocessing.get_context('fork').Queue()
+    child = multiprocessing.get_context('fork').Process(target=_child_stats, args=(database, results))
+    child.start()
+    childstats = results.get(timeout=30)
+    child.join()
+    # the child started with a fresh engine of its own, and did not check the schema again
+    assert childstats[database]['engines'] == 1
+    assert childstats[database]['schema_checks'] == 0
+    assert agupinholedb.get_engine(database) is engine
@@ -0,0 +1,33 @@
+import datetime
+
+from lcogt_awsarchiveaccess.lco_archive_utilities import ArchiveDiskCrawler, ScandirArchiveCrawler
+from lcogt_nres_aguanalysis import agusynthetic
+
+
+def test_scandir_crawler_matches_glob_and_caches(tmp_path):
+    startdate = datetime.date(2021, 3, 1)
+    agusynthetic.generate_frames(str(tmp_path), cameras=['ak01', 'ak02'], nights=2, framespernight=2,
+                                 startdate=startdate)
+    dates = ['20210301', '20210302', '20210303']
+    cachefile = str(tmp_path / 'listing.json')
+
+    crawler = ScandirArchiveCrawler(str(tmp_path), nthreads=4, cachefile=cachefile)
+    cameras = crawler.find_cameras(sites=['lsc', 'cpt'], cameras=['ak??'])
+    assert sorted(cameras) == [f'{tmp_path}/lsc/ak01', f'{tmp_path}/lsc/ak02']
+
+    listings = {(camera, date): files for camera, date, files in
+                crawler.iter_files_for_cameras_dates(cameras, dates, 'raw', '*[x]00.fits*')}
+    assert len(listings) == 6
+    for (camera, date), files in listings.items():
+        table = ArchiveDiskCrawler.findfiles_for_camera_dates(camera, date, 'raw', '*[x]00.fits*')
+        expected = [] if table is None else sorted(table['filename'])
+        assert [f['filename'] for f in files] == expected
+
+    # second run comes from the cache, and a new night shows up despite its missing directory being cached.
+    agusynthetic.generate_frames(str(tmp_path), cameras=['ak01'], nights=1, framespernight=1,
+                                 startdate=datetime.date(2021, 3, 3))
+    crawler = ScandirArchiveCrawler(str(tmp_path), nthreads=4, cachefile=cachefile)
+    listings = {(camera, date): files for camera, date, files in
+                crawler.iter_files_for_cameras_dates(cameras, dates, 'raw', '*[x]00.fits*')}
+    assert crawler.cachehits == 5
+    assert len(listings[(f'{tmp_path}/lsc/ak01', '20210303')]) == 1
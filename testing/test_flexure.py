@@ -0,0 +1,198 @@
+import datetime
+import json
+import threading
+
+import matplotlib
+import numpy as np
+import sqlalchemy
+
+matplotlib.use('Agg')
+
+from lcogt_nres_aguanalysis import aguanalysis, aguflexure, agupinholedb
+
+TRUTH = {'sin(alt)': (1.5, -0.8), 'cos(alt)': (-2.0, 0.5), 'sin(az)': (0.3, 0.2), 'cos(az)': (-0.4, 0.6),
+         'foctemp': (0.05, -0.03)}
+NOISE = 0.1
+
+
+def make_measurements(n, seed=0, camera='ak01'):
+    rng = np.random.default_rng(seed)
+    start = datetime.datetime(2021, 1, 1)
+    measurements = []
+    for ii in range(n):
+        dateobs = start + datetime.timedelta(hours=6 * ii)
+        alt, az, temp = rng.uniform(20, 90), rng.uniform(0, 360), rng.uniform(-5, 25)
+        f = aguflexure.features(alt, az, temp)[1:]
+        # a camera re-mount every month
+        offset = np.asarray([780., 550.]) + 3 * (dateobs.month % 2)
+        x, y = offset + f @ np.asarray([TRUTH[feature] for feature in aguflexure.FEATURES]) + \
+            rng.normal(0, NOISE, size=2)
+        measurements.append(agupinholedb.PinholeMeasurement(
+            imagename=f'{camera}-{ii}', instrument=camera, altitude=alt, azimut=az, foctemp=temp, xcenter=x,
+            ycenter=y, dateobs=dateobs))
+    return measurements
+
+
+def write(session, measurements):
+    update = aguflexure.StatisticsUpdate()
+    update.merge_all(session, measurements)
+    update.apply(session)
+    session.commit()
+
+
+def test_incremental_fit_recovers_model(tmp_path):
+    session = agupinholedb.get_session(f'sqlite:///{tmp_path}/flexure.sqlite')
+    measurements = make_measurements(400)
+    write(session, measurements[:250])
+    write(session, measurements[250:])
+
+    model = aguflexure.fit_camera(session, 'ak01')
+    assert model.n == 400
+    assert len(model.offsets) == 4
+    for feature, (x, y) in TRUTH.items():
+        assert abs(model.coefficients[feature][0] - x) < 4 * model.uncertainties[feature][0] + 1e-3
+        assert abs(model.coefficients[feature][1] - y) < 4 * model.uncertainties[feature][1] + 1e-3
+    assert 0.8 * NOISE < model.rms[0] < 1.2 * NOISE
+
+    # same as a direct least-squares fit with one offset column per month
+    months = sorted(set(aguflexure.month_of(m.dateobs) for m in measurements))
+    design = np.asarray([list(aguflexure.features(m.altitude, m.azimut, m.foctemp)[1:]) +
+                         [float(aguflexure.month_of(m.dateobs) == month) for month in months] for m in measurements])
+    solution = np.linalg.lstsq(design, np.asarray([[m.xcenter, m.ycenter] for m in measurements]), rcond=None)[0]
+    for ii, feature in enumerate(aguflexure.FEATURES):
+        assert np.allclose(model.coefficients[feature], solution[ii], atol=1e-6)
+
+    residuals = model.residuals([m.altitude for m in measurements], [m.azimut for m in measurements],
+                                [m.foctemp for m in measurements], [aguflexure.month_of(m.dateobs) for m in measurements],
+                                [m.xcenter for m in measurements], [m.ycenter for m in measurements])
+    assert abs(np.std(residuals[0]) - NOISE) < 0.2 * NOISE
+    session.close()
+
+
+def test_replaced_measurements_and_rebuild(tmp_path):
+    session = agupinholedb.get_session(f'sqlite:///{tmp_path}/flexure.sqlite')
+    write(session, make_measurements(100))
+    # reprocessing replaces the measurements, e.g., with another centroid engine
+    replaced = make_measurements(100, seed=1)
+    write(session, replaced[:60])
+    incremental = aguflexure.load_statistics(session, 'ak01')
+
+    assert aguflexure.rebuild_statistics(session) == 100
+    rebuilt = aguflexure.load_statistics(session, 'ak01')
+    assert sorted(incremental) == sorted(rebuilt)
+    for month, statistics in rebuilt.items():
+        assert incremental[month].n == statistics.n
+        assert np.allclose(incremental[month].xtx, statistics.xtx)
+        assert np.allclose(incremental[month].xty, statistics.xty)
+        assert np.allclose(incremental[month].yty, statistics.yty)
+    session.close()
+
+
+def test_merge_all_matches_merge_with_one_lookup_per_chunk(tmp_path, monkeypatch):
+    monkeypatch.setattr(aguflexure.StatisticsUpdate, 'LOOKUP_CHUNK', 40)
+    sessions = {}
+    for way in ['merge', 'merge_all']:
+        session = sessions[way] = agupinholedb.get_session(f'sqlite:///{tmp_path}/{way}.sqlite')
+        write(session, make_measurements(50))
+        # a third replaces stored measurements, the rest is new, and one image is in the batch twice
+        batch = make_measurements(100, seed=1)[25:] + make_measurements(51, seed=2)[50:]
+        selects = []
+        sqlalchemy.event.listen(session.get_bind(), 'before_cursor_execute',
+                                lambda conn, cursor, statement, *args: selects.append(statement)
+                                if statement.startswith('SELECT') else None)
+        update = aguflexure.StatisticsUpdate()
+        if way == 'merge':
+            # merge() can not take the same image twice before a flush
+            for measurement in batch[:25] + batch[26:]:
+                update.merge(session, measurement)
+        else:
+            update.merge_all(session, batch)
+            assert len(selects) == 2
+        update.apply(session)
+        session.commit()
+    for month, statistics in aguflexure.load_statistics(sessions['merge'], 'ak01').items():
+        other = aguflexure.load_statistics(sessions['merge_all'], 'ak01')[month]
+        assert statistics.n == other.n
+        assert np.allclose(statistics.xtx, other.xtx) and np.allclose(statistics.xty, other.xty)
+    assert aguflexure.rebuild_statistics(sessions['merge_all']) == 100
+    for month, statistics in aguflexure.load_statistics(sessions['merge_all'], 'ak01').items():
+        assert np.allclose(statistics.xty, aguflexure.load_statistics(sessions['merge'], 'ak01')[month].xty)
+    for session in sessions.values():
+        session.close()
+
+
+def test_concurrent_writers_add_up(tmp_path):
+    database = f'sqlite:///{tmp_path}/concurrent.sqlite'
+    agupinholedb.create_db(database)
+    batches = [make_measurements(60, seed=seed, camera='ak01')[ii::2] for ii, seed in enumerate([3, 4])]
+    ready = threading.Barrier(2)
+    errors = []
+
+    def writer(batch):
+        session = agupinholedb.get_session(database)
+        try:
+            update = aguflexure.StatisticsUpdate()
+            update.merge_all(session, batch)
+            # both writers have their changes before either applies them
+            ready.wait()
+            update.apply(session)
+            session.commit()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            session.close()
+
+    threads = [threading.Thread(target=writer, args=(batch,)) for batch in batches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    session = agupinholedb.get_session(database)
+    incremental = aguflexure.load_statistics(session, 'ak01')
+    assert sum(statistics.n for statistics in incremental.values()) == 60
+    aguflexure.rebuild_statistics(session)
+    for month, statistics in aguflexure.load_statistics(session, 'ak01').items():
+        assert incremental[month].n == statistics.n
+        assert np.allclose(incremental[month].xty, statistics.xty)
+    session.close()
+
+
+def test_apply_adds_to_a_row_created_by_another_writer(tmp_path, monkeypatch):
+    database = f'sqlite:///{tmp_path}/race.sqlite'
+    agupinholedb.create_db(database)
+    measurements = make_measurements(20)
+    other = agupinholedb.get_session(database)
+    write(other, measurements[:10])
+    other.close()
+
+    # the row does not exist yet when this writer looks, and exists when it inserts
+    one_or_none = sqlalchemy.orm.Query.one_or_none
+    calls = []
+
+    def missed_once(query):
+        calls.append(query)
+        return None if len(calls) == 1 else one_or_none(query)
+
+    monkeypatch.setattr(sqlalchemy.orm.Query, 'one_or_none', missed_once)
+    session = agupinholedb.get_session(database)
+    write(session, measurements[10:])
+    monkeypatch.undo()
+    # the insert failed, and the second lookup found the row
+    assert len(calls) == 2
+    assert sum(statistics.n for statistics in aguflexure.load_statistics(session, 'ak01').values()) == 20
+    assert session.query(agupinholedb.PinholeMeasurement).count() == 20
+    session.close()
+
+
+def test_aguanalysis_writes_flexure_model(tmp_path):
+    database = f'sqlite:///{tmp_path}/flexure.sqlite'
+    session = agupinholedb.get_session(database)
+    write(session, make_measurements(200, camera='ak05'))
+    session.close()
+
+    aguanalysis.plotagutrends('ak05', sql=database, outputpath=str(tmp_path))
+    with open(tmp_path / 'flexuremodel_ak05.json') as f:
+        model = json.load(f)
+    assert model['n'] == 200
+    assert (tmp_path / 'flexuremodel_pinhole_ak05.png').exists()
@@ -0,0 +1,30 @@
+import json
+
+from lcogt_nres_aguanalysis.agumetrics import MetricsRegistry
+
+
+def test_worker_snapshot_merges_into_parent(tmp_path):
+    worker = MetricsRegistry()
+    for seconds in [0.002, 0.02, 0.2]:
+        worker.observe('correlate', seconds)
+    worker.count('download_bytes', 1000)
+    worker.gauge('pool_pending', 4)
+
+    parent = MetricsRegistry()
+    parent.observe('correlate', 2.)
+    parent.merge(worker.snapshot())
+    parent.merge(worker.snapshot())
+
+    assert parent.histograms['correlate'].count == 7
+    assert parent.histograms['correlate'].max == 2.
+    assert parent.counters['download_bytes'] == 2000
+    assert parent.gauges['pool_pending'] == (4, 4)
+
+    parent.write(str(tmp_path / 'metrics.json'))
+    summary = json.load(open(tmp_path / 'metrics.json'))
+    assert summary['stages']['correlate']['p50'] == 0.025
+
+    parent.write(str(tmp_path / 'metrics.prom'), prefix='test')
+    prom = open(tmp_path / 'metrics.prom').read()
+    assert 'test_stage_seconds_bucket{stage="correlate",le="+Inf"} 7' in prom
+    assert 'test_download_bytes_total 2000' in prom
@@ -0,0 +1,49 @@
+import argparse
+import datetime
+
+from lcogt_nres_aguanalysis import agucentroid, agumetrics, agupinholedb, agupinholesearch
+
+TESTDATA = {'tlv1m0XX-ak14-20210501-0127-e00.fits.fz': {'x': 782.6, 'y': 586.5},
+            'tlv1m0XX-ak13-20201128-1029-x00.fits.fz': {'x': 782.5, 'y': 546.6}, }
+TESTDATADIR = 'testing/testdata'
+CENTERTOLERANCE = 2
+
+
+def test_prior_window_and_fallback():
+    args = argparse.Namespace(makepng=False)
+    agumetrics.metrics.reset()
+    for image, truth in TESTDATA.items():
+        # a good prior, and one where the camera has moved since, so the window misses the pinhole
+        for prior in [(truth['x'] + 1.5, truth['y'] - 1.2), (truth['x'] + 30, truth['y'] + 30)]:
+            measurement = agupinholesearch.findPinhole(f'{TESTDATADIR}/{image}', args, None, prior=prior)
+            assert abs(measurement.xcenter - truth['x']) < CENTERTOLERANCE, f"X center in {image} with {prior}"
+            assert abs(measurement.ycenter - truth['y']) < CENTERTOLERANCE, f"Y center in {image} with {prior}"
+    assert agumetrics.metrics.counters['prior_used'] == 2
+    assert agumetrics.metrics.counters['prior_fallback'] == 2
+
+
+def test_prior_window_matches_full_search():
+    # the prior window only saves time: every centroid engine gives the full search result
+    for engine in agucentroid.CENTROID_ENGINES:
+        args = argparse.Namespace(makepng=False, centroid=engine)
+        for image, truth in TESTDATA.items():
+            full = agupinholesearch.findPinhole(f'{TESTDATADIR}/{image}', args, None)
+            for prior in [(truth['x'] + 1.5, truth['y'] - 1.2), (truth['x'] - 4, truth['y'] + 4)]:
+                agumetrics.metrics.reset()
+                measurement = agupinholesearch.findPinhole(f'{TESTDATADIR}/{image}', args, None, prior=prior)
+                assert agumetrics.metrics.counters == {'prior_used': 1}
+                assert agumetrics.metrics.gauges['prior_match'][0] > agupinholesearch.PRIOR_MIN_MATCH + 0.2
+                assert abs(measurement.xcenter - full.xcenter) < 1e-6, f"{engine} X center in {image} with {prior}"
+                assert abs(measurement.ycenter - full.ycenter) < 1e-6, f"{engine} Y center in {image} with {prior}"
+
+
+def test_recent_location_from_database(tmp_path):
+    session = agupinholedb.get_session(f'sqlite:///{tmp_path}/prior.sqlite')
+    start = datetime.datetime(2021, 1, 1)
+    for ii in range(20):
+        session.add(agupinholedb.PinholeMeasurement(imagename=f'image{ii}', instrument='ak01',
+                                                    xcenter=700. if ii < 5 else 780. + ii % 2,
+                                                    ycenter=550., dateobs=start + datetime.timedelta(days=ii)))
+    session.commit()
+    assert agupinholedb.get_recent_location(session, 'ak01') == (780.5, 550.)
+    assert agupinholedb.get_recent_location(session, 'ak02') is None
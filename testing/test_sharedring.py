@@ -0,0 +1,82 @@
+import argparse
+import glob
+import multiprocessing
+
+import numpy as np
+
+from lcogt_nres_aguanalysis import agucutoutstore, agupinholedb, agupinholesearch, agusharedring
+
+TESTDATADIR = 'testing/testdata'
+
+
+def _fill(ring, slot, value):
+    ring.slots['cutout'][slot] = value
+    ring.slots['ncutouts'][slot] = 1
+
+
+def test_ring_is_shared_with_spawned_processes():
+    with agusharedring.SharedRing(3, agupinholesearch.frame_slot_dtype(1024)) as ring:
+        slots = [ring.acquire() for ii in range(3)]
+        try:
+            ring.acquire()
+            assert False, "no free slot left"
+        except RuntimeError:
+            pass
+        # a spawned process attaches by name
+        process = multiprocessing.get_context('spawn').Process(target=_fill, args=(ring, slots[1], 7.))
+        process.start()
+        process.join(60)
+        assert process.exitcode == 0
+        assert np.all(ring.slots['cutout'][slots[1]] == 7.) and ring.slots['ncutouts'][slots[1]] == 1
+        assert ring.slots['ncutouts'][slots[0]] == 0
+        ring.release(slots[1])
+        assert ring.acquire() == slots[1]
+
+
+def test_cutouts_come_back_through_the_ring(tmp_path):
+    filenames = sorted(glob.glob(f'{TESTDATADIR}/*.fits.fz'))
+    reference = []
+    for filename in filenames:
+        agupinholesearch.findPinhole(filename, argparse.Namespace(makepng=False), None, cutouts=reference)
+
+    database = f'sqlite:///{tmp_path}/ring.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    args = argparse.Namespace(makepng=False, useaws=False, reprocess=True, ncpu=2, profile=False,
+                              cutoutstore=str(tmp_path / 'store'))
+    failed, retry = agupinholesearch.findPinHoleInImages([{'filename': f, 'frameid': -1} for f in filenames],
+                                                         session, args)
+    assert failed == [] and retry == []
+    session.close()
+
+    store = agucutoutstore.CutoutStore(args.cutoutstore)
+    stored = {}
+    for camera, index, cutouts in store.iter_batches():
+        for record, cutout in zip(index, cutouts):
+            stored[record['imagename']] = (record, cutout)
+    assert len(stored) == len(reference)
+    for cutout, record in reference:
+        storedrecord, storedcutout = stored[record['imagename']]
+        assert np.array_equal(storedcutout, cutout)
+        assert storedrecord.tobytes() == record.tobytes()
+
+
+def test_frame_opens_in_place_from_a_slot():
+    filename = f'{TESTDATADIR}/tlv1m0XX-ak14-20210501-0127-e00.fits.fz'
+    with open(filename, 'rb') as f:
+        content = f.read()
+    with agusharedring.SharedRing(1, agupinholesearch.frame_slot_dtype(len(content) + 100)) as ring:
+        slot = ring.acquire()
+        ring.slots['content'][slot, :len(content)] = np.frombuffer(content, dtype=np.uint8)
+        buffer = agusharedring.BufferFile(ring.slots['content'][slot, :len(content)])
+        # the file reads the slot itself, not a copy of it
+        assert np.shares_memory(np.asarray(buffer.buffer), ring.slots['content'])
+        image = agupinholesearch.read_frame(None, content=ring.slots['content'][slot, :len(content)])
+        reference = agupinholesearch.read_frame(filename)
+        assert image[1].header == reference[1].header
+        assert np.array_equal(image[1].section[500:600, 700:800], reference[1].section[500:600, 700:800])
+        image.close()
+        reference.close()
+        buffer.seek(-80, 2)
+        assert buffer.read() == content[-80:] and buffer.read(10) == b''
+        buffer.close()
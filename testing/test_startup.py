@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+from lcogt_nres_aguanalysis import agubenchmark
+
+HEAVY_MODULES = ['matplotlib', 'scipy.signal', 'astropy.io.fits', 'opensearchpy', 'boto3']
+
+
+def loaded_modules(module):
+    output = subprocess.run([sys.executable, '-c', f'import sys, {module}; print(" ".join(sys.modules))'],
+                            capture_output=True, text=True, check=True).stdout
+    return set(output.split())
+
+
+def test_entry_points_import_light():
+    for module in ['lcogt_nres_aguanalysis.agupinholesearch', 'lcogt_nres_aguanalysis.aguanalysis']:
+        loaded = loaded_modules(module)
+        assert [heavy for heavy in HEAVY_MODULES if heavy in loaded] == [], module
+
+
+def test_parse_importtime():
+    output = ("import time: self [us] | cumulative | imported package\n"
+              "import time:       100 |        100 | lcogt_nres_aguanalysis\n"
+              "import time:        50 |         50 |     numpy.core\n"
+              "import time:      2000 |       2050 |   numpy\n"
+              "import time:       300 |        300 |   json\n"
+              "import time:      1000 |       3350 | lcogt_nres_aguanalysis.aguanalysis\n")
+    imports = agubenchmark.parse_importtime(output)
+    assert imports[0] == ('lcogt_nres_aguanalysis', 100e-6, 100e-6, 0)
+    assert imports[-1][2] == 3350e-6
+    assert [name for name, cumulative in agubenchmark.direct_imports(imports, 'lcogt_nres_aguanalysis.aguanalysis')] \
+        == ['numpy', 'json']
+
+
+def test_archive_access_does_not_import_the_application():
+    loaded = loaded_modules('lcogt_awsarchiveaccess.lco_archive_utilities')
+    assert [module for module in loaded if module.startswith('lcogt_nres_aguanalysis')] == []
@@ -0,0 +1,78 @@
+import argparse
+
+from lcogt_awsarchiveaccess import lco_archive_utilities
+from lcogt_nres_aguanalysis import agupinholedb, agupinholesearch, agusynthetic
+
+CENTERTOLERANCE = 0.5
+
+
+def test_crawl_against_standins(tmp_path, monkeypatch):
+    records = agusynthetic.generate_frames(str(tmp_path), cameras=['ak01', 'ak02'], nights=1, framespernight=3,
+                                           starcontamination=0)
+    truth = {r['frameid']: r for r in records}
+    server = agusynthetic.start_server(str(tmp_path))
+    monkeypatch.setattr(lco_archive_utilities, 'ARCHIVE_API_URL', server.url)
+    args = argparse.Namespace(makepng=False)
+
+    try:
+        files = lco_archive_utilities.get_frames_by_identifiers(records[0]['DAY-OBS'], camera='ak02', mintexp=5,
+                                                                obstype='EXPERIMENTAL', rlevel=0, es_url=server.url)
+        assert len(files) == 3
+        for image in files:
+            record = truth[int(image['frameid'])]
+            assert record['INSTRUME'] == 'ak02'
+            measurement = agupinholesearch.findPinhole(image['filename'], args, int(image['frameid']))
+            assert abs(measurement.xcenter - record['xcenter']) < CENTERTOLERANCE
+            assert abs(measurement.ycenter - record['ycenter']) < CENTERTOLERANCE
+    finally:
+        server.shutdown()
+
+
+def test_range_fetch_against_standins(tmp_path, monkeypatch):
+    records = agusynthetic.generate_frames(str(tmp_path), cameras=['ak01'], nights=1, framespernight=2,
+                                           starcontamination=0)
+    args = argparse.Namespace(makepng=False, rangefetch=True)
+    for ranges in [True, False]:
+        server = agusynthetic.start_server(str(tmp_path), ranges=ranges)
+        monkeypatch.setattr(lco_archive_utilities, 'ARCHIVE_API_URL', server.url)
+        try:
+            for record in records:
+                measurement = agupinholesearch.findPinhole(record['filename'], args, record['frameid'])
+                assert abs(measurement.xcenter - record['xcenter']) < CENTERTOLERANCE
+                assert abs(measurement.ycenter - record['ycenter']) < CENTERTOLERANCE
+            filesize = sum((tmp_path / record['path']).stat().st_size for record in records)
+            if ranges:
+                assert server.bytes_sent < filesize / 4
+            else:
+                assert server.bytes_sent == filesize
+        finally:
+            server.shutdown()
+
+
+def test_bulk_fetch_against_standins(tmp_path, monkeypatch):
+    records = agusynthetic.generate_frames(str(tmp_path / 'data'), cameras=['ak01'], nights=1, framespernight=6,
+                                           starcontamination=0)
+    server = agusynthetic.start_server(str(tmp_path / 'data'))
+    monkeypatch.setattr(lco_archive_utilities, 'ARCHIVE_API_URL', server.url)
+    try:
+        frameids = [r['frameid'] for r in records] + [1]
+        fetched = dict(lco_archive_utilities.iter_frames_from_archive(frameids, concurrency=4))
+        assert sorted(fetched) == sorted(frameids)
+        assert isinstance(fetched[1], Exception)
+        for record in records:
+            assert fetched[record['frameid']] == (tmp_path / 'data' / record['path']).read_bytes()
+
+        database = f'sqlite:///{tmp_path}/bulk.sqlite'
+        agupinholedb.create_db(database)
+        session = agupinholedb.get_session(database)
+        args = argparse.Namespace(makepng=False, useaws=True, reprocess=False, ncpu=1, profile=False,
+                                  fetchconcurrency=4, rangefetch=True)
+        files = [{'filename': r['filename'], 'frameid': r['frameid']} for r in records]
+        failed, retry = agupinholesearch.findPinHoleInImages(files, session, args)
+        assert failed == [] and retry == []
+        for record in records:
+            measurement = session.query(agupinholedb.PinholeMeasurement).get(record['filename'])
+            assert abs(measurement.xcenter - record['xcenter']) < CENTERTOLERANCE
+            assert abs(measurement.ycenter - record['ycenter']) < CENTERTOLERANCE
+    finally:
+        server.shutdown()
@@ -0,0 +1,100 @@
+import datetime
+
+import matplotlib
+import numpy as np
+
+matplotlib.use('Agg')
+
+from lcogt_nres_aguanalysis import aguanalysis, agumetrics, agupinholedb
+
+
+def test_telescope_history_segments(tmp_path):
+    database = f'sqlite:///{tmp_path}/history.sqlite'
+    session = agupinholedb.get_session(database)
+    start = datetime.datetime(2020, 1, 1)
+    # ak01 is swapped for ak02 and back; ak03 is on another telescope
+    cameras = ['ak01'] * 3 + ['ak02'] * 2 + ['ak01'] * 2
+    for ii, camera in enumerate(cameras):
+        session.add(agupinholedb.PinholeMeasurement(
+            imagename=f'{camera}-{ii}.fits.fz', instrument=camera, telescopeidentifier='lsc-domb-1m0a',
+            xcenter=780. + ii, ycenter=None if ii == 1 else 550., crpix1=780., crpix2=550.,
+            dateobs=start + datetime.timedelta(days=ii)))
+    session.add(agupinholedb.PinholeMeasurement(imagename='ak03-0.fits.fz', instrument='ak03',
+                                                telescopeidentifier='lsc-domc-1m0a', dateobs=start))
+    session.commit()
+
+    history = aguanalysis.readTelescopeHistory('lsc-domb-1m0a', database)
+    assert len(history) == 7
+    assert history.segments == [('ak01', 0, 3), ('ak02', 3, 5), ('ak01', 5, 7)]
+    assert history.cameras == ['ak01', 'ak02']
+    assert history.swaps == [start + datetime.timedelta(days=3), start + datetime.timedelta(days=5)]
+    np.testing.assert_array_equal(history.camera('ak02')['xcenter'], [783., 784.])
+    assert np.isnan(history['ycenter'][1])
+
+    images, alt, az, xs, ys, dobs, foctemps, crpix1, crpix2 = aguanalysis.readPinHoles('ak01', database)
+    assert images == ['ak01-0.fits.fz', 'ak01-1.fits.fz', 'ak01-2.fits.fz', 'ak01-5.fits.fz', 'ak01-6.fits.fz']
+    np.testing.assert_array_equal(xs, history.camera('ak01')['xcenter'])
+
+    assert aguanalysis.listTelescopes(session) == ['lsc-domb-1m0a', 'lsc-domc-1m0a']
+    filename = aguanalysis.plottelescopehistory(history, outputpath=str(tmp_path))
+    assert (tmp_path / filename).stat().st_size > 0
+    assert aguanalysis.plottelescopehistory(history, outputpath=str(tmp_path), filename='lsc_longterm.png') == \
+        'lsc_longterm.png'
+    assert (tmp_path / 'lsc_longterm.png').stat().st_size > 0
+
+
+def test_camera_histories_from_telescope_histories(tmp_path):
+    database = f'sqlite:///{tmp_path}/cameras.sqlite'
+    session = agupinholedb.get_session(database)
+    start = datetime.datetime(2020, 1, 1)
+    # ak01 moves from domb to domc and back, ak02 stays on domb; ak03 has no telescope
+    placement = [('ak01', 'lsc-domb-1m0a'), ('ak02', 'lsc-domb-1m0a'), ('ak01', 'lsc-domc-1m0a'),
+                 ('ak01', 'lsc-domb-1m0a'), ('ak03', None), ('ak04', 'elp-doma-1m0a')]
+    for ii, (camera, telescope) in enumerate(placement):
+        session.add(agupinholedb.PinholeMeasurement(
+            imagename=f'{camera}-{ii}.fits.fz', instrument=camera, telescopeidentifier=telescope, xcenter=780. + ii,
+            ycenter=550., crpix1=780., crpix2=550., dateobs=start + datetime.timedelta(days=ii)))
+    session.commit()
+
+    agumetrics.metrics.reset()
+    telescopes = {}
+    histories = aguanalysis.readCameraHistories(session, ['ak01', 'ak02', 'ak03', 'ak05'], telescopes)
+    # one query per telescope of these cameras, and one for the measurements without a telescope
+    assert sorted(telescopes) == ['lsc-domb-1m0a', 'lsc-domc-1m0a']
+    assert agumetrics.metrics.histograms['db_load'].count == 3
+    for camera in ['ak01', 'ak02', 'ak03', 'ak05']:
+        expected = aguanalysis.readPinHoles(camera, database)
+        got = aguanalysis.pinholeColumns(histories[camera])
+        assert got[0] == expected[0], camera
+        for values, expectedvalues in zip(got[1:], expected[1:]):
+            np.testing.assert_array_equal(values, expectedvalues)
+    assert histories['ak05']['imagename'].shape == (0,)
+    session.close()
+
+
+def test_running_median_residuals_matches_full_window():
+    rng = np.random.default_rng(3)
+    dobs = np.sort(np.datetime64('2021-01-01') + rng.integers(0, 90 * 86400, 500).astype('timedelta64[s]'))
+    values = rng.normal(0, 1, 500)
+    usable = np.abs(values) < 2
+    window = datetime.timedelta(days=3)
+    expected = np.asarray([values[ii] - np.median(values[(dobs > dobs[ii] - window) & (dobs < dobs[ii] + window) &
+                                                         usable]) for ii in range(len(dobs))])
+    assert np.allclose(aguanalysis.running_median_residuals(dobs, values, window, usable), expected)
+    stepped = aguanalysis.running_median_residuals(dobs, values, window, usable, step=aguanalysis.MEDIAN_STEP)
+    assert np.nanmax(np.abs(stepped - expected)) < 0.5
+
+
+def test_decimated_plot_draws_fewer_points():
+    plt = aguanalysis.pyplot()
+    rng = np.random.default_rng(4)
+    x = rng.uniform(0, 1, 100000)
+    y = rng.normal(0, 1, 100000)
+    with plt.rc_context({'savefig.dpi': 100}):
+        plt.figure(figsize=(4, 3), dpi=100)
+        keep = aguanalysis.decimate(x, y, 1, xlim=(0, 0.5))
+        assert 0 < len(keep) < np.sum(x <= 0.5) / 2
+        assert np.all(x[keep] <= 0.5)
+        line, = aguanalysis.plotpoints(x, y, '.', 1, rendermode='decimated')
+    assert line.get_rasterized() and len(line.get_xdata()) < len(x)
+    plt.close()
@@ -0,0 +1,73 @@
+import os
+import time
+
+from lcogt_awsarchiveaccess import lco_archive_utilities
+from lcogt_nres_aguanalysis import agumetrics, agupinholedb, aguworkerpool
+
+
+def _task(name):
+    if name.startswith('hang'):
+        time.sleep(60)
+    elif name.startswith('crash'):
+        os._exit(1)
+    elif name.startswith('bad'):
+        raise ValueError(name)
+    return name.upper()
+
+
+def test_deadlines_replace_hung_and_crashed_workers():
+    names = ['a', 'hang1', 'b', 'crash1', 'c', 'bad1', 'hang2', 'd', 'e', 'f']
+    pool = aguworkerpool.DeadlinePool(_task, nworkers=3, deadline=2)
+    start = time.monotonic()
+    results = {result.key: result for result in pool.map((name, (name,)) for name in names)}
+    elapsed = time.monotonic() - start
+
+    assert sorted(results) == sorted(names)
+    assert elapsed < 20
+    for name in 'abcdef':
+        assert results[name].outcome == 'done' and results[name].value == name.upper()
+    assert results['hang1'].outcome == results['hang2'].outcome == 'timeout'
+    assert results['hang1'].seconds >= 2
+    assert results['crash1'].outcome == 'crashed'
+    assert results['bad1'].outcome == 'error' and 'ValueError' in str(results['bad1'].value)
+    assert agumetrics.metrics.histograms['task'].count >= len(names)
+
+
+def test_fetch_deadline(monkeypatch):
+    def fetch(frameid, rows=None, session=None):
+        time.sleep(30 if frameid == 2 else 0.01)
+        return b'frame %d' % frameid
+
+    monkeypatch.setattr(lco_archive_utilities, 'fetch_frame_content', fetch)
+    start = time.monotonic()
+    fetched = dict(lco_archive_utilities.iter_frames_from_archive([1, 2, 3, 4], concurrency=2, deadline=1))
+    assert time.monotonic() - start < 10
+    assert isinstance(fetched.pop(2), TimeoutError)
+    assert fetched == {1: b'frame 1', 3: b'frame 3', 4: b'frame 4'}
+
+
+def test_fetch_deadline_with_many_transfers(monkeypatch):
+    # the transfers in flight change while the consumer checks them for their deadline
+    def fetch(frameid, rows=None, session=None):
+        time.sleep(0.001 * (frameid % 3))
+        return b'frame %d' % frameid
+
+    monkeypatch.setattr(lco_archive_utilities, 'fetch_frame_content', fetch)
+    fetched = dict(lco_archive_utilities.iter_frames_from_archive(range(2000), concurrency=32, deadline=10))
+    assert fetched == {frameid: b'frame %d' % frameid for frameid in range(2000)}
+
+
+def test_timed_out_work_is_released(tmp_path):
+    database = f'sqlite:///{tmp_path}/queue.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    agupinholedb.enqueue_work(session, [('frame-a.fits.fz', 1, 'ak01'), ('frame-b.fits.fz', 2, 'ak01')])
+    assert len(agupinholedb.claim_work(session, 'worker')) == 2
+    agupinholedb.complete_work(session, ['frame-b.fits.fz'], 'worker')
+    # frame-a timed out; it is queued again until its third attempt
+    assert agupinholedb.release_work(session, ['frame-a.fits.fz'], 'worker', maxattempts=3) == 1
+    for attempt in range(2):
+        assert [item.imagename for item in agupinholedb.claim_work(session, 'worker')] == ['frame-a.fits.fz']
+        agupinholedb.release_work(session, ['frame-a.fits.fz'], 'worker', maxattempts=3)
+    assert agupinholedb.count_work(session) == {'done': 1, 'failed': 1}
+    session.close()
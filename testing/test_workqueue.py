@@ -0,0 +1,71 @@
+import argparse
+import glob
+import multiprocessing
+
+from lcogt_nres_aguanalysis import agupinholedb, agupinholesearch
+
+TESTDATADIR = 'testing/testdata'
+
+
+def _worker(database, owner, results):
+    session = agupinholedb.get_session(database)
+    claimed = []
+    while True:
+        items = agupinholedb.claim_work(session, owner, batchsize=7)
+        if len(items) == 0:
+            break
+        claimed.extend(item.imagename for item in items)
+        agupinholedb.complete_work(session, [item.imagename for item in items], owner)
+    results.put(claimed)
+    session.close()
+
+
+def test_concurrent_claims_are_exclusive(tmp_path):
+    database = f'sqlite:///{tmp_path}/queue.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    names = [f'frame-{ii:04d}-x00.fits.fz' for ii in range(60)]
+    assert agupinholedb.enqueue_work(session, [(name, None, 'ak01') for name in names]) == 60
+    assert agupinholedb.enqueue_work(session, [(name, None, 'ak01') for name in names[:10]]) == 0
+
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_worker, args=(database, f'worker{ii}', results)) for ii in range(4)]
+    for worker in workers:
+        worker.start()
+    claimed = [name for worker in workers for name in results.get(timeout=60)]
+    for worker in workers:
+        worker.join()
+    assert sorted(claimed) == names
+    assert agupinholedb.count_work(session) == {'done': 60}
+
+
+def test_expired_leases_are_requeued(tmp_path):
+    database = f'sqlite:///{tmp_path}/queue.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    agupinholedb.enqueue_work(session, [('frame-a.fits.fz', 1, 'ak01'), ('frame-b.fits.fz', 2, 'ak01')])
+
+    assert len(agupinholedb.claim_work(session, 'crashed', leaseseconds=-1)) == 2
+    assert agupinholedb.claim_work(session, 'other') == []
+    assert agupinholedb.requeue_expired(session, maxattempts=2) == 2
+    items = agupinholedb.claim_work(session, 'other', batchsize=1, leaseseconds=-1)
+    assert [(item.imagename, item.attempts) for item in items] == [('frame-a.fits.fz', 2)]
+    assert agupinholedb.requeue_expired(session, maxattempts=2) == 0
+    assert agupinholedb.count_work(session) == {'failed': 1, 'queued': 1}
+
+
+def test_process_queue(tmp_path):
+    database = f'sqlite:///{tmp_path}/queue.sqlite'
+    agupinholedb.create_db(database)
+    session = agupinholedb.get_session(database)
+    args = argparse.Namespace(queue='enqueue', useaws=False, reprocess=False, ncpu=1, batchsize=3, leaseseconds=60,
+                              makepng=False, profile=False)
+    files = [{'filename': f, 'frameid': '-1'} for f in sorted(glob.glob(f'{TESTDATADIR}/*.fits.fz'))]
+    agupinholesearch.processFiles('/archive/engineering/tlv/ak13', '20201001', files, session, args)
+    assert agupinholedb.count_work(session) == {'queued': len(files)}
+
+    args.queue = 'work'
+    agupinholesearch.processQueue(session, args)
+    assert agupinholedb.count_work(session) == {'done': len(files)}
+    # one of the test frames has no usable pinhole
+    assert session.query(agupinholedb.PinholeMeasurement).count() == len(files) - 1
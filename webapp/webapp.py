@@ -13,6 +13,7 @@ from flask import render_template
 import collections
 import datetime
 import boto3
+import json
 import os
 import re
 
@@ -51,10 +52,10 @@ def s3_list_objects():
 
 
 
-def build_site_info_dict():
+def build_site_info_dict(objects=None):
     retval = collections.defaultdict(list)
     # TODO: instead of site -> filenames make a site->telescope->filenames dictionary
-    for objdict in s3_list_objects():
+    for objdict in (objects if objects is not None else s3_list_objects()):
         filename = objdict['Key']
 
         parts = re.split(r'[_\.]', filename)
@@ -68,6 +69,36 @@ def build_site_info_dict():
 
     return retval
 
+# flexure model file name -> (ETag, model), so a model is downloaded again only after aguanalysis rewrote it
+flexure_model_cache = {}
+
+def load_flexure_models(objects=None):
+    '''
+    Flexure model coefficients per camera, from the flexuremodel_<camera>.json files that aguanalysis writes next
+    to the plots. The models are fitted from statistics kept in the database, so this needs no database access.
+    Only models that are new or changed since the last request, by their ETag in the bucket listing, are downloaded.
+    '''
+    client = None
+    bucket = os.environ.get('AWS_S3_BUCKET', None)
+    models = {}
+    for objdict in (objects if objects is not None else s3_list_objects()):
+        filename = objdict['Key']
+        if filename.startswith('flexuremodel_') and filename.endswith('.json'):
+            etag = objdict.get('ETag')
+            cached = flexure_model_cache.get(filename)
+            if cached is None or etag is None or cached[0] != etag:
+                try:
+                    if client is None:
+                        client = boto3.client('s3')
+                    model = json.loads(client.get_object(Bucket=bucket, Key=filename)['Body'].read())
+                except Exception as ex:
+                    logging.error(f"While reading flexure model {filename}: {ex}")
+                    continue
+                cached = (etag, model)
+                flexure_model_cache[filename] = cached
+            models[cached[1]['instrument']] = cached[1]
+    return models
+
 def generate_presigned_url(filename):
     # https://boto3.amazonaws.com/v1/documentation/api/latest/guide/s3-presigned-urls.html
     client = boto3.client('s3')
@@ -87,10 +118,13 @@ def generate_presigned_url(filename):
 @app.route('/')
 @app.route('/index.html')
 def indexhtml():
+    # one bucket listing for the plots and the flexure models
+    objects = list(s3_list_objects())
     params = {
         'generate_presigned_url': generate_presigned_url,
         'timestamp': get_last_update_time_from_object(),
-        'info': build_site_info_dict(),
+        'info': build_site_info_dict(objects),
+        'flexure': load_flexure_models(objects),
     }
     return render_template('index.html', **params)
 